@@ -0,0 +1,223 @@
+"""
+ fake_upstream.py is a local stand-in for the 3rd party api services used by urbo (HERE, Mapple, OpenWeather)
+ it answers from the recorded responses in bench/fixtures, adapted to the requested address or location,
+ and can add latency and errors per provider
+how to run?
+    uvicorn bench.fake_upstream:app --port 9000
+
+ then point urbo to it, e.g.
+    GEOCODE_HERE_API_URL=http://127.0.0.1:9000/here/geocode
+    GEOCODE_HERE_REVERSE_API_URL=http://127.0.0.1:9000/here/revgeocode
+    TOKEN_URL=http://127.0.0.1:9000/mapple/token
+    NEARBY_PLACES_URL=http://127.0.0.1:9000/mapple/nearby
+    STILL_MAP_URL=http://127.0.0.1:9000/mapple/
+    AIR_POLLUTION_URL=http://127.0.0.1:9000/openweather/air_pollution
+
+ latency and errors are set per provider (HERE, MAPPLE, OPENWEATHER) with environment variables, e.g.
+    FAKE_HERE_LATENCY_MS=80 FAKE_HERE_JITTER_MS=20 FAKE_HERE_ERROR_RATE=0.05 FAKE_HERE_ERROR_STATUS=503
+ or while it runs with PUT /_fake/config/{provider}
+"""
+import asyncio
+import copy
+import hashlib
+import json
+import os
+import random
+import struct
+import zlib
+from collections import Counter
+from typing import Optional
+
+from fastapi import FastAPI, HTTPException, Request, Response
+from pydantic import BaseModel
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+PROVIDERS = ("here", "mapple", "openweather")
+# largest side of the generated still map, bigger sizes are clipped
+MAX_IMAGE_SIDE = 2048
+
+
+class FaultConfig(BaseModel):
+    latency_ms: float = 0
+    jitter_ms: float = 0
+    # share of the calls answered with error_status
+    error_rate: float = 0
+    error_status: int = 503
+
+
+def load_fixture(name: str) -> dict:
+    with open(os.path.join(FIXTURES_DIR, f"{name}.json")) as file:
+        return json.load(file)
+
+
+def env_fault_config(provider: str) -> FaultConfig:
+    prefix = f"FAKE_{provider.upper()}_"
+    return FaultConfig(
+        latency_ms=float(os.getenv(f"{prefix}LATENCY_MS", "0")),
+        jitter_ms=float(os.getenv(f"{prefix}JITTER_MS", "0")),
+        error_rate=float(os.getenv(f"{prefix}ERROR_RATE", "0")),
+        error_status=int(os.getenv(f"{prefix}ERROR_STATUS", "503"))
+    )
+
+
+FIXTURES = {name: load_fixture(name) for name in
+            ("here_geocode", "here_reverse_geocode", "mapple_token", "mapple_nearby", "openweather_air_pollution")}
+fault_configs = {provider: env_fault_config(provider) for provider in PROVIDERS}
+# calls received per route, tells how many upstream calls a benchmark run really made
+call_counts = Counter()
+
+app = FastAPI(title="URBO fake upstream")
+
+
+async def simulate(provider: str, route: str):
+    """
+    Counts the call, waits the configured latency and raises the configured error
+    :param provider: provider of the route
+    :param route: route name
+    """
+    call_counts[route] += 1
+    config = fault_configs[provider]
+
+    delay = config.latency_ms + random.uniform(-config.jitter_ms, config.jitter_ms)
+    if delay > 0:
+        await asyncio.sleep(delay / 1000)
+
+    if config.error_rate and random.random() < config.error_rate:
+        raise HTTPException(status_code=config.error_status, detail=f"Injected {provider} error")
+
+
+def text_offset(text: str, scale: float = 0.5):
+    """
+    :param text: any text
+    :param scale: largest offset in degrees
+    :return: (lat, lon) offset derived from the text, the same text always gives the same offset
+    """
+    digest = hashlib.sha256(text.encode()).digest()
+    lat_offset, lon_offset = struct.unpack(">hh", digest[:4])
+    return lat_offset / 32768 * scale, lon_offset / 32768 * scale
+
+
+# ------------------------- HERE -------------------------
+
+@app.get("/here/geocode")
+async def here_geocode(q: str, apiKey: Optional[str] = None):
+    await simulate("here", "here_geocode")
+    data = copy.deepcopy(FIXTURES["here_geocode"])
+    item = data["items"][0]
+    # every address gets its own position, so a benchmark with many addresses misses the caches
+    lat_offset, lon_offset = text_offset(q.strip().lower())
+    item["position"] = {"lat": round(item["position"]["lat"] + lat_offset, 6),
+                        "lng": round(item["position"]["lng"] + lon_offset, 6)}
+    item["title"] = item["address"]["label"] = q
+    return data
+
+
+@app.get("/here/revgeocode")
+async def here_reverse_geocode(at: str, limit: int = 1, apiKey: Optional[str] = None):
+    await simulate("here", "here_reverse_geocode")
+    lat, lon = (float(value) for value in at.split(","))
+    data = copy.deepcopy(FIXTURES["here_reverse_geocode"])
+    item = data["items"][0]
+    item["position"] = {"lat": lat, "lng": lon}
+    item["address"]["label"] = item["title"] = f"{item['address']['label']} ({lat:.4f},{lon:.4f})"
+    return data
+
+
+# ------------------------- MAPPLE -------------------------
+
+@app.post("/mapple/token")
+async def mapple_token():
+    await simulate("mapple", "mapple_token")
+    return FIXTURES["mapple_token"]
+
+
+@app.get("/mapple/nearby")
+async def mapple_nearby(request: Request, keywords: str, refLocation: str, radius: int = 1000,
+                        region: Optional[str] = None):
+    if request.headers.get("Authorization") != f"Bearer {FIXTURES['mapple_token']['access_token']}":
+        raise HTTPException(status_code=401, detail="Invalid token")
+    await simulate("mapple", "mapple_nearby")
+
+    lat, lon = (float(value) for value in refLocation.split(","))
+    data = copy.deepcopy(FIXTURES["mapple_nearby"])
+    fixture_position = FIXTURES["here_geocode"]["items"][0]["position"]
+    fixture_lat, fixture_lon = fixture_position["lat"], fixture_position["lng"]
+
+    # the recorded places are moved around the requested location and named after the keyword
+    places = []
+    for index, place in enumerate(data["suggestedLocations"]):
+        if place["distance"] > radius:
+            continue
+        for lat_key, lon_key in (("latitude", "longitude"), ("entryLatitude", "entryLongitude")):
+            place[lat_key] = round(place[lat_key] - fixture_lat + lat, 6)
+            place[lon_key] = round(place[lon_key] - fixture_lon + lon, 6)
+        place["eLoc"] = hashlib.sha1(f"{keywords}:{place['latitude']}:{place['longitude']}".encode()).hexdigest()[:6]
+        place["placeName"] = f"{keywords.title()} {index + 1}"
+        places.append(place)
+
+    data["suggestedLocations"] = places
+    data["pageInfo"]["totalHits"] = len(places)
+    return data
+
+
+@app.get("/mapple/{api_key}/still_image")
+async def mapple_still_image(center: str, zoom: int = 12, size: str = "1000x1000"):
+    await simulate("mapple", "mapple_still_image")
+    width, height = (min(int(value), MAX_IMAGE_SIDE) for value in size.lower().split("x"))
+    color = hashlib.sha256(f"{center}:{zoom}".encode()).digest()[:3]
+    return Response(content=solid_png(width, height, color), media_type="image/png")
+
+
+def solid_png(width: int, height: int, color: bytes) -> bytes:
+    """
+    :param width: image width
+    :param height: image height
+    :param color: RGB bytes
+    :return: PNG of one color
+    """
+    def chunk(kind: bytes, payload: bytes):
+        return (struct.pack(">I", len(payload)) + kind + payload
+                + struct.pack(">I", zlib.crc32(kind + payload) & 0xFFFFFFFF))
+
+    row = b"\x00" + color * width
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header)
+            + chunk(b"IDAT", zlib.compress(row * height, 6)) + chunk(b"IEND", b""))
+
+
+# ------------------------- OPENWEATHER -------------------------
+
+@app.get("/openweather/air_pollution")
+async def openweather_air_pollution(lat: float, lon: float, appid: Optional[str] = None):
+    await simulate("openweather", "openweather_air_pollution")
+    data = copy.deepcopy(FIXTURES["openweather_air_pollution"])
+    data["coord"] = {"lon": lon, "lat": lat}
+    # the index follows the location so different places get different recommendations
+    data["list"][0]["main"]["aqi"] = 1 + int(hashlib.sha1(f"{lat:.2f},{lon:.2f}".encode()).hexdigest(), 16) % 5
+    return data
+
+
+# ------------------------- CONTROL -------------------------
+
+@app.get("/_fake/config")
+def get_fault_configs():
+    return fault_configs
+
+
+@app.put("/_fake/config/{provider}")
+def set_fault_config(provider: str, config: FaultConfig):
+    if provider not in fault_configs:
+        raise HTTPException(status_code=404, detail="Unknown provider")
+    fault_configs[provider] = config
+    return config
+
+
+@app.get("/_fake/stats")
+def get_call_counts():
+    return dict(call_counts)
+
+
+@app.delete("/_fake/stats")
+def reset_call_counts():
+    call_counts.clear()
+    return {}
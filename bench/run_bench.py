@@ -0,0 +1,222 @@
+"""
+ run_bench.py drives the urbo endpoints at set concurrency levels and reports latency percentiles and throughput
+ results are written as JSON so runs can be compared over time
+how to run?
+    uvicorn bench.fake_upstream:app --port 9000
+    uvicorn urbo_api.urbo_app_main:app --port 8000     (pointed to the fake upstream, see fake_upstream.py)
+    python -m bench.run_bench --concurrency 1,8,32 --requests 200
+    python -m bench.run_bench --scenarios aggregate --distinct 500 --compare bench_results/previous.json
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import subprocess
+import time
+from datetime import datetime, timezone
+
+import httpx
+
+SCENARIOS = ("aggregate", "geocode", "reverse_geocode", "nearby_places", "stillmap", "air_pollution")
+CITIES = ("New Delhi", "Mumbai", "Bengaluru", "Chennai", "Kolkata", "Hyderabad", "Pune", "Jaipur", "Lucknow",
+          "Ahmedabad")
+KEYWORDS = (["parks"], ["schools"], ["hospitals"], ["parks", "schools"], ["bus stop", "metro station"])
+
+
+def request_args(scenario: str, index: int, distinct: int):
+    """
+    Builds the request number index of the scenario, only `distinct` different inputs are used,
+    so a small value measures the cache hit path and a large one the upstream path
+    :param scenario: scenario name
+    :param index: request number
+    :param distinct: number of different inputs
+    :return: method, path and httpx request kwargs
+    """
+    key = index % distinct
+    city = f"{CITIES[key % len(CITIES)]} {key // len(CITIES)}" if key >= len(CITIES) else CITIES[key]
+    lat = round(28.6139 + (key % 100) * 0.01, 4)
+    lon = round(77.2090 + (key // 100) * 0.01, 4)
+
+    if scenario == "aggregate":
+        return "POST", "/aggregate-endpoint", {"json": {"address": city, "keywords": KEYWORDS[key % len(KEYWORDS)],
+                                                        "inline_map_image": False}}
+    if scenario == "geocode":
+        return "POST", "/geocode", {"json": {"address": city}}
+    if scenario == "reverse_geocode":
+        return "POST", "/reverse-geocode", {"json": {"latitude": lat, "longitude": lon}}
+    if scenario == "nearby_places":
+        return "GET", "/fetch-nearby-places/", {"json": {"keywords": KEYWORDS[key % len(KEYWORDS)],
+                                                         "ref_location": [lat, lon]}}
+    if scenario == "stillmap":
+        return "GET", "/stillmap", {"params": {"lat": lat, "lon": lon}}
+    if scenario == "air_pollution":
+        return "GET", "/fetch-air-pollution-data/", {"params": {"latitude": lat, "longitude": lon}}
+    raise ValueError(f"Unknown scenario {scenario}")
+
+
+def percentile(sorted_values, fraction: float):
+    """
+    :param sorted_values: sorted latencies
+    :param fraction: 0.5 for p50, 0.99 for p99
+    :return: nearest rank percentile, None when there is no value
+    """
+    if not sorted_values:
+        return None
+    rank = math.ceil(fraction * len(sorted_values))
+    return sorted_values[min(max(rank, 1), len(sorted_values)) - 1]
+
+
+async def run_level(client: httpx.AsyncClient, scenario: str, concurrency: int, requests: int, distinct: int,
+                    warmup: int):
+    """
+    Sends the requests of one scenario with `concurrency` requests in flight
+    :return: latency percentiles (ms), requests per second and status counts
+    """
+    for index in range(warmup):
+        method, path, kwargs = request_args(scenario, index, distinct)
+        await client.request(method, path, **kwargs)
+
+    latencies = []
+    statuses = {}
+    next_index = iter(range(requests))
+
+    async def worker():
+        for index in next_index:
+            method, path, kwargs = request_args(scenario, index, distinct)
+            start = time.perf_counter()
+            try:
+                response = await client.request(method, path, **kwargs)
+                status = str(response.status_code)
+            except httpx.HTTPError as exc:
+                status = type(exc).__name__
+            latencies.append((time.perf_counter() - start) * 1000)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "requests": requests,
+        "distinct_inputs": distinct,
+        "elapsed_seconds": round(elapsed, 3),
+        "requests_per_second": round(requests / elapsed, 2),
+        "p50_ms": round(percentile(latencies, 0.50), 2),
+        "p95_ms": round(percentile(latencies, 0.95), 2),
+        "p99_ms": round(percentile(latencies, 0.99), 2),
+        "max_ms": round(latencies[-1], 2),
+        "statuses": statuses
+    }
+
+
+async def upstream_calls(fake_upstream_url: str, reset: bool = False):
+    """
+    :param fake_upstream_url: base url of the fake upstream, None when it is not used
+    :param reset: clears the counters after reading them
+    :return: calls received by the fake upstream per route
+    """
+    if not fake_upstream_url:
+        return None
+    try:
+        async with httpx.AsyncClient(base_url=fake_upstream_url) as client:
+            calls = (await client.get("/_fake/stats")).json()
+            if reset:
+                await client.delete("/_fake/stats")
+    except httpx.HTTPError:
+        return None
+    return calls
+
+
+async def run(args):
+    results = []
+    limits = httpx.Limits(max_connections=max(args.concurrency), max_keepalive_connections=max(args.concurrency))
+    async with httpx.AsyncClient(base_url=args.base_url, timeout=args.timeout, limits=limits) as client:
+        for scenario in args.scenarios:
+            for concurrency in args.concurrency:
+                await upstream_calls(args.fake_upstream, reset=True)
+                result = await run_level(client, scenario, concurrency, args.requests, args.distinct, args.warmup)
+                result["upstream_calls"] = await upstream_calls(args.fake_upstream)
+                results.append(result)
+                print_result(result)
+    return results
+
+
+def print_result(result: dict):
+    print(f"{result['scenario']:<16} c={result['concurrency']:<4} rps={result['requests_per_second']:<9} "
+          f"p50={result['p50_ms']:<9} p95={result['p95_ms']:<9} p99={result['p99_ms']:<9} "
+          f"statuses={result['statuses']}")
+
+
+def compare(results, previous_path: str):
+    """
+    Prints the change of rps and p95 against a previous run, for the scenarios and levels found in both
+    """
+    with open(previous_path) as file:
+        previous = {(item["scenario"], item["concurrency"]): item for item in json.load(file)["results"]}
+
+    print(f"\ncompared to {previous_path}")
+    for result in results:
+        before = previous.get((result["scenario"], result["concurrency"]))
+        if before is None:
+            continue
+        rps_change = (result["requests_per_second"] / before["requests_per_second"] - 1) * 100
+        p95_change = (result["p95_ms"] / before["p95_ms"] - 1) * 100
+        print(f"{result['scenario']:<16} c={result['concurrency']:<4} rps {rps_change:+.1f}%  p95 {p95_change:+.1f}%")
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load benchmark of the urbo endpoints")
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--fake-upstream", default="http://127.0.0.1:9000",
+                        help="fake upstream url, its call counts are added to the results (empty to skip)")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        type=lambda value: [item for item in value.split(",") if item])
+    parser.add_argument("--concurrency", default="1,8,32",
+                        type=lambda value: [int(item) for item in value.split(",")])
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario and concurrency level")
+    parser.add_argument("--distinct", type=int, default=10, help="number of different inputs cycled through")
+    parser.add_argument("--warmup", type=int, default=10, help="requests sent before measuring")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--output", default=None, help="results file, default bench_results/<timestamp>.json")
+    parser.add_argument("--compare", default=None, help="previous results file to compare with")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    for scenario in args.scenarios:
+        if scenario not in SCENARIOS:
+            raise SystemExit(f"Unknown scenario {scenario}, choose from {', '.join(SCENARIOS)}")
+
+    started_at = datetime.now(timezone.utc)
+    results = asyncio.run(run(args))
+
+    output = args.output or os.path.join("bench_results", f"{started_at:%Y%m%dT%H%M%SZ}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as file:
+        json.dump({
+            "started_at": started_at.isoformat(),
+            "commit": git_commit(),
+            "base_url": args.base_url,
+            "results": results
+        }, file, indent=2)
+    print(f"\nresults written to {output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
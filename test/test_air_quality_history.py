@@ -0,0 +1,43 @@
+"""
+    test_air_quality_history contains test cases for the monthly partitions and the rows of the air quality history
+"""
+
+from datetime import datetime, timedelta, timezone
+
+from urbo_api.urbo_api_dataload.air_quality_history_api import (COMPONENT_CODES, month_start, next_month,
+                                                                 partition_ddl, partition_name, reading_rows)
+
+
+# ------------------------- TESTS -------------------------
+
+# Test: any time falls in the partition of its UTC month
+def test_month_start():
+    moment = datetime(2024, 3, 1, 2, 30, tzinfo=timezone(timedelta(hours=5, minutes=30)))
+    assert month_start(moment) == datetime(2024, 2, 1, tzinfo=timezone.utc)
+    assert month_start(datetime(2024, 3, 31, 23, 59)) == datetime(2024, 3, 1, tzinfo=timezone.utc)
+
+
+# Test: the partition of december ends at the start of the next year
+def test_partition_bounds():
+    december = datetime(2024, 12, 1, tzinfo=timezone.utc)
+    assert next_month(december) == datetime(2025, 1, 1, tzinfo=timezone.utc)
+    assert partition_name(december) == "air_quality_readings_y2024m12"
+    ddl = partition_ddl(december)
+    assert "PARTITION OF air_quality_readings" in ddl
+    assert "FROM ('2024-12-01T00:00:00+00:00') TO ('2025-01-01T00:00:00+00:00')" in ddl
+
+
+# Test: one row per entry and component, the aqi included
+def test_reading_rows():
+    air_pollution_list = [{"main": {"aqi": 2}, "dt": 1728839262,
+                           "components": {"co": 226.97, "no": 0, "no2": 0.03, "o3": 62.94, "so2": 0.09,
+                                          "pm2_5": 0.7, "pm10": 1.43, "nh3": 0}}]
+
+    rows = reading_rows(77.209, 28.6139, air_pollution_list)
+
+    assert len(rows) == len(COMPONENT_CODES)
+    assert {row["location"] for row in rows} == {"SRID=4326;POINT(77.209 28.6139)"}
+    assert {row["measured_at"] for row in rows} == {datetime.fromtimestamp(1728839262, timezone.utc)}
+    values = {row["component"]: row["value"] for row in rows}
+    assert values[COMPONENT_CODES["aqi"]] == 2.0
+    assert values[COMPONENT_CODES["pm2_5"]] == 0.7
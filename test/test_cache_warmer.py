@@ -0,0 +1,138 @@
+"""
+    test_cache_warmer contains test cases for the scheduling of the cache warming jobs
+"""
+
+import asyncio
+import json
+import time
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+from fastapi import HTTPException
+
+from urbo_api.db_connect.local_cache import MemoryCache, SharedCache, TwoLevelCache
+from urbo_api.urbo_api_fetchdata.cache_warmer import CacheWarmer, WarmJob, load_warm_config, quota_blocker
+
+
+def fake_http(budget=None):
+    return SimpleNamespace(scheduler=SimpleNamespace(budget=lambda: budget or {}))
+
+
+# ------------------------- TESTS -------------------------
+
+# Test: places are read from a JSON list or a JSON file, with the aggregate endpoint defaults
+def test_load_warm_config(tmp_path):
+    places = [{"address": "New Delhi", "keywords": ["parks"], "radius": 2000}, {"address": "Mumbai"}]
+    config_file = tmp_path / "warm.json"
+    config_file.write_text(json.dumps(places))
+
+    for value in (json.dumps(places), str(config_file)):
+        loaded = load_warm_config(value)
+        assert [place.address for place in loaded] == ["New Delhi", "Mumbai"]
+        assert loaded[0].radius == 2000 and loaded[1].keywords == [] and loaded[1].zoom == 12
+
+    assert load_warm_config(None) == []
+
+
+# Test: a job is held back once the remaining daily quota of one of its providers reaches the reserve
+def test_quota_blocker():
+    budget = {"here": {"daily_quota": 100, "remaining_today": 20}, "mapple": {"daily_quota": None,
+                                                                             "remaining_today": None}}
+
+    assert quota_blocker(budget, ("mapple",), reserve=0.2) is None
+    assert quota_blocker(budget, ("here", "mapple"), reserve=0.1) is None
+    assert "here" in quota_blocker(budget, ("here", "mapple"), reserve=0.2)
+
+
+# Test: each job runs again after its own interval, a failed job is retried sooner
+def test_jobs_follow_their_interval():
+    calls = []
+
+    async def place_data(place, state, http):
+        calls.append(("place_data", place.address))
+
+    async def air_quality(place, state, http):
+        calls.append(("air_quality", place.address))
+        raise HTTPException(status_code=503, detail="down")
+
+    warmer = CacheWarmer(load_warm_config('[{"address": "Pune"}]'),
+                         [WarmJob("place_data", 3600, ("here",), place_data),
+                          WarmJob("air_quality", 1200, ("openweather",), air_quality)],
+                         retry_interval=300)
+    now = datetime.now(timezone.utc)
+
+    asyncio.run(warmer.run_once(fake_http(), now))
+    assert calls == [("place_data", "Pune"), ("air_quality", "Pune")]
+    assert warmer.due(now + timedelta(seconds=200)) == []
+    assert [job.name for _, job in warmer.due(now + timedelta(seconds=400))] == ["air_quality"]
+    assert [job.name for _, job in warmer.due(now + timedelta(seconds=4000))] == ["place_data", "air_quality"]
+
+    jobs = warmer.status()[0]["jobs"]
+    assert jobs["place_data"]["last_warmed_at"] is not None and jobs["place_data"]["last_error"] is None
+    assert jobs["air_quality"]["last_warmed_at"] is None and jobs["air_quality"]["last_error"] == "503: down"
+
+
+# Test: a job whose provider quota is reserved is skipped without being called
+def test_skips_when_quota_reserved():
+    calls = []
+
+    async def place_data(place, state, http):
+        calls.append(place.address)
+
+    warmer = CacheWarmer(load_warm_config('[{"address": "Pune"}]'), [WarmJob("place_data", 3600, ("here",),
+                                                                            place_data)])
+    asyncio.run(warmer.run_once(fake_http({"here": {"daily_quota": 100, "remaining_today": 5}})))
+
+    assert calls == []
+    assert warmer.status()[0]["jobs"]["place_data"]["last_error"].startswith("skipped")
+
+
+# Test: with several workers on the host only the one holding the lease runs the jobs, the other takes over later
+# and carries on from the saved runs
+def test_single_warmer_per_host(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    calls = []
+
+    async def place_data(place, state, http):
+        calls.append(place.address)
+
+    warmers = [CacheWarmer(load_warm_config('[{"address": "Pune"}]'),
+                           [WarmJob("place_data", 3600, ("here",), place_data)],
+                           shared=TwoLevelCache(MemoryCache(1000), SharedCache(path, 10000)))
+               for _ in range(2)]
+
+    for warmer in warmers:
+        asyncio.run(warmer.run_once(fake_http()))
+    assert calls == ["Pune"]
+    assert [warmer.leader for warmer in warmers] == [True, False]
+    # the worker not running the jobs reports the runs of the leader
+    assert warmers[1].status()[0]["jobs"]["place_data"]["last_warmed_at"] is not None
+
+    asyncio.run(warmers[0].stop())
+    asyncio.run(warmers[1].run_once(fake_http()))
+    assert calls == ["Pune"] and warmers[1].leader
+    assert warmers[1].due(datetime.now(timezone.utc)) == []
+    assert [job.name for _, job in warmers[1].due(datetime.now(timezone.utc) + timedelta(seconds=4000))] == \
+        ["place_data"]
+
+
+# Test: a leader with no job due for longer than the lease keeps it on every tick, the jobs are not run twice
+def test_idle_leader_keeps_lease(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    calls = []
+
+    async def place_data(place, state, http):
+        calls.append(place.address)
+
+    warmers = [CacheWarmer(load_warm_config('[{"address": "Pune"}]'),
+                           [WarmJob("place_data", 3600, ("here",), place_data)], lease_ttl=0.3,
+                           shared=TwoLevelCache(MemoryCache(1000), SharedCache(path, 10000)))
+               for _ in range(2)]
+
+    for _ in range(4):
+        for warmer in warmers:
+            asyncio.run(warmer.run_once(fake_http()))
+        time.sleep(0.15)
+
+    assert calls == ["Pune"]
+    assert [warmer.leader for warmer in warmers] == [True, False]
@@ -0,0 +1,64 @@
+"""
+    test_circuit_breaker contains test cases for the per provider circuit breaker
+"""
+
+import time
+
+import pytest
+
+from urbo_api.urbo_api_dataload.circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpenError
+
+
+# ------------------------- TESTS -------------------------
+
+# Test: the circuit opens once the failure rate is reached and then fails fast
+def test_opens_on_failure_rate():
+    breaker = CircuitBreaker("openweather", window_size=10, min_calls=4, failure_rate=0.5)
+
+    for failed in (False, True, False, True):
+        breaker.before_call()
+        breaker.record(failed, 0.1)
+
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpenError) as exc:
+        breaker.before_call()
+    assert exc.value.status_code == 503
+
+
+# Test: slow calls open the circuit even when they succeed
+def test_opens_on_slow_calls():
+    breaker = CircuitBreaker("mapple", min_calls=3, slow_call_seconds=1, slow_call_rate=0.6)
+
+    for _ in range(3):
+        breaker.before_call()
+        breaker.record(False, 2)
+
+    assert breaker.state == OPEN
+
+
+# Test: after the open period one trial call goes through, its success closes the circuit
+def test_half_open_trial_closes():
+    breaker = CircuitBreaker("here", min_calls=1, failure_rate=0.5, open_seconds=0.1)
+    breaker.before_call()
+    breaker.record(True, 0.1)
+    time.sleep(0.15)
+
+    breaker.before_call()
+    assert breaker.state == HALF_OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    breaker.record(False, 0.1)
+    assert breaker.state == CLOSED
+
+
+# Test: a failed trial call opens the circuit again
+def test_half_open_trial_fails():
+    breaker = CircuitBreaker("here", min_calls=1, failure_rate=0.5, open_seconds=0.1)
+    breaker.before_call()
+    breaker.record(True, 0.1)
+    time.sleep(0.15)
+
+    breaker.before_call()
+    breaker.record(True, 0.1)
+    assert breaker.state == OPEN
@@ -0,0 +1,116 @@
+"""
+    test_fetch_data contains test cases for the sections of the aggregate endpoint and the NDJSON stream of its
+    batch endpoint
+"""
+
+import asyncio
+import json
+from datetime import datetime, timezone
+
+import pytest
+from fastapi import HTTPException
+
+from urbo_api.urbo_api_dataload import schema
+from urbo_api.urbo_api_dataload.map_image_api import stillmap_image_url
+from urbo_api.urbo_api_fetchdata import fetch_data
+from urbo_api.urbo_api_fetchdata.fetch_data import build_urban_planning_data, encode_aggregate_response, \
+    stream_urban_planning_data
+
+NEARBY_PLACES = {"suggestedLocations": [{"eLoc": "A1", "placeName": "Lodhi Garden"},
+                                        {"eLoc": "B2", "placeName": "Nehru Park"}],
+                 "keywordCounts": {"parks": 2}}
+AIR_QUALITY = {"output": {"main": {"aqi": 2}, "components": {"pm2_5": 12.5}},
+               "fetched_at": datetime(2024, 1, 1, tzinfo=timezone.utc), "stale": False}
+STILL_MAP = {"id": "5f0c6a52-6a5b-4c38-9d0b-7cbe4ab5e7a1", "map_img": None}
+
+
+@pytest.fixture
+def loaders(monkeypatch):
+    """replaces the geocode lookup and the section loaders, returns the names of the loaders called"""
+    calls = []
+
+    async def find_stored_geocode(address, async_db):
+        return schema.GeocodePoint(address=address, latitude=28.6139, longitude=77.2090)
+
+    def loader(name, result):
+        def load(*args):
+            calls.append(name)
+            return result
+        return load
+
+    monkeypatch.setattr(fetch_data, "find_stored_geocode", find_stored_geocode)
+    monkeypatch.setattr(fetch_data, "with_session", lambda load, *args: load(*args, None))
+    monkeypatch.setattr(fetch_data, "load_nearby_places", loader("nearby_places", NEARBY_PLACES))
+    monkeypatch.setattr(fetch_data, "load_air_pollution", loader("air_quality", AIR_QUALITY))
+    monkeypatch.setattr(fetch_data, "load_still_map", loader("still_map", STILL_MAP))
+    return calls
+
+
+def build(sections):
+    user_input = schema.UrbanPlanningByPlaceCreate(address="New Delhi", keywords=["parks"],
+                                                   inline_map_image=False, sections=sections)
+    response_data = asyncio.run(build_urban_planning_data(user_input, None, None))
+    return encode_aggregate_response(user_input, response_data)
+
+
+# ------------------------- TESTS -------------------------
+
+# Test: the sections which are not requested are never loaded nor returned, the count comes without the places
+def test_requested_sections_only(loaders):
+    response = build(["air_quality", "nearby_places_count"])
+
+    assert sorted(loaders) == ["air_quality", "nearby_places"]
+    assert response["nearby_places_count"] == 2
+    assert response["air_quality_index"] == 2
+    assert "Nearby_places" not in response
+    assert "still_map_url" not in response and "pollutants_info" not in response
+
+
+# Test: a single section only calls its own loader
+def test_single_section(loaders):
+    response = build(["still_map"])
+
+    assert loaders == ["still_map"]
+    assert response["still_map_url"] == stillmap_image_url(STILL_MAP["id"])
+    assert "air_quality_index" not in response and "nearby_places_count" not in response
+
+
+# Test: without sections every section is loaded and returned
+def test_all_sections(loaders):
+    response = build(None)
+
+    assert sorted(loaders) == ["air_quality", "nearby_places", "still_map"]
+    assert response["Nearby_places"] == NEARBY_PLACES
+    assert response["nearby_places_count"] == 2 and response["pollutants_info"]
+
+
+# Test: at most concurrency places are built at once, a failing place gives an error line and the stream goes on
+def test_batch_stream(monkeypatch):
+    running = []
+    most_running = []
+
+    async def coalesced_urban_planning_data(user_input, http):
+        running.append(user_input.address)
+        most_running.append(len(running))
+        await asyncio.sleep(0.01)
+        running.remove(user_input.address)
+        if user_input.address == "Atlantis":
+            raise HTTPException(status_code=404, detail="Address not found")
+        if user_input.address == "Broken":
+            raise ValueError("bug")
+        return {"address": user_input.address, "latitude": 1, "longitude": 2, "degraded_sections": []}
+
+    monkeypatch.setattr(fetch_data, "coalesced_urban_planning_data", coalesced_urban_planning_data)
+    addresses = ["Pune", "Atlantis", "Mumbai", "Broken", "Delhi", "Chennai", "Kolkata"]
+    user_inputs = [schema.UrbanPlanningByPlaceCreate(address=address, keywords=[]) for address in addresses]
+
+    async def collect():
+        return [json.loads(line) async for line in stream_urban_planning_data(user_inputs, None, 2)]
+
+    lines = sorted(asyncio.run(collect()), key=lambda line: line["index"])
+
+    assert max(most_running) == 2
+    assert [line["address"] for line in lines] == addresses
+    assert lines[1]["error"] == {"status_code": 404, "detail": "Address not found"}
+    assert lines[3]["error"]["status_code"] == 500
+    assert all(lines[index]["result"]["address"] == addresses[index] for index in (0, 2, 4, 5, 6))
@@ -0,0 +1,68 @@
+"""
+    test_heatmap contains test cases for the sample grid, the interpolation and the PNG encoding of the heatmap
+"""
+
+import zlib
+
+import numpy as np
+
+from urbo_api.urbo_api_fetchdata.heatmap import colorize, encode_png, grid_coordinates, grid_offsets, idw
+
+
+# ------------------------- TESTS -------------------------
+
+# Test: row 0 is the north edge and column 0 the west edge of the square
+def test_grid_offsets():
+    y, x = grid_offsets(3, 1000)
+
+    assert y.shape == x.shape == (3, 3)
+    assert y[0, 0] == 500 and y[2, 0] == -500
+    assert x[0, 0] == -500 and x[0, 2] == 500
+    assert y[1, 1] == x[1, 1] == 0
+
+
+# Test: the center of the grid is the center coordinate
+def test_grid_coordinates():
+    lats, lons = grid_coordinates(28.6139, 77.2090, 5, 10000)
+
+    assert lats[2, 2] == 28.6139 and lons[2, 2] == 77.2090
+    assert lats[0, 2] > lats[4, 2]
+    assert lons[2, 4] > lons[2, 0]
+
+
+# Test: targets on a sample get its value, targets in between get a value within the sampled range
+def test_idw():
+    sample_xy = np.array([[0, 0], [100, 0]])
+    sample_values = np.array([[1.0, 10.0], [5.0, 20.0]])
+    target_xy = np.array([[0, 0], [100, 0], [50, 0], [25, 0]])
+
+    result = idw(sample_xy, sample_values, target_xy, chunk_cells=3)
+
+    np.testing.assert_allclose(result[0], [1, 10], rtol=1e-3)
+    np.testing.assert_allclose(result[1], [5, 20], rtol=1e-3)
+    np.testing.assert_allclose(result[2], [3, 15], rtol=1e-5)
+    assert 1 < result[3, 0] < 3
+
+
+# Test: the lowest value gets the first color and the highest the last one
+def test_colorize():
+    rgba = colorize(np.array([[1, 5], [3, 9]]), 1, 5, alpha=100)
+
+    assert rgba.shape == (2, 2, 4)
+    assert tuple(rgba[0, 0]) == (0, 166, 81, 100)
+    assert tuple(rgba[0, 1]) == tuple(rgba[1, 1]) == (126, 0, 35, 100)
+
+
+# Test: the PNG keeps the size and the pixels of the array
+def test_encode_png():
+    rgba = np.zeros((2, 3, 4), dtype=np.uint8)
+    rgba[1, 2] = (10, 20, 30, 40)
+
+    image = encode_png(rgba)
+
+    assert image.startswith(b"\x89PNG\r\n\x1a\n")
+    assert int.from_bytes(image[16:20], "big") == 3 and int.from_bytes(image[20:24], "big") == 2
+    idat = image[image.index(b"IDAT") + 4:image.index(b"IEND") - 8]
+    raw = zlib.decompress(idat)
+    assert len(raw) == 2 * (3 * 4 + 1)
+    assert raw[-4:] == bytes((10, 20, 30, 40))
@@ -0,0 +1,63 @@
+"""
+    test_http_client contains test cases for the retries of the shared upstream http client
+"""
+
+import pytest
+import requests
+from fastapi import HTTPException
+
+from urbo_api.urbo_api_dataload.http_client import UpstreamClient, upstream_error
+from urbo_api.urbo_api_dataload.upstream_scheduler import HERE, UpstreamScheduler
+
+
+def make_response(status_code: int, headers=None):
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers.update(headers or {})
+    return response
+
+
+def make_client():
+    scheduler = UpstreamScheduler({HERE: {"rate": 100, "burst": 100, "daily_quota": 0}})
+    return UpstreamClient(max_retries=3, backoff_factor=0, max_retry_wait=1, scheduler=scheduler)
+
+
+# ------------------------- TESTS -------------------------
+
+# Test: every retry of a 5xx response takes its own token
+def test_retries_take_tokens():
+    client = make_client()
+    responses = iter([make_response(502), make_response(503), make_response(200)])
+
+    response = client._send(lambda url, **kwargs: next(responses), "https://example.com", HERE)
+
+    assert response.status_code == 200
+    assert client.scheduler.budget()[HERE]["used_today"] == 3
+
+
+# Test: a Retry-After longer than the allowed wait pauses the provider instead of sleeping
+def test_long_retry_after_pauses_provider():
+    client = make_client()
+    calls = []
+
+    def send(url, **kwargs):
+        calls.append(url)
+        return make_response(429, {"Retry-After": "30"})
+
+    with pytest.raises(HTTPException) as exc:
+        client._send(send, "https://example.com", HERE)
+
+    assert exc.value.status_code == 503
+    assert len(calls) == 1
+    assert client.scheduler.budget()[HERE]["paused_for_seconds"] > 25
+
+
+# Test: a rate limited or failing service or refused credentials are upstream failures, a refused request is a
+# bad request
+def test_upstream_error_status():
+    assert upstream_error(429, "limited").status_code == 503
+    assert upstream_error(500, "failed").status_code == 502
+    assert upstream_error(503, "failed").status_code == 502
+    assert upstream_error(401, "rotated key").status_code == 502
+    assert upstream_error(403, "rotated key").status_code == 502
+    assert upstream_error(404, "refused").status_code == 400
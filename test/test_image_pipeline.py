@@ -0,0 +1,110 @@
+"""
+    test_image_pipeline contains test cases for deriving still maps from stored ones and for their variants
+"""
+
+import io
+
+import pytest
+
+from urbo_api.urbo_api_dataload.image_pipeline import best_source, crop_box, derive_image, make_variant, \
+    mercator_pixel, parse_size
+
+Image = pytest.importorskip("PIL.Image")
+
+SOURCE = {"lat": 28.6139, "lon": 77.2090, "zoom": 12, "size": (1000, 1000)}
+
+
+def png(width: int, height: int) -> bytes:
+    # left half red, right half blue, so crops can be told apart
+    image = Image.new("RGB", (width, height), (0, 0, 255))
+    image.paste((255, 0, 0), (0, 0, width // 2, height))
+    output = io.BytesIO()
+    image.save(output, format="PNG")
+    return output.getvalue()
+
+
+# ------------------------- TESTS -------------------------
+
+# Test: sizes are parsed, invalid ones give None
+def test_parse_size():
+    assert parse_size("1000x500") == (1000, 500)
+    assert parse_size("500X500") == (500, 500)
+    assert parse_size("big") is None
+    assert parse_size("0x10") is None
+
+
+# Test: one zoom level more doubles the pixel distances
+def test_mercator_pixel():
+    x_12, y_12 = mercator_pixel(28.6139, 77.2090, 12)
+    x_13, y_13 = mercator_pixel(28.6139, 77.2090, 13)
+
+    assert x_13 == pytest.approx(2 * x_12)
+    assert y_13 == pytest.approx(2 * y_12)
+    assert mercator_pixel(0, 0, 0) == pytest.approx((128, 128))
+
+
+# Test: a smaller size at the same zoom is the middle of the stored map
+def test_crop_box_smaller_size():
+    assert crop_box(SOURCE, 28.6139, 77.2090, 12, (500, 500)) == pytest.approx((250, 250, 750, 750))
+
+
+# Test: one zoom level in uses half the pixels, one level out needs twice the pixels of the stored map
+def test_crop_box_zoom():
+    assert crop_box(SOURCE, 28.6139, 77.2090, 13, (1000, 1000)) == pytest.approx((250, 250, 750, 750))
+    assert crop_box(SOURCE, 28.6139, 77.2090, 11, (500, 500)) == pytest.approx((0, 0, 1000, 1000))
+    assert crop_box(SOURCE, 28.6139, 77.2090, 11, (1000, 1000)) is None
+    assert crop_box(SOURCE, 28.6139, 77.2090, 14, (500, 500), max_upscale=2) is None
+
+
+# Test: a nearby center moves the crop, a center outside of the stored map gives None
+def test_crop_box_moved_center():
+    box = crop_box(SOURCE, 28.6139, 77.2090 + 100 * 360 / (256 * 2 ** 12), 12, (500, 500))
+
+    assert box == pytest.approx((350, 250, 850, 750))
+    assert crop_box(SOURCE, 28.6139, 78.2090, 12, (500, 500)) is None
+
+
+# Test: the stored map needing the least enlargement is chosen
+def test_best_source():
+    zoomed_out = {**SOURCE, "zoom": 11, "id": "zoomed_out"}
+    same_zoom = {**SOURCE, "id": "same_zoom"}
+
+    source, box = best_source([zoomed_out, same_zoom], 28.6139, 77.2090, 12, (500, 500))
+
+    assert source["id"] == "same_zoom"
+    assert best_source([], 28.6139, 77.2090, 12, (500, 500)) is None
+
+
+# Test: a derived map is never used as a source, even when it is the closest and needs no enlargement
+def test_best_source_skips_derived_maps():
+    derived = {**SOURCE, "id": "derived", "source_id": "original"}
+    original = {**SOURCE, "zoom": 11, "id": "original", "source_id": None}
+
+    source, box = best_source([derived, original], 28.6139, 77.2090, 12, (500, 500))
+    assert source["id"] == "original"
+
+    assert best_source([derived], 28.6139, 77.2090, 12, (500, 500)) is None
+
+
+# Test: the derived image has the requested size and shows the requested part of the stored map
+def test_derive_image():
+    content = png(100, 100)
+
+    cropped = Image.open(io.BytesIO(derive_image(content, (0, 25, 50, 75), (50, 50))))
+    assert cropped.size == (50, 50)
+    assert cropped.getpixel((25, 25))[:3] == (255, 0, 0)
+
+    resized = Image.open(io.BytesIO(derive_image(content, (0, 0, 100, 100), (40, 40))))
+    assert resized.size == (40, 40)
+    assert resized.getpixel((35, 20))[:3] == (0, 0, 255)
+
+
+# Test: variants are WebP, the thumbnail keeps the aspect ratio
+def test_make_variant():
+    content = png(1000, 500)
+
+    webp = Image.open(io.BytesIO(make_variant(content, "webp")))
+    thumbnail = Image.open(io.BytesIO(make_variant(content, "thumbnail")))
+
+    assert webp.format == "WEBP" and webp.size == (1000, 500)
+    assert thumbnail.format == "WEBP" and thumbnail.size == (256, 128)
@@ -0,0 +1,75 @@
+"""
+    test_local_cache contains test cases for the in-process and shared levels of the local cache
+"""
+
+import time
+
+from urbo_api.db_connect.local_cache import MemoryCache, SharedCache, TwoLevelCache, make_key
+
+
+# ------------------------- TESTS -------------------------
+
+# Test: the least recently used values are evicted once the memory level is over its size
+def test_memory_lru_eviction():
+    memory = MemoryCache(max_bytes=10)
+    expires_at = time.time() + 60
+
+    memory.set("a", b"1234", expires_at)
+    memory.set("b", b"1234", expires_at)
+    memory.get("a")
+    memory.set("c", b"1234", expires_at)
+
+    assert memory.get("b") is None
+    assert memory.get("a") is not None and memory.get("c") is not None
+    assert memory.size == 8
+
+
+# Test: expired values are not served by either level
+def test_ttl_expiry(tmp_path):
+    memory = MemoryCache(max_bytes=1000)
+    shared = SharedCache(str(tmp_path / "cache.sqlite3"), max_bytes=1000)
+
+    memory.set("a", b"1", time.time() - 1)
+    shared.set("a", b"1", time.time() - 1)
+
+    assert memory.get("a") is None
+    assert shared.get("a") is None
+
+
+# Test: a value set by one worker is served by another one through the shared file
+def test_shared_between_workers(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    worker_1 = TwoLevelCache(MemoryCache(1000), SharedCache(path, 10000))
+    worker_2 = TwoLevelCache(MemoryCache(1000), SharedCache(path, 10000))
+
+    worker_1.set("geocode", "New Delhi", {"latitude": 28.6139, "longitude": 77.209}, ttl=60)
+
+    assert worker_2.get("geocode", "New Delhi") == {"latitude": 28.6139, "longitude": 77.209}
+    # copied to the memory level of the second worker
+    assert worker_2.memory.get(make_key("geocode", "New Delhi")) is not None
+    assert worker_2.get("geocode", "Mumbai") is None
+
+
+# Test: the cached value is a copy, changing it does not change the cache
+def test_values_are_copies():
+    cache = TwoLevelCache(MemoryCache(1000))
+    cache.set("nearby_places", ["parks", 28.61, 77.21], {"suggestedLocations": []}, ttl=60)
+
+    cache.get("nearby_places", ["parks", 28.61, 77.21])["suggestedLocations"].append(1)
+
+    assert cache.get("nearby_places", ("parks", 28.61, 77.21)) == {"suggestedLocations": []}
+
+
+# Test: trimming the shared file keeps the most recently read values within its size
+def test_shared_trim(tmp_path):
+    shared = SharedCache(str(tmp_path / "cache.sqlite3"), max_bytes=8, trim_every=1000)
+    expires_at = time.time() + 60
+
+    for key in ("a", "b", "c"):
+        shared.set(key, b"1234", expires_at)
+        time.sleep(0.01)
+    shared.get("a")
+    shared.trim()
+
+    assert shared.get("b") is None
+    assert shared.get("a") is not None and shared.get("c") is not None
@@ -0,0 +1,53 @@
+"""
+    test_local_places contains test cases for the coverage decision of the stored Mapple results
+"""
+
+from types import SimpleNamespace
+
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Query
+
+from urbo_api.urbo_api_dataload.local_places import find_covering_request, is_complete_result, place_coordinates
+
+
+def recording_session(statements):
+    """session whose queries compile their SQL instead of running it"""
+    class RecordingQuery(Query):
+        def first(self):
+            statements.append(str(self.statement.compile(dialect=postgresql.dialect())))
+            return None
+
+    return SimpleNamespace(query=lambda *entities: RecordingQuery(entities))
+
+
+# ------------------------- TESTS -------------------------
+
+# Test: coordinates are read from latitude / longitude, then from the entry point, missing ones give None
+def test_place_coordinates():
+    assert place_coordinates({"latitude": 28.6, "longitude": 77.2}) == (77.2, 28.6)
+    assert place_coordinates({"entryLatitude": "28.6", "entryLongitude": "77.2"}) == (77.2, 28.6)
+    assert place_coordinates({"latitude": 28.6}) is None
+
+
+# Test: a result with more pages or a place without coordinates can not answer later queries locally
+def test_is_complete_result():
+    located = {"eLoc": "A1", "latitude": 28.6, "longitude": 77.2}
+
+    assert is_complete_result({"suggestedLocations": [located]})
+    assert is_complete_result({"suggestedLocations": []})
+    assert is_complete_result({"suggestedLocations": [located], "pageInfo": {"totalPages": 1}})
+    assert not is_complete_result({"suggestedLocations": [located], "pageInfo": {"totalPages": 3}})
+    assert not is_complete_result({"suggestedLocations": [located, {"eLoc": "B2"}]})
+
+
+# Test: only a complete result of the keyword whose circle contains the requested circle covers it
+def test_find_covering_request_filters():
+    statements = []
+    find_covering_request(recording_session(statements), "parks", 28.6139, 77.2090, 500)
+
+    sql = " ".join(statements[0].split())
+    assert "nearby_places.keywords = %(keywords_1)s" in sql
+    assert "nearby_places.complete IS true" in sql
+    assert "nearby_places.radius >= %(radius_1)s" in sql
+    assert "ST_DWithin(nearby_places.ref_location" in sql
+    assert "nearby_places.radius - %(radius_2)s" in sql
@@ -0,0 +1,52 @@
+"""
+    test_metrics contains test cases for the Prometheus text format of the metrics
+"""
+
+from urbo_api.urbo_api_monitoring.metrics import Counter, Histogram, Registry, statement_kind
+
+
+# ------------------------- TESTS -------------------------
+
+# Test: counters are exposed per label values
+def test_counter_exposition():
+    registry = Registry()
+    counter = registry.register(Counter("cache_lookups_total", "Lookups", ("table", "result")))
+    counter.inc("geocode", "hit")
+    counter.inc("geocode", "hit")
+    counter.inc("geocode", "miss")
+
+    text = registry.expose()
+    assert "# TYPE cache_lookups_total counter" in text
+    assert 'cache_lookups_total{table="geocode",result="hit"} 2' in text
+    assert 'cache_lookups_total{table="geocode",result="miss"} 1' in text
+
+
+# Test: histogram buckets are cumulative and end with +Inf, sum and count follow
+def test_histogram_exposition():
+    registry = Registry()
+    histogram = registry.register(Histogram("duration_seconds", "Duration", ("provider",), buckets=(0.1, 1)))
+    for value in (0.05, 0.5, 0.5, 3):
+        histogram.observe("here", value=value)
+
+    lines = registry.expose().split("\n")
+    assert 'duration_seconds_bucket{provider="here",le="0.1"} 1' in lines
+    assert 'duration_seconds_bucket{provider="here",le="1"} 3' in lines
+    assert 'duration_seconds_bucket{provider="here",le="+Inf"} 4' in lines
+    assert 'duration_seconds_sum{provider="here"} 4.05' in lines
+    assert 'duration_seconds_count{provider="here"} 4' in lines
+
+
+# Test: label values are escaped
+def test_label_escaping():
+    registry = Registry()
+    counter = registry.register(Counter("errors_total", "Errors", ("detail",)))
+    counter.inc('say "hi"\n')
+
+    assert 'errors_total{detail="say \\"hi\\"\\n"} 1' in registry.expose()
+
+
+# Test: statements are grouped by their first keyword
+def test_statement_kind():
+    assert statement_kind("  select * from geocode") == "SELECT"
+    assert statement_kind("INSERT INTO places VALUES (1)") == "INSERT"
+    assert statement_kind("CREATE INDEX idx ON places (id)") == "OTHER"
@@ -0,0 +1,41 @@
+"""
+    test_nearby_places contains test cases for the keyword normalization and the merge of the per keyword
+    nearby places results
+"""
+
+from urbo_api.urbo_api_dataload.data_nearbyplaces_api import merge_nearby_places_responses, normalize_keywords
+
+
+# ------------------------- TESTS -------------------------
+
+# Test: keywords are stripped and lower cased, duplicates and empty ones are dropped, the first order is kept
+def test_normalize_keywords():
+    assert normalize_keywords(["Parks", " schools ", "PARKS", "", "  ", "Hospitals"]) == \
+        ["parks", "schools", "hospitals"]
+    assert normalize_keywords([]) == []
+
+
+# Test: a place found by several keywords is kept once, places without eLoc are all kept, in response order
+def test_merge_dedupes_across_keywords():
+    parks = {"suggestedLocations": [{"eLoc": "A1", "placeName": "Lodhi Garden"},
+                                    {"eLoc": "B2", "placeName": "Nehru Park"}]}
+    gardens = {"suggestedLocations": [{"eLoc": "B2", "placeName": "Nehru Park"},
+                                      {"eLoc": "C3", "placeName": "Mughal Garden"},
+                                      {"placeName": "Unnamed lawn"},
+                                      {"placeName": "Unnamed lawn"}]}
+
+    merged = merge_nearby_places_responses([parks, gardens])
+
+    assert [location.get("eLoc") for location in merged["suggestedLocations"]] == ["A1", "B2", "C3", None, None]
+    assert "keywordCounts" not in merged
+
+
+# Test: with the keywords, the number of places each keyword found is added, before the dedupe
+def test_merge_keyword_counts():
+    parks = {"suggestedLocations": [{"eLoc": "A1"}, {"eLoc": "B2"}]}
+    gardens = {"suggestedLocations": [{"eLoc": "B2"}]}
+
+    merged = merge_nearby_places_responses([parks, gardens, {}], ["parks", "gardens", "forests"])
+
+    assert len(merged["suggestedLocations"]) == 2
+    assert merged["keywordCounts"] == {"parks": 2, "gardens": 1, "forests": 0}
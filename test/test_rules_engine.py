@@ -0,0 +1,66 @@
+"""
+    test_rules_engine contains test cases for the compilation and the batch evaluation of the recommendation rules
+"""
+
+import numpy as np
+import pytest
+
+from urbo_api.urbo_api_fetchdata.rules_engine import DEFAULT_RULES, NEARBY_PAGE_SIZE, RuleSet
+
+RULES = [
+    {"name": "parks", "metric": "places", "keywords": ["parks"], "op": ">=", "value": 10, "per_radius": 1000,
+     "weight": 2, "pass": "{value:g} {label}", "fail": "only {value:g} of {threshold:g} {label}"},
+    {"name": "air_quality", "metric": "aqi", "op": "<=", "value": 3, "weight": 1},
+]
+
+
+# ------------------------- TESTS -------------------------
+
+# Test: thresholds grow in proportion to the searched radius, unknown values neither pass nor fail
+def test_evaluate():
+    rules = RuleSet(RULES)
+    passed, known, thresholds = rules.evaluate([[12, 4], [12, np.nan]], [1000, 2000])
+
+    assert thresholds.tolist() == [[10, 3], [20, 3]]
+    assert passed.tolist() == [[True, False], [False, False]]
+    assert known.tolist() == [[True, True], [True, False]]
+    assert rules.scores(passed, known).tolist() == pytest.approx([200 / 3, 0])
+
+
+# Test: each city gets its score and the results of the rules it has data for, in input order
+def test_score_cities():
+    results = RuleSet(RULES).score_cities([
+        {"radius": 1000, "aqi": 2, "place_counts": {"Parks": 4}},
+        {"radius": 1000},
+    ])
+
+    assert results[0]["score"] == 33.3
+    assert [rule["name"] for rule in results[0]["rules"]] == ["parks", "air_quality"]
+    assert results[0]["rules"][0]["message"] == "only 4 of 10 parks"
+    assert results[0]["rules"][1]["message"] is None
+    assert results[1] == {"score": None, "rules": []}
+
+
+# Test: invalid rules are refused when they are compiled, the default rules compile
+def test_invalid_rules():
+    with pytest.raises(ValueError):
+        RuleSet([{"name": "parks", "metric": "places", "op": "=>", "value": 10}])
+    with pytest.raises(ValueError):
+        RuleSet([{"name": "trees", "metric": "trees", "op": ">=", "value": 10}])
+
+    assert len(RuleSet(DEFAULT_RULES)) == len(DEFAULT_RULES)
+
+
+# Test: over 1000 meters a full page of places still passes, the threshold is capped at the page size
+def test_large_radius_full_page():
+    rules = RuleSet(DEFAULT_RULES)
+    full_page = {"parks": NEARBY_PAGE_SIZE, "bus stop": NEARBY_PAGE_SIZE}
+
+    for radius in (1500, 2000, 5000):
+        results = {rule["name"]: rule for rule in rules.score_cities([{"radius": radius,
+                                                                       "place_counts": full_page}])[0]["rules"]}
+        assert results["parks"]["passed"] and results["parks"]["threshold"] == NEARBY_PAGE_SIZE
+        assert results["public_transport"]["passed"]
+
+    results = rules.score_cities([{"radius": 500, "place_counts": {"parks": 5}}])[0]["rules"]
+    assert results[0]["name"] == "parks" and results[0]["threshold"] == 5 and results[0]["passed"]
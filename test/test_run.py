@@ -91,8 +91,8 @@ def test_root(test_client):
 
 # Test: Successful geocode lookup
 def test_get_geocode_success(test_client, geocode_payload, here_api_response):
-    # Mock requests.get to return a successful response
-    with patch('requests.get') as mock_get:
+    # Mock the upstream http client get to return a successful response
+    with patch('requests.Session.get') as mock_get:
         mock_get.return_value.status_code = 200
         mock_get.return_value.json.return_value = here_api_response
 
@@ -110,8 +110,8 @@ def test_get_geocode_success(test_client, geocode_payload, here_api_response):
 
 # Test: Address not found in HERE API
 def test_get_geocode_address_not_found(test_client, geocode_payload):
-    # Mock requests.get to return an empty list
-    with patch('requests.get') as mock_get:
+    # Mock the upstream http client get to return an empty list
+    with patch('requests.Session.get') as mock_get:
         mock_get.return_value.status_code = 200
         mock_get.return_value.json.return_value = {'items': []}
 
@@ -126,8 +126,8 @@ def test_get_geocode_address_not_found(test_client, geocode_payload):
 
 # Test: HERE API returns non-200 status code
 def test_get_geocode_here_api_error(test_client, geocode_payload):
-    # Mock requests.get to return an error status
-    with patch('requests.get') as mock_get:
+    # Mock the upstream http client get to return an error status
+    with patch('requests.Session.get') as mock_get:
         # Service Unavailable
         mock_get.return_value.status_code = 503
 
@@ -0,0 +1,93 @@
+"""
+    test_single_flight contains test cases for coalescing identical in-flight calls
+"""
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+from urbo_api.urbo_api_dataload.single_flight import AsyncSingleFlight, SingleFlight
+
+
+# ------------------------- TESTS -------------------------
+
+# Test: threads calling the same key at the same time share one call
+def test_concurrent_calls_share_result():
+    flight = SingleFlight()
+    calls = []
+
+    def fetch(value):
+        calls.append(value)
+        time.sleep(0.2)
+        return {"value": value}
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flight.do("key", fetch, 1))) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert results == [{"value": 1}] * 10
+
+
+# Test: the error of the call is raised to every waiter and the key is released
+def test_error_is_shared_and_key_released():
+    flight = SingleFlight()
+    errors = []
+
+    def fail():
+        time.sleep(0.2)
+        raise ValueError("upstream failed")
+
+    def call():
+        try:
+            flight.do("key", fail)
+        except ValueError as exc:
+            errors.append(exc)
+
+    threads = [threading.Thread(target=call) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(errors) == 5
+    assert flight.do("key", lambda: "ok") == "ok"
+
+
+# Test: a finished call is not reused, the next call fetches again
+def test_sequential_calls_are_not_cached():
+    flight = SingleFlight()
+    calls = []
+
+    flight.do("key", calls.append, 1)
+    flight.do("key", calls.append, 2)
+
+    assert calls == [1, 2]
+
+
+# Test: coroutines share one task, a cancelled waiter does not cancel it for the others
+def test_async_calls_share_task():
+    flight = AsyncSingleFlight()
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.1)
+        return "result"
+
+    async def run():
+        first = asyncio.ensure_future(flight.do("key", fetch))
+        others = [asyncio.ensure_future(flight.do("key", fetch)) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await asyncio.gather(*others)
+
+    assert asyncio.run(run()) == ["result"] * 3
+    assert len(calls) == 1
@@ -0,0 +1,46 @@
+"""
+    test_spatial contains test cases for the distance tolerant lookups of the stored points
+"""
+
+from sqlalchemy.dialects import postgresql
+
+from urbo_api.urbo_api_dataload import models
+from urbo_api.urbo_api_dataload.spatial import nearest_first, within_distance
+
+
+def compile_sql(expression):
+    """:return: SQL of the expression for PostGIS and its parameters"""
+    compiled = expression.compile(dialect=postgresql.dialect())
+    return " ".join(compiled.string.split()), compiled.params
+
+
+# ------------------------- TESTS -------------------------
+
+# Test: a geography column is matched with ST_DWithin on geography in meters, not by exact equality
+def test_within_distance_geography():
+    sql, params = compile_sql(within_distance(models.NearbyPlace.ref_location, 77.2090, 28.6139, 50))
+
+    assert sql.startswith("ST_DWithin(nearby_places.ref_location, CAST(ST_GeogFromText(")
+    assert "AS geography(GEOMETRY,4326)" in sql
+    assert " = " not in sql
+    assert 50 in params.values()
+
+
+# Test: a geometry column gets the index friendly bounding box in degrees and the exact check on geography in meters
+def test_within_distance_geometry():
+    sql, params = compile_sql(within_distance(models.AirPollution.center_coordinates, 77.2090, 28.6139, 50))
+
+    assert sql.count("ST_DWithin(") == 2
+    assert "ST_DWithin(airpollution.center_coordinates, ST_GeomFromText(" in sql
+    assert "ST_DWithin(CAST(airpollution.center_coordinates AS geography(GEOMETRY,4326))" in sql
+    assert " = " not in sql
+    assert 50 in params.values()
+
+
+# Test: the closest point comes first with the KNN operator, so the GiST index is used
+def test_nearest_first():
+    geography_sql, _ = compile_sql(nearest_first(models.NearbyPlace.ref_location, 77.2090, 28.6139))
+    geometry_sql, _ = compile_sql(nearest_first(models.AirPollution.center_coordinates, 77.2090, 28.6139))
+
+    assert geography_sql.startswith("nearby_places.ref_location <-> CAST(ST_GeogFromText(")
+    assert geometry_sql.startswith("airpollution.center_coordinates <-> ST_GeomFromEWKT(")
@@ -0,0 +1,52 @@
+"""
+    test_tracing contains test cases for the request spans and the Server-Timing header
+"""
+
+import time
+
+from fastapi import FastAPI
+from fastapi.concurrency import run_in_threadpool
+from fastapi.testclient import TestClient
+
+from urbo_api.urbo_api_monitoring.tracing import TimingMiddleware, span, traced
+
+
+# ------------------------- HELPERS -------------------------
+
+@traced("load")
+def load():
+    time.sleep(0.01)
+    return "loaded"
+
+
+def timed_app():
+    app = FastAPI()
+    app.add_middleware(TimingMiddleware)
+
+    @app.get("/work")
+    async def work():
+        with span("stage"):
+            # spans started in the threadpool are children of the current span
+            return await run_in_threadpool(load)
+
+    return app
+
+
+# ------------------------- TESTS -------------------------
+
+# Test: the stages of the request are in the Server-Timing header, with the total last
+def test_server_timing_header():
+    with TestClient(timed_app()) as client:
+        response = client.get("/work")
+
+    assert response.status_code == 200
+    entries = [entry.split(";")[0] for entry in response.headers["server-timing"].split(", ")]
+    assert entries[:2] == ["stage", "load"]
+    assert entries[-1] == "total"
+
+
+# Test: spans outside of a request do nothing
+def test_span_outside_request():
+    with span("alone") as current:
+        assert current is None
+    assert load() == "loaded"
@@ -0,0 +1,53 @@
+"""
+    test_transport_density contains test cases for the grid binning, the hub distances and the score of the
+    public transport analysis
+"""
+
+import numpy as np
+import pytest
+
+from urbo_api.urbo_api_fetchdata.transport_density import cell_centers, density_score, hub_counts, hub_distances, \
+    local_xy
+
+
+# ------------------------- TESTS -------------------------
+
+# Test: points north and east of the center get positive offsets in meters
+def test_local_xy():
+    xy = local_xy([28.6239, 28.6139], [77.2090, 77.2190], 28.6139, 77.2090)
+
+    assert xy[0, 0] == pytest.approx(0) and xy[0, 1] == pytest.approx(1113, abs=1)
+    assert xy[1, 0] > 900 and xy[1, 1] == pytest.approx(0)
+
+
+# Test: hubs fall in the cell containing them, row 0 is the north edge, hubs outside the square are left out
+def test_hub_counts():
+    counts = hub_counts([[-750, 750], [-600, 600], [750, -750], [5000, 0]], 4, 2000)
+
+    assert counts[0, 0] == 2 and counts[3, 3] == 1
+    assert counts.sum() == 3
+
+    y, x = cell_centers(4, 2000)
+    assert y[0, 0] == 750 and x[0, 0] == -750
+
+
+# Test: every cell gets the distance to its nearest hub, the density integrates to the number of hubs
+def test_hub_distances():
+    y, x = cell_centers(100, 10000)
+    cell_xy = np.column_stack((x.ravel(), y.ravel()))
+    nearest, density = hub_distances([[0, 0], [1000, 0]], cell_xy, bandwidth=300, chunk_cells=999)
+
+    assert nearest.min() == pytest.approx(np.hypot(50, 50))
+    assert nearest.max() == pytest.approx(np.hypot(4950, 4950), rel=0.2)
+    # cells of 0.01 km²
+    assert density.sum() * 0.01 == pytest.approx(2, rel=0.01)
+
+    nearest, density = hub_distances(np.empty((0, 2)), cell_xy, bandwidth=300)
+    assert np.isinf(nearest).all() and not density.any()
+
+
+# Test: full coverage and density give 100, density above the target counts as the target
+def test_density_score():
+    assert density_score(1, 8, 4) == 100
+    assert density_score(0.5, 2, 4, coverage_weight=0.5) == 50
+    assert density_score(0, 0, 4) == 0
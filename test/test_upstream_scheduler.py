@@ -0,0 +1,119 @@
+"""
+    test_upstream_scheduler contains test cases for the per provider rate limiter
+"""
+
+import threading
+import time
+
+import pytest
+from fastapi import HTTPException
+
+from urbo_api.urbo_api_dataload.upstream_scheduler import Priority, ProviderLimiter, provider_limits
+
+
+# ------------------------- TESTS -------------------------
+
+# Test: the burst is served at once, the next call waits for a new token
+def test_burst_then_rate():
+    limiter = ProviderLimiter("here", rate=10, burst=2)
+
+    start = time.monotonic()
+    limiter.acquire()
+    limiter.acquire()
+    assert time.monotonic() - start < 0.05
+
+    limiter.acquire()
+    assert time.monotonic() - start >= 0.08
+
+
+# Test: a caller which cannot get a token before its timeout gets 503 with Retry-After
+def test_timeout_raises_503():
+    limiter = ProviderLimiter("here", rate=0.5, burst=1)
+    limiter.acquire()
+
+    with pytest.raises(HTTPException) as exc:
+        limiter.acquire(timeout=0.1)
+
+    assert exc.value.status_code == 503
+    assert int(exc.value.headers["Retry-After"]) >= 1
+    assert limiter.budget()["queued"] == 0
+
+
+# Test: waiting interactive callers are served before batch and prefetch callers
+def test_priority_order():
+    limiter = ProviderLimiter("mapple", rate=20, burst=1)
+    limiter.acquire()
+    served = []
+
+    def call(priority):
+        limiter.acquire(priority, timeout=5)
+        served.append(priority)
+
+    threads = []
+    for priority in (Priority.PREFETCH, Priority.BATCH, Priority.INTERACTIVE):
+        thread = threading.Thread(target=call, args=(priority,))
+        thread.start()
+        threads.append(thread)
+        time.sleep(0.01)
+    for thread in threads:
+        thread.join()
+
+    assert served == [Priority.INTERACTIVE, Priority.BATCH, Priority.PREFETCH]
+
+
+# Test: the daily quota is enforced and reported in the budget
+def test_daily_quota():
+    limiter = ProviderLimiter("openweather", rate=100, burst=100, daily_quota=2)
+    limiter.acquire()
+    limiter.acquire()
+
+    budget = limiter.budget()
+    assert budget["used_today"] == 2
+    assert budget["remaining_today"] == 0
+
+    with pytest.raises(HTTPException) as exc:
+        limiter.acquire()
+    assert exc.value.status_code == 503
+
+
+# Test: a pause (upstream 429) holds back the next caller
+def test_pause():
+    limiter = ProviderLimiter("here", rate=100, burst=10)
+    limiter.pause(0.2)
+
+    start = time.monotonic()
+    limiter.acquire()
+    assert time.monotonic() - start >= 0.15
+
+
+# Test: callers already waiting when the quota gets used up do not get a token
+def test_daily_quota_checked_for_waiting_callers():
+    limiter = ProviderLimiter("openweather", rate=20, burst=1, daily_quota=2)
+    limiter.acquire()
+    results = []
+
+    def call():
+        try:
+            limiter.acquire(timeout=2)
+            results.append("served")
+        except HTTPException as exc:
+            results.append(exc.status_code)
+
+    threads = [threading.Thread(target=call) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(results, key=str) == [503, 503, "served"]
+    assert limiter.budget()["used_today"] == 2
+
+
+# Test: each worker gets its share of the limits
+def test_provider_limits_per_worker(monkeypatch):
+    monkeypatch.setenv("MAPPLE_RATE_LIMIT", "10")
+    monkeypatch.setenv("MAPPLE_BURST", "20")
+    monkeypatch.setenv("MAPPLE_DAILY_QUOTA", "1000")
+
+    assert provider_limits("mapple", workers=4) == {"rate": 2.5, "burst": 5, "daily_quota": 250}
+    assert provider_limits("mapple", workers=1) == {"rate": 10, "burst": 20, "daily_quota": 1000}
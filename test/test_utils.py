@@ -0,0 +1,92 @@
+"""
+    test_utils contains test cases for the cached Mapple token manager
+"""
+
+import threading
+import time
+from unittest.mock import MagicMock
+
+import pytest
+from fastapi import HTTPException
+
+from urbo_api.urbo_api_dataload.utils import MappleTokenManager
+
+
+# ------------------------- HELPERS -------------------------
+
+def token_client(expires_in=3600, delay=0.0):
+    """http client mock whose token endpoint returns token-1, token-2 ... on each call"""
+    http = MagicMock()
+    calls = []
+
+    def post(*args, **kwargs):
+        calls.append(1)
+        time.sleep(delay)
+        response = MagicMock()
+        response.status_code = 200
+        response.json.return_value = {'access_token': f'token-{len(calls)}', 'expires_in': expires_in}
+        return response
+
+    http.post.side_effect = post
+    return http
+
+
+# ------------------------- TESTS -------------------------
+
+# Test: token is reused until it expires
+def test_token_is_cached():
+    http = token_client()
+    manager = MappleTokenManager(refresh_margin=60)
+
+    assert manager.get_token(http) == 'token-1'
+    assert manager.get_token(http) == 'token-1'
+    assert http.post.call_count == 1
+
+
+# Test: token is refreshed once it is within the refresh margin
+def test_token_refreshed_before_expiry():
+    http = token_client(expires_in=30)
+    manager = MappleTokenManager(refresh_margin=60)
+
+    assert manager.get_token(http) == 'token-1'
+    assert manager.get_token(http) == 'token-2'
+
+
+# Test: concurrent requests share one refresh
+def test_concurrent_requests_share_one_refresh():
+    http = token_client(delay=0.1)
+    manager = MappleTokenManager()
+    tokens = []
+
+    threads = [threading.Thread(target=lambda: tokens.append(manager.get_token(http))) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert tokens == ['token-1'] * 10
+    assert http.post.call_count == 1
+
+
+# Test: a rejected token forces one refresh, an already replaced one does not
+def test_expired_token_forces_refresh():
+    http = token_client()
+    manager = MappleTokenManager()
+
+    rejected = manager.get_token(http)
+    assert manager.get_token(http, expired_token=rejected) == 'token-2'
+    assert manager.get_token(http, expired_token=rejected) == 'token-2'
+    assert http.post.call_count == 2
+
+
+# Test: a failing token endpoint makes the Mapple service unavailable (503), no token is cached
+def test_token_failure_is_unavailable():
+    http = MagicMock()
+    http.post.return_value.status_code = 500
+    manager = MappleTokenManager(refresh_margin=60)
+
+    with pytest.raises(HTTPException) as exc:
+        manager.get_token(http)
+
+    assert exc.value.status_code == 503
+    assert manager._token is None
@@ -0,0 +1,109 @@
+"""
+    test_write_behind contains test cases for the batched writes of the write-behind queue
+"""
+
+from types import SimpleNamespace
+
+from urbo_api.db_connect import write_behind
+from urbo_api.db_connect.write_behind import WriteBehindQueue, persist_rows
+from urbo_api.urbo_api_monitoring.metrics import WRITE_BEHIND_DROPPED_ROWS
+
+
+class Places:
+    __tablename__ = "places"
+
+
+class Geocodes:
+    __tablename__ = "geocodes"
+
+
+class FakeSession:
+    """
+    Keeps the rows of the open transaction apart from the committed ones
+    """
+
+    def __init__(self):
+        self.pending = []
+        self.committed = []
+
+    def commit(self):
+        self.committed.extend(self.pending)
+        self.pending = []
+
+    def rollback(self):
+        self.pending = []
+
+    def close(self):
+        pass
+
+
+def fake_insert(db, model, rows, conflict_columns=(), columns=None):
+    if any(values.get("bad") for values in rows):
+        raise ValueError("bad row")
+    db.pending.extend((model.__tablename__, values["name"]) for values in rows)
+
+
+# ------------------------- TESTS -------------------------
+
+# Test: a bad row only drops itself, the rest of its table and the other tables are written and the drop is counted
+def test_bad_row_in_batch(monkeypatch):
+    monkeypatch.setattr(write_behind, "execute_insert", fake_insert)
+    db = FakeSession()
+    queue = WriteBehindQueue(session_factory=lambda: db)
+    dropped_before = WRITE_BEHIND_DROPPED_ROWS._values.get(("places",), 0)
+
+    queue._flush([(Places, {"name": "park", "bad": False}, ()),
+                  (Places, {"name": "broken", "bad": True}, ()),
+                  (Places, {"name": "school", "bad": False}, ()),
+                  (Geocodes, {"name": "delhi"}, ())])
+
+    assert sorted(db.committed) == [("geocodes", "delhi"), ("places", "park"), ("places", "school")]
+    assert WRITE_BEHIND_DROPPED_ROWS._values[("places",)] - dropped_before == 1
+    assert ("geocodes",) not in WRITE_BEHIND_DROPPED_ROWS._values
+
+
+# Test: a full queue refuses the row after the put timeout, the caller then writes it itself
+def test_full_queue_backpressure(monkeypatch):
+    queue = WriteBehindQueue(session_factory=FakeSession, maxsize=1, put_timeout=0.01)
+    assert queue.submit(Places, {"name": "park"})
+    assert not queue.submit(Places, {"name": "school"})
+
+    monkeypatch.setattr(write_behind, "execute_insert", fake_insert)
+    monkeypatch.setattr(write_behind, "WRITE_BEHIND_ENABLED", True)
+    monkeypatch.setattr(write_behind, "write_behind_queue", SimpleNamespace(running=True, submit=queue.submit))
+    db = FakeSession()
+
+    persist_rows(db, Places, [{"name": "school"}])
+    assert db.committed == [("places", "school")]
+    assert queue.size == 1
+
+
+# Test: rows which must not be deferred are written now, even with the write-behind queue running
+def test_rows_not_deferred(monkeypatch):
+    submitted = []
+    monkeypatch.setattr(write_behind, "execute_insert", fake_insert)
+    monkeypatch.setattr(write_behind, "WRITE_BEHIND_ENABLED", True)
+    monkeypatch.setattr(write_behind, "write_behind_queue",
+                        SimpleNamespace(running=True, submit=lambda *args: submitted.append(args) or True))
+    db = FakeSession()
+
+    persist_rows(db, Places, [{"name": "park"}], defer=False)
+    assert db.committed == [("places", "park")] and submitted == []
+
+    persist_rows(db, Places, [{"name": "school"}])
+    assert db.committed == [("places", "park")] and len(submitted) == 1
+
+
+# Test: stop writes the rows still waiting for their batch before the worker ends
+def test_stop_drains_queue(monkeypatch):
+    monkeypatch.setattr(write_behind, "execute_insert", fake_insert)
+    db = FakeSession()
+    queue = WriteBehindQueue(session_factory=lambda: db, flush_interval=60)
+    queue.start()
+
+    for name in ("park", "school", "hospital"):
+        assert queue.submit(Places, {"name": name})
+    queue.stop()
+
+    assert not queue.running
+    assert sorted(db.committed) == [("places", "hospital"), ("places", "park"), ("places", "school")]
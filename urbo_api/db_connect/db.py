@@ -1,12 +1,21 @@
 """
 db.py helps connecting to database
+it provides the sync engine/session used by most endpoints and an async engine/session (asyncpg)
+for endpoints which should not hold a thread while waiting for the database
 """
 from dotenv import load_dotenv
 from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm import declarative_base
 import os
 
+try:
+    from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+except ImportError:
+    # async support is optional, it needs greenlet (and asyncpg to connect)
+    AsyncSession = async_sessionmaker = create_async_engine = None
+
 load_dotenv()
 
 db_url = os.getenv("DATABASE_URL")
@@ -14,9 +23,30 @@ db_url = os.getenv("DATABASE_URL")
 # Construct connection string
 SQLALCHEMY_DATABASE_URL = db_url
 
+# Connection pool settings, shared by the sync and the async engine (each one has its own pool)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+# statement_timeout of every connection in milliseconds, 0 means no timeout
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "0"))
+
+pool_options = {
+    "pool_size": DB_POOL_SIZE,
+    "max_overflow": DB_MAX_OVERFLOW,
+    "pool_timeout": DB_POOL_TIMEOUT,
+    "pool_recycle": DB_POOL_RECYCLE,
+    "pool_pre_ping": DB_POOL_PRE_PING
+}
+
+connect_args = {}
+if DB_STATEMENT_TIMEOUT_MS:
+    connect_args["options"] = f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"
+
 
 # Create SQLAlchemy engine
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
+engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args=connect_args, **pool_options)
 
 # Create a session local class for handling database sessions
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
@@ -31,3 +61,59 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+# The async engine is created on first use, so the app still starts when asyncpg is not installed
+async_engine = None
+AsyncSessionLocal = None
+
+
+def get_async_engine():
+    """
+    Creates the async engine (asyncpg driver) on first call
+    :return: async engine
+    """
+    global async_engine, AsyncSessionLocal
+
+    if create_async_engine is None:
+        raise RuntimeError("Async DB access needs 'sqlalchemy[asyncio]' and 'asyncpg' installed")
+
+    if async_engine is None:
+        url = make_url(SQLALCHEMY_DATABASE_URL)
+        async_connect_args = {}
+
+        # asyncpg does not understand libpq sslmode, it takes ssl instead
+        if "sslmode" in url.query:
+            async_connect_args["ssl"] = url.query["sslmode"]
+            url = url.difference_update_query(["sslmode"])
+
+        if DB_STATEMENT_TIMEOUT_MS:
+            async_connect_args["server_settings"] = {"statement_timeout": str(DB_STATEMENT_TIMEOUT_MS)}
+
+        async_engine = create_async_engine(url.set(drivername="postgresql+asyncpg"),
+                                           connect_args=async_connect_args, **pool_options)
+        AsyncSessionLocal = async_sessionmaker(bind=async_engine, class_=AsyncSession, autoflush=False,
+                                               expire_on_commit=False)
+
+    return async_engine
+
+
+def async_session():
+    """
+    :return: new async session, to be used as async context manager
+    """
+    get_async_engine()
+    return AsyncSessionLocal()
+
+
+async def get_async_db():
+    async with async_session() as db:
+        yield db
+
+
+async def dispose_async_engine():
+    """
+    Closes the connections of the async pool, used on app shutdown
+    """
+    if async_engine is not None:
+        await async_engine.dispose()
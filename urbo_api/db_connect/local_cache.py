@@ -0,0 +1,326 @@
+"""
+ local_cache.py contains the two level cache in front of the DB lookups of the hottest data
+ level 1 is an LRU dict in the process, level 2 is a SQLite file (WAL mode) shared by all the uvicorn workers
+ of the host, so a value loaded by one worker is served by the others without a Postgres round trip
+ both levels evict by TTL and by size, a failing level 2 only makes lookups miss, it never fails a request
+ the shared file also holds leases, so work which must run once per host (e.g. cache warming) runs in one worker,
+ and the state of that work, so every worker can report it and the next lease holder carries on from it
+"""
+import json
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from dotenv import load_dotenv
+
+from urbo_api.urbo_api_monitoring.metrics import local_cache_lookup
+
+# load environment variable
+load_dotenv()
+LOCAL_CACHE_ENABLED = os.getenv("LOCAL_CACHE_ENABLED", "true").lower() == "true"
+# bytes kept in the memory of each worker
+LOCAL_CACHE_MEMORY_BYTES = int(os.getenv("LOCAL_CACHE_MEMORY_BYTES", str(64 * 1024 * 1024)))
+# shared file, empty to keep only the in-process level
+LOCAL_CACHE_PATH = os.getenv("LOCAL_CACHE_PATH", "cache/urbo_cache.sqlite3")
+LOCAL_CACHE_FILE_BYTES = int(os.getenv("LOCAL_CACHE_FILE_BYTES", str(512 * 1024 * 1024)))
+# the shared file is trimmed to its size every this many writes
+LOCAL_CACHE_TRIM_EVERY = int(os.getenv("LOCAL_CACHE_TRIM_EVERY", "200"))
+
+logger = logging.getLogger(__name__)
+
+MEMORY = "memory"
+SHARED = "shared"
+MISS = "miss"
+
+
+class MemoryCache:
+    """
+    Thread safe LRU of serialized values with an expiry time, bounded by the total size of the values
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        """
+        :param key: cache key
+        :return: (serialized value, expiry time) or None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= time.time():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key: str, data: bytes, expires_at: float):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            if len(data) > self.max_bytes:
+                return
+            self._entries[key] = (data, expires_at)
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def delete(self, key: str):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def _remove(self, key: str):
+        data, _ = self._entries.pop(key)
+        self.size -= len(data)
+
+
+class SharedCache:
+    """
+    SQLite file shared by the worker processes, one connection per thread
+    the least recently read entries are deleted when the file holds more than max_bytes of values
+    """
+
+    def __init__(self, path: str, max_bytes: int, trim_every: int = LOCAL_CACHE_TRIM_EVERY):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.trim_every = trim_every
+        self._local = threading.local()
+        self._writes = 0
+        self._writes_lock = threading.Lock()
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # autocommit, every statement is its own short transaction
+            connection = sqlite3.connect(self.path, timeout=1, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS cache_entries (key TEXT PRIMARY KEY, value BLOB NOT NULL, "
+                               "size INTEGER NOT NULL, expires_at REAL NOT NULL, accessed_at REAL NOT NULL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS idx_cache_entries_accessed_at "
+                               "ON cache_entries (accessed_at)")
+            connection.execute("CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT NOT NULL, "
+                               "expires_at REAL NOT NULL)")
+            connection.execute("CREATE TABLE IF NOT EXISTS states (name TEXT PRIMARY KEY, value BLOB NOT NULL, "
+                               "updated_at REAL NOT NULL)")
+            self._local.connection = connection
+        return connection
+
+    def get(self, key: str):
+        """
+        :param key: cache key
+        :return: (serialized value, expiry time) or None
+        """
+        now = time.time()
+        connection = self._connection()
+        row = connection.execute("SELECT value, expires_at FROM cache_entries WHERE key = ? AND expires_at > ?",
+                                 (key, now)).fetchone()
+        if row is not None:
+            connection.execute("UPDATE cache_entries SET accessed_at = ? WHERE key = ?", (now, key))
+        return row
+
+    def set(self, key: str, data: bytes, expires_at: float):
+        self._connection().execute(
+            "INSERT OR REPLACE INTO cache_entries (key, value, size, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+            (key, data, len(data), expires_at, time.time()))
+
+        with self._writes_lock:
+            self._writes += 1
+            trim = self._writes % self.trim_every == 0
+        if trim:
+            self.trim()
+
+    def delete(self, key: str):
+        self._connection().execute("DELETE FROM cache_entries WHERE key = ?", (key,))
+
+    def acquire_lease(self, name: str, owner: str, ttl: float) -> bool:
+        """
+        Takes or renews the lease, it is only taken when it expired or already belongs to the owner
+        :param name: lease name, e.g. cache_warmer
+        :param owner: id of the worker asking for it
+        :param ttl: seconds the lease is held unless it is renewed
+        :return: True when the owner holds the lease
+        """
+        now = time.time()
+        connection = self._connection()
+        connection.execute(
+            "INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?) ON CONFLICT (name) DO UPDATE SET "
+            "owner = excluded.owner, expires_at = excluded.expires_at "
+            "WHERE leases.owner = excluded.owner OR leases.expires_at <= ?", (name, owner, now + ttl, now))
+        row = connection.execute("SELECT owner FROM leases WHERE name = ?", (name,)).fetchone()
+        return row is not None and row[0] == owner
+
+    def release_lease(self, name: str, owner: str):
+        self._connection().execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
+
+    def load_state(self, name: str):
+        """
+        :param name: state name, e.g. cache_warmer
+        :return: serialized state, None when it was never saved
+        """
+        row = self._connection().execute("SELECT value FROM states WHERE name = ?", (name,)).fetchone()
+        return None if row is None else row[0]
+
+    def save_state(self, name: str, data: bytes):
+        # states are not cache entries, they never expire and are not trimmed
+        self._connection().execute("INSERT OR REPLACE INTO states (name, value, updated_at) VALUES (?, ?, ?)",
+                                   (name, data, time.time()))
+
+    def trim(self):
+        """
+        Deletes the expired entries, then the least recently read ones until the values fit in max_bytes
+        """
+        connection = self._connection()
+        connection.execute("DELETE FROM cache_entries WHERE expires_at <= ?", (time.time(),))
+        connection.execute(
+            "DELETE FROM cache_entries WHERE key IN (SELECT key FROM (SELECT key, SUM(size) OVER "
+            "(ORDER BY accessed_at DESC, key) AS kept FROM cache_entries) WHERE kept > ?)", (self.max_bytes,))
+
+
+class TwoLevelCache:
+    """
+    Memory level in front of the shared level, a value found in the shared level is copied to the memory level
+    values are pickled, so any value the loaders return (dicts, bytes, datetimes, pydantic models) can be cached
+    and a caller never gets an object another caller may change
+    """
+
+    def __init__(self, memory: MemoryCache, shared=None, enabled: bool = True):
+        self.memory = memory
+        self.shared = shared
+        self.enabled = enabled
+
+    def get(self, namespace: str, key):
+        """
+        :param namespace: kind of data, e.g. geocode
+        :param key: json serializable key of the value in the namespace
+        :return: value, None on a miss
+        """
+        if not self.enabled:
+            return None
+        cache_key = make_key(namespace, key)
+
+        entry = self.memory.get(cache_key)
+        if entry is not None:
+            local_cache_lookup(namespace, MEMORY)
+            return pickle.loads(entry[0])
+
+        if self.shared is not None:
+            try:
+                entry = self.shared.get(cache_key)
+            except sqlite3.Error:
+                logger.warning("Shared cache read failed", exc_info=True)
+                entry = None
+            if entry is not None:
+                self.memory.set(cache_key, entry[0], entry[1])
+                local_cache_lookup(namespace, SHARED)
+                return pickle.loads(entry[0])
+
+        local_cache_lookup(namespace, MISS)
+        return None
+
+    def set(self, namespace: str, key, value, ttl: float):
+        """
+        :param namespace: kind of data, e.g. geocode
+        :param key: json serializable key of the value in the namespace
+        :param value: value, None is not cached
+        :param ttl: seconds the value may be served
+        """
+        if not self.enabled or value is None or ttl <= 0:
+            return
+        cache_key = make_key(namespace, key)
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        expires_at = time.time() + ttl
+
+        self.memory.set(cache_key, data, expires_at)
+        if self.shared is not None:
+            try:
+                self.shared.set(cache_key, data, expires_at)
+            except sqlite3.Error:
+                logger.warning("Shared cache write failed", exc_info=True)
+
+    def delete(self, namespace: str, key):
+        cache_key = make_key(namespace, key)
+        self.memory.delete(cache_key)
+        if self.shared is not None:
+            try:
+                self.shared.delete(cache_key)
+            except sqlite3.Error:
+                logger.warning("Shared cache delete failed", exc_info=True)
+
+    def acquire_lease(self, name: str, owner: str, ttl: float) -> bool:
+        """
+        :param name: lease name
+        :param owner: id of the worker asking for it
+        :param ttl: seconds the lease is held unless it is renewed
+        :return: True when the owner holds the lease, always True without the shared level (single process),
+                 False when the shared file can not be used
+        """
+        if self.shared is None:
+            return True
+        try:
+            return self.shared.acquire_lease(name, owner, ttl)
+        except sqlite3.Error:
+            logger.warning("Shared cache lease failed", exc_info=True)
+            return False
+
+    def release_lease(self, name: str, owner: str):
+        if self.shared is None:
+            return
+        try:
+            self.shared.release_lease(name, owner)
+        except sqlite3.Error:
+            logger.warning("Shared cache lease release failed", exc_info=True)
+
+    def load_state(self, name: str):
+        """
+        Reads a state shared by the workers, it is never kept in the memory level so every read is current
+        :param name: state name
+        :return: state, None when there is no shared level, it was never saved or the shared file can not be used
+        """
+        if self.shared is None:
+            return None
+        try:
+            data = self.shared.load_state(name)
+        except sqlite3.Error:
+            logger.warning("Shared cache state read failed", exc_info=True)
+            return None
+        return None if data is None else pickle.loads(data)
+
+    def save_state(self, name: str, value):
+        """
+        :param name: state name
+        :param value: picklable state
+        """
+        if self.shared is None:
+            return
+        try:
+            self.shared.save_state(name, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+        except sqlite3.Error:
+            logger.warning("Shared cache state write failed", exc_info=True)
+
+
+def make_key(namespace: str, key) -> str:
+    """
+    :param namespace: kind of data
+    :param key: json serializable key, tuples and lists give the same key
+    :return: key of the entry in both levels
+    """
+    return f"{namespace}:{json.dumps(key, separators=(',', ':'), default=str)}"
+
+
+local_cache = TwoLevelCache(MemoryCache(LOCAL_CACHE_MEMORY_BYTES),
+                            SharedCache(LOCAL_CACHE_PATH, LOCAL_CACHE_FILE_BYTES) if LOCAL_CACHE_PATH else None,
+                            enabled=LOCAL_CACHE_ENABLED)
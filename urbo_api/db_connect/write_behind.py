@@ -0,0 +1,251 @@
+"""
+write_behind.py helps persisting the upstream results without making the request wait for the DB commit
+when enabled, the rows are put on a bounded in-process queue and a background worker writes them
+in batched multi-row inserts
+every table of a batch is committed on its own, when its insert fails the rows are written one by one,
+so a bad row only drops itself and is counted in urbo_write_behind_dropped_rows_total
+"""
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+from dotenv import load_dotenv
+from sqlalchemy import inspect
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from urbo_api.db_connect.db import SessionLocal
+from urbo_api.urbo_api_monitoring.metrics import write_behind_dropped
+
+load_dotenv()
+
+WRITE_BEHIND_ENABLED = os.getenv("WRITE_BEHIND_ENABLED", "false").lower() == "true"
+# rows waiting to be written, when the queue is full requests wait up to WRITE_BEHIND_PUT_TIMEOUT seconds
+# and then write their rows themselves
+WRITE_BEHIND_QUEUE_SIZE = int(os.getenv("WRITE_BEHIND_QUEUE_SIZE", "10000"))
+WRITE_BEHIND_PUT_TIMEOUT = float(os.getenv("WRITE_BEHIND_PUT_TIMEOUT", "1"))
+# rows written by one multi-row insert, and longest time a row waits for its batch
+WRITE_BEHIND_BATCH_SIZE = int(os.getenv("WRITE_BEHIND_BATCH_SIZE", "500"))
+WRITE_BEHIND_FLUSH_INTERVAL = float(os.getenv("WRITE_BEHIND_FLUSH_INTERVAL", "0.5"))
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class WriteBehindQueue:
+    """
+    Bounded queue of rows and the background thread which writes them to DB
+    """
+
+    def __init__(self, session_factory=SessionLocal, maxsize: int = WRITE_BEHIND_QUEUE_SIZE,
+                 batch_size: int = WRITE_BEHIND_BATCH_SIZE, flush_interval: float = WRITE_BEHIND_FLUSH_INTERVAL,
+                 put_timeout: float = WRITE_BEHIND_PUT_TIMEOUT):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._thread = None
+
+    @property
+    def size(self):
+        """
+        :return: rows waiting to be written
+        """
+        return self._queue.qsize()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Writes all the queued rows and stops the worker, used on app shutdown
+        """
+        if not self.running:
+            return
+        self._queue.put(_STOP)
+        self._thread.join()
+        self._thread = None
+
+    def submit(self, model, values: dict, conflict_columns=None) -> bool:
+        """
+        :param model: model class of the table
+        :param values: column values of the row
+        :param conflict_columns: unique columns, when given the row is upserted
+        :return: False when the queue stayed full, the caller then writes the row itself
+        """
+        try:
+            self._queue.put((model, values, tuple(conflict_columns or ())), timeout=self.put_timeout)
+            return True
+        except queue.Full:
+            return False
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = []
+            deadline = None
+
+            while len(batch) < self.batch_size:
+                timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+
+                if item is _STOP:
+                    stopping = True
+                    break
+
+                batch.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+
+            if stopping:
+                # drain what is left before leaving
+                while True:
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is not _STOP:
+                        batch.append(item)
+
+            if batch:
+                self._flush(batch)
+
+    def _flush(self, batch):
+        # one multi-row insert per table and set of columns
+        groups = defaultdict(dict)
+        for model, values, conflict_columns in batch:
+            key = (model, tuple(sorted(values)), conflict_columns)
+            row_key = tuple(values[column] for column in conflict_columns) if conflict_columns else len(groups[key])
+            # an upsert cannot touch the same row twice in one statement, the latest values win
+            groups[key][row_key] = values
+
+        db = self.session_factory()
+        try:
+            for (model, columns, conflict_columns), rows in groups.items():
+                self._write_group(db, model, list(rows.values()), conflict_columns, columns)
+        finally:
+            db.close()
+
+    def _write_group(self, db: Session, model, rows, conflict_columns, columns):
+        """
+        Writes the rows of one table in their own transaction, when that fails each row is retried alone
+        and only the rows which still fail are dropped
+        :param db: DB connection session
+        :param model: model class of the table
+        :param rows: list of column values
+        :param conflict_columns: unique columns, when given the rows are upserted
+        :param columns: columns present in the rows
+        """
+        table = model.__tablename__
+        try:
+            execute_insert(db, model, rows, conflict_columns, columns)
+            db.commit()
+            return
+        except Exception:
+            db.rollback()
+            if len(rows) == 1:
+                logger.exception("Write-behind dropped a row of %s", table)
+                write_behind_dropped(table, 1)
+                return
+            logger.warning("Write-behind insert of %d rows into %s failed, retrying row by row", len(rows), table,
+                           exc_info=True)
+
+        dropped = 0
+        for values in rows:
+            try:
+                execute_insert(db, model, [values], conflict_columns, columns)
+                db.commit()
+            except Exception:
+                db.rollback()
+                dropped += 1
+                logger.exception("Write-behind dropped a row of %s", table)
+        if dropped:
+            write_behind_dropped(table, dropped)
+
+
+def execute_insert(db: Session, model, rows, conflict_columns=(), columns=None):
+    """
+    Multi-row insert, or upsert on the conflict columns
+    :param db: DB connection session
+    :param model: model class of the table
+    :param rows: list of column values
+    :param conflict_columns: unique columns, when given existing rows are updated
+    :param columns: columns present in the rows
+    """
+    statement = insert(model).values(rows)
+    if conflict_columns:
+        columns = columns or rows[0].keys()
+        statement = statement.on_conflict_do_update(
+            index_elements=list(conflict_columns),
+            set_={column: statement.excluded[column] for column in columns
+                  if column not in conflict_columns and column != "id"}
+        )
+    db.execute(statement)
+
+
+write_behind_queue = WriteBehindQueue()
+
+
+def record_values(record) -> dict:
+    """
+    :param record: model instance
+    :return: its column values, the ones left unset get their DB default
+    """
+    values = {}
+    for column in inspect(record).mapper.column_attrs:
+        value = getattr(record, column.key)
+        if value is not None:
+            values[column.key] = value
+    return values
+
+
+def persist(db: Session, *records):
+    """
+    Writes the records now, or hands them to the write-behind queue when it is enabled and running
+    the ids are set here, so the caller can use them in either case
+    :param db: DB connection session
+    :param records: model instances
+    """
+    for record in records:
+        if record.id is None:
+            record.id = uuid.uuid4()
+
+    if WRITE_BEHIND_ENABLED and write_behind_queue.running:
+        records = [record for record in records
+                   if not write_behind_queue.submit(type(record), record_values(record))]
+        if not records:
+            return
+
+    db.add_all(records)
+    db.commit()
+
+
+def persist_rows(db: Session, model, rows, conflict_columns=(), defer: bool = True):
+    """
+    Inserts (or upserts on the conflict columns) the rows now, or hands them to the write-behind queue
+    :param db: DB connection session
+    :param model: model class of the table
+    :param rows: list of column values
+    :param conflict_columns: unique columns, when given existing rows are updated
+    :param defer: False writes the rows now even when write-behind is enabled, for rows other writes rely on
+    """
+    if defer and WRITE_BEHIND_ENABLED and write_behind_queue.running:
+        rows = [values for values in rows if not write_behind_queue.submit(model, values, conflict_columns)]
+
+    if rows:
+        execute_insert(db, model, rows, conflict_columns)
+        db.commit()
@@ -1,12 +1,16 @@
 import os
 
 from dotenv import load_dotenv
-from fastapi import APIRouter, Depends, HTTPException
-import requests
+from fastapi import APIRouter, Depends
 from geoalchemy2 import WKTElement
 from sqlalchemy.orm import Session
 from urbo_api.db_connect.db import get_db
+from urbo_api.db_connect.write_behind import persist
 from urbo_api.urbo_api_dataload import models, schema
+from urbo_api.urbo_api_dataload.air_quality_history_api import store_readings
+from urbo_api.urbo_api_dataload.http_client import UpstreamClient, get_http_client, upstream_error
+from urbo_api.urbo_api_dataload.upstream_scheduler import OPENWEATHER
+from urbo_api.urbo_api_monitoring.tracing import traced
 
 #load environment variable
 load_dotenv()
@@ -20,12 +24,15 @@ router = APIRouter(
 
 
 @router.get("/fetch-air-pollution-data/", response_model=schema.AirPollutionResponse)
-def get_air_pollution(latitude: float, longitude: float, db: Session = Depends(get_db)):
+@traced("get_air_pollution")
+def get_air_pollution(latitude: float, longitude: float, db: Session = Depends(get_db),
+                      http: UpstreamClient = Depends(get_http_client)):
     """
 
     :param latitude: user input latitude
     :param longitude: user input longitude
     :param db:DB connection session
+    :param http: shared upstream http client
     :return: returns the coordinate(lon, lat) and the air pollution data of that specific coordinates
     """
     params = {
@@ -34,7 +41,7 @@ def get_air_pollution(latitude: float, longitude: float, db: Session = Depends(g
         'appid': api_key
     }
 
-    response = requests.get(base_url, params=params)
+    response = http.get(base_url, provider=OPENWEATHER, params=params)
 
     if response.status_code == 200:
         data = response.json()
@@ -47,9 +54,8 @@ def get_air_pollution(latitude: float, longitude: float, db: Session = Depends(g
             air_pollution_response=data['list']
         )
 
-        db.add(pollution_record)
-        db.commit()
-        db.refresh(pollution_record)
+        persist(db, pollution_record)
+        store_readings(db, lon, lat, data['list'])
 
         # response_model = schema.AirPollutionResponse(
         #     center_coordinates={"lon": lon, "lat": lat},
@@ -66,4 +72,4 @@ def get_air_pollution(latitude: float, longitude: float, db: Session = Depends(g
         }
 
     else:
-        raise HTTPException(status_code=response.status_code, detail="Error in fetching air polluting data")
+        raise upstream_error(response.status_code, "Error in fetching air polluting data")
@@ -0,0 +1,203 @@
+"""
+ air_quality_history_api.py contains the air quality history store and the endpoint aggregating it
+ every OpenWeather air pollution response is also stored as typed rows (one per location, time and component)
+ in air_quality_readings, a table partitioned by month, so trends are read with one indexed query
+ instead of parsing the stored JSON responses
+"""
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+
+from dotenv import load_dotenv
+from fastapi import APIRouter, Depends, HTTPException, Query
+from sqlalchemy import func, literal_column, select, text
+from sqlalchemy.orm import Session
+
+from urbo_api.db_connect.db import AsyncSession, get_async_db
+from urbo_api.db_connect.write_behind import persist_rows
+from urbo_api.urbo_api_dataload import models, schema
+from urbo_api.urbo_api_dataload.spatial import within_distance
+
+# load environment variable
+load_dotenv()
+# longest time range (days) one history request may aggregate
+AIR_QUALITY_HISTORY_MAX_DAYS = int(os.getenv("AIR_QUALITY_HISTORY_MAX_DAYS", "366"))
+# readings within this distance (meters) of the requested location are aggregated together,
+# OpenWeather answers for an area, not an exact point
+AIR_QUALITY_HISTORY_RADIUS = float(os.getenv("AIR_QUALITY_HISTORY_RADIUS", "2000"))
+
+# components are stored as small integers, aqi is the index of main, the others are in components
+COMPONENT_CODES = {"aqi": 0, "co": 1, "no": 2, "no2": 3, "o3": 4, "so2": 5, "pm2_5": 6, "pm10": 7, "nh3": 8}
+COMPONENT_NAMES = {code: name for name, code in COMPONENT_CODES.items()}
+INTERVALS = ("hour", "day", "week")
+
+_created_partitions = set()
+_partitions_lock = threading.Lock()
+
+
+def month_start(moment: datetime) -> datetime:
+    """
+    :param moment: any time, naive values are taken as UTC
+    :return: first instant (UTC) of its month
+    """
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    moment = moment.astimezone(timezone.utc)
+    return datetime(moment.year, moment.month, 1, tzinfo=timezone.utc)
+
+
+def next_month(month: datetime) -> datetime:
+    """
+    :param month: first instant of a month
+    :return: first instant of the following month
+    """
+    return datetime(month.year + month.month // 12, month.month % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+def partition_name(month: datetime) -> str:
+    """
+    :param month: first instant of a month
+    :return: name of the partition holding the readings of that month
+    """
+    return f"{models.AirQualityReading.__tablename__}_y{month.year:04d}m{month.month:02d}"
+
+
+def partition_ddl(month: datetime) -> str:
+    """
+    :param month: first instant of a month
+    :return: statement creating the partition of that month when it is missing
+    """
+    return (f"CREATE TABLE IF NOT EXISTS {partition_name(month)} PARTITION OF "
+            f"{models.AirQualityReading.__tablename__} "
+            f"FOR VALUES FROM ('{month.isoformat()}') TO ('{next_month(month).isoformat()}')")
+
+
+def ensure_partitions(bind, moments):
+    """
+    Creates the monthly partitions the given times fall in, the ones created by this process are remembered
+    :param bind: DB engine
+    :param moments: times which are about to be stored
+    """
+    months = {month_start(moment) for moment in moments} - _created_partitions
+    if not months:
+        return
+
+    with _partitions_lock:
+        months -= _created_partitions
+        if not months:
+            return
+        with bind.begin() as connection:
+            for month in sorted(months):
+                connection.execute(text(partition_ddl(month)))
+        _created_partitions.update(months)
+
+
+def reading_rows(lon: float, lat: float, air_pollution_list: list) -> list:
+    """
+    :param lon: longitude returned by OpenWeather
+    :param lat: latitude returned by OpenWeather
+    :param air_pollution_list: list of the OpenWeather air pollution response
+    :return: one row of air_quality_readings per entry and component
+    """
+    # EWKT text rather than a WKTElement, equal locations then compare equal when the write-behind queue
+    # merges the rows of one flush
+    location = f"SRID=4326;POINT({lon} {lat})"
+    rows = []
+    for entry in air_pollution_list:
+        measured_at = datetime.fromtimestamp(entry["dt"], timezone.utc)
+        values = {"aqi": entry.get("main", {}).get("aqi"), **entry.get("components", {})}
+        for name, value in values.items():
+            if name in COMPONENT_CODES and value is not None:
+                rows.append({"location": location, "measured_at": measured_at,
+                             "component": COMPONENT_CODES[name], "value": float(value)})
+    return rows
+
+
+def store_readings(db: Session, lon: float, lat: float, air_pollution_list: list):
+    """
+    Stores the air pollution response as readings, a reading already stored is updated
+    :param db: DB connection session
+    :param lon: longitude returned by OpenWeather
+    :param lat: latitude returned by OpenWeather
+    :param air_pollution_list: list of the OpenWeather air pollution response
+    """
+    rows = reading_rows(lon, lat, air_pollution_list)
+    if not rows:
+        return
+    ensure_partitions(db.get_bind(), {row["measured_at"] for row in rows})
+    persist_rows(db, models.AirQualityReading, rows, conflict_columns=("location", "measured_at", "component"))
+
+
+router = APIRouter(
+    tags=["air-pollution"],
+    responses={404: {"description": "Not Found"}}
+)
+
+
+@router.get("/air-quality/history", response_model=schema.AirQualityHistoryResponse)
+async def get_air_quality_history(latitude: float, longitude: float, start: Optional[datetime] = None,
+                                  end: Optional[datetime] = None, interval: str = "hour",
+                                  components: Optional[List[str]] = Query(None),
+                                  radius: float = AIR_QUALITY_HISTORY_RADIUS,
+                                  db: AsyncSession = Depends(get_async_db)):
+    """
+    Aggregates the stored air quality readings around a location per hour, day or week
+    :param latitude: latitude
+    :param longitude: longitude
+    :param start: start of the time range, default 7 days before end
+    :param end: end of the time range (excluded), default now
+    :param interval: hour, day or week
+    :param components: components to aggregate (aqi, co, no, no2, o3, so2, pm2_5, pm10, nh3), default all
+    :param radius: readings within this distance (meters) are used
+    :param db: async DB connection session
+    :return: mean, min, max, percentiles and count of each component per time bucket
+    """
+    if interval not in INTERVALS:
+        raise HTTPException(status_code=400, detail=f"interval must be one of {', '.join(INTERVALS)}")
+
+    unknown = [name for name in components or () if name not in COMPONENT_CODES]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown components: {', '.join(unknown)}")
+
+    end = end or datetime.now(timezone.utc)
+    start = start or end - timedelta(days=7)
+    end, start = (moment if moment.tzinfo else moment.replace(tzinfo=timezone.utc) for moment in (end, start))
+    if start >= end:
+        raise HTTPException(status_code=400, detail="start must be before end")
+    if end - start > timedelta(days=AIR_QUALITY_HISTORY_MAX_DAYS):
+        raise HTTPException(status_code=400,
+                            detail=f"Time range is limited to {AIR_QUALITY_HISTORY_MAX_DAYS} days")
+
+    reading = models.AirQualityReading
+    # the interval is inlined (it is one of INTERVALS), a bound parameter would make the GROUP BY expression
+    # differ from the selected one
+    bucket = func.date_trunc(literal_column(f"'{interval}'"), reading.measured_at).label("bucket")
+    query = (select(bucket, reading.component,
+                    func.avg(reading.value), func.min(reading.value), func.max(reading.value),
+                    func.percentile_cont(0.5).within_group(reading.value),
+                    func.percentile_cont(0.9).within_group(reading.value),
+                    func.percentile_cont(0.95).within_group(reading.value),
+                    func.count())
+             # the time range prunes the partitions, the location uses the GiST index
+             .where(reading.measured_at >= start, reading.measured_at < end,
+                    within_distance(reading.location, longitude, latitude, radius))
+             .group_by(bucket, reading.component)
+             .order_by(bucket, reading.component))
+    if components:
+        query = query.where(reading.component.in_([COMPONENT_CODES[name] for name in components]))
+
+    buckets = {}
+    for row in (await db.execute(query)).all():
+        bucket_start, code, mean, minimum, maximum, p50, p90, p95, count = row
+        buckets.setdefault(bucket_start, {})[COMPONENT_NAMES[code]] = {
+            "mean": mean, "min": minimum, "max": maximum, "p50": p50, "p90": p90, "p95": p95, "count": count
+        }
+
+    return {
+        "center_coordinates": {"lon": longitude, "lat": latitude},
+        "start": start,
+        "end": end,
+        "interval": interval,
+        "buckets": [{"bucket": bucket_start, "components": values} for bucket_start, values in buckets.items()]
+    }
@@ -0,0 +1,135 @@
+"""
+ circuit_breaker.py contains the circuit breaker kept for each 3rd party api service (HERE, Mapple, OpenWeather)
+ once too many of the recent calls failed or were slow the circuit opens and calls fail fast for a while,
+ then one trial call decides if the circuit closes again
+"""
+import os
+import threading
+import time
+from collections import deque
+
+from dotenv import load_dotenv
+from fastapi import HTTPException
+
+# load environment variable
+load_dotenv()
+# number of recent calls looked at, and calls needed before the circuit may open
+CIRCUIT_BREAKER_WINDOW = int(os.getenv("CIRCUIT_BREAKER_WINDOW", "20"))
+CIRCUIT_BREAKER_MIN_CALLS = int(os.getenv("CIRCUIT_BREAKER_MIN_CALLS", "5"))
+# share of failed calls (connection error, timeout, 5xx) which opens the circuit
+CIRCUIT_BREAKER_FAILURE_RATE = float(os.getenv("CIRCUIT_BREAKER_FAILURE_RATE", "0.5"))
+# a call slower than SLOW_CALL_SECONDS is slow, the share of slow calls which opens the circuit
+CIRCUIT_BREAKER_SLOW_CALL_SECONDS = float(os.getenv("CIRCUIT_BREAKER_SLOW_CALL_SECONDS", "5"))
+CIRCUIT_BREAKER_SLOW_CALL_RATE = float(os.getenv("CIRCUIT_BREAKER_SLOW_CALL_RATE", "0.8"))
+# seconds the circuit stays open before a trial call is let through
+CIRCUIT_BREAKER_OPEN_SECONDS = float(os.getenv("CIRCUIT_BREAKER_OPEN_SECONDS", "30"))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(HTTPException):
+    """
+    Raised instead of calling a provider whose circuit is open
+    """
+
+    def __init__(self, provider: str, retry_after: float):
+        super().__init__(status_code=503, detail=f"Upstream {provider} unavailable, try again later",
+                         headers={"Retry-After": str(max(1, round(retry_after)))})
+
+
+class CircuitBreaker:
+    """
+    Failure and latency based circuit breaker of one provider
+    """
+
+    def __init__(self, name: str, window_size: int = CIRCUIT_BREAKER_WINDOW,
+                 min_calls: int = CIRCUIT_BREAKER_MIN_CALLS, failure_rate: float = CIRCUIT_BREAKER_FAILURE_RATE,
+                 slow_call_seconds: float = CIRCUIT_BREAKER_SLOW_CALL_SECONDS,
+                 slow_call_rate: float = CIRCUIT_BREAKER_SLOW_CALL_RATE,
+                 open_seconds: float = CIRCUIT_BREAKER_OPEN_SECONDS):
+        """
+        :param name: provider name
+        :param window_size: number of recent calls looked at
+        :param min_calls: calls needed in the window before the circuit may open
+        :param failure_rate: share of failed calls which opens the circuit
+        :param slow_call_seconds: duration from which a call is slow
+        :param slow_call_rate: share of slow calls which opens the circuit
+        :param open_seconds: seconds the circuit stays open before a trial call
+        """
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate = slow_call_rate
+        self.open_seconds = open_seconds
+
+        self.state = CLOSED
+        self._lock = threading.Lock()
+        self._calls = deque(maxlen=window_size)
+        self._opened_at = 0.0
+        self._trial_running = False
+
+    def before_call(self):
+        """
+        Lets the call through or raises CircuitOpenError, in half open state only one trial call goes through
+        """
+        with self._lock:
+            if self.state == OPEN:
+                remaining = self._opened_at + self.open_seconds - time.monotonic()
+                if remaining > 0:
+                    raise CircuitOpenError(self.name, remaining)
+                self.state = HALF_OPEN
+                self._trial_running = False
+
+            if self.state == HALF_OPEN:
+                if self._trial_running:
+                    raise CircuitOpenError(self.name, 1)
+                self._trial_running = True
+
+    def release(self):
+        """
+        The call let through was not made after all (e.g. no rate limit token), another trial may go
+        """
+        with self._lock:
+            self._trial_running = False
+
+    def record(self, failed: bool, duration: float):
+        """
+        :param failed: True on connection error, timeout or 5xx response
+        :param duration: seconds the call took
+        """
+        slow = duration >= self.slow_call_seconds
+
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._trial_running = False
+                if failed or slow:
+                    self._open()
+                else:
+                    self.state = CLOSED
+                return
+
+            self._calls.append((failed, slow))
+            if len(self._calls) < self.min_calls:
+                return
+
+            failures = sum(1 for call_failed, _ in self._calls if call_failed)
+            slow_calls = sum(1 for _, call_slow in self._calls if call_slow)
+            if (failures / len(self._calls) >= self.failure_rate
+                    or slow_calls / len(self._calls) >= self.slow_call_rate):
+                self._open()
+
+    def _open(self):
+        self.state = OPEN
+        self._opened_at = time.monotonic()
+        self._calls.clear()
+
+
+def is_upstream_failure(exc: HTTPException) -> bool:
+    """
+    :param exc: error raised while fetching from a 3rd party api service
+    :return: True when the service failed (open circuit, timeout, 5xx), not the request itself
+    """
+    return exc.status_code >= 500
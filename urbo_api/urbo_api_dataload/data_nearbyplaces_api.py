@@ -6,12 +6,20 @@ from fastapi import APIRouter, Depends, HTTPException
 from dotenv import load_dotenv
 from geoalchemy2 import WKTElement
 from sqlalchemy.orm import Session
-from urbo_api.db_connect.db import engine
-from urbo_api.db_connect.db import get_db
-from urbo_api.urbo_api_dataload import utils
+from urbo_api.db_connect.db import get_db, SessionLocal
+from urbo_api.db_connect.write_behind import persist
+from urbo_api.urbo_api_dataload import local_places, utils
 from urbo_api.urbo_api_dataload import models, schema
-import requests
+from urbo_api.urbo_api_dataload.http_client import UpstreamClient, get_http_client, upstream_error
+from urbo_api.urbo_api_dataload.single_flight import location_key, upstream_flight
+from urbo_api.urbo_api_dataload.spatial import within_distance, nearest_first
+from urbo_api.urbo_api_dataload.upstream_scheduler import MAPPLE
+from urbo_api.urbo_api_monitoring.metrics import cache_lookup
+from urbo_api.urbo_api_monitoring.tracing import traced
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
 import os
+import uuid
 
 bearer_token = None
 load_dotenv()
@@ -21,14 +29,15 @@ client_secret = os.getenv('CLIENT_SECRET')
 token_url = os.getenv('TOKEN_URL')
 nearby_places_url = os.getenv('NEARBY_PLACES_URL')
 
-# binds the metadata to a specific database engine to create table in DB
-models.Base.metadata.create_all(bind=engine)
-
 headers = {
     'Content-Type': 'application/x-www-form-urlencoded',
     'User-Agent': 'iamdarkseid'
 }
 
+# runs the Mapple requests of the keywords which are not stored yet at the same time
+_keyword_executor = ThreadPoolExecutor(max_workers=int(os.getenv('NEARBY_PLACES_KEYWORD_WORKERS', '4')),
+                                       thread_name_prefix="nearby-places")
+
 router = APIRouter(
     tags=["nearby-places"],
     responses={404: {"description": "Not Found"}}
@@ -36,68 +45,197 @@ router = APIRouter(
 
 
 @router.get("/fetch-nearby-places/", response_model=schema.NearbyPlaceResponse)
-def fetch_nearby_places(place_data: schema.NearbyPlacesCreate, db_session: Session = Depends(get_db)):
+@traced("fetch_nearby_places")
+def fetch_nearby_places(place_data: schema.NearbyPlacesCreate, db_session: Session = Depends(get_db),
+                        http: UpstreamClient = Depends(get_http_client)):
     """
     This helps to fetch nearby places based on
+    results are stored per keyword and location, a keyword whose area was already covered is answered from the
+    places table, only the remaining keywords are requested from Mapple API
     :param place_data: inputs such as keyword, longitude, latitude, radius and region
     :param db_session: DB connection session
+    :param http: shared upstream http client
     :return: returns the nearby places based on given inputs
     """
-    token = utils.get_mapple_token()
-    if not token:
-        raise HTTPException(status_code=500, detail="Token not found")
+    latitude, longitude = place_data.ref_location[0], place_data.ref_location[1]
+    keywords = normalize_keywords(place_data.keywords)
+
+    nearby_places = find_stored_nearby_places(db_session, keywords, latitude, longitude, place_data.radius,
+                                              place_data.region)
+    for keyword in keywords:
+        if keyword in nearby_places:
+            cache_lookup("nearbyplaces", "hit")
+            continue
+
+        covering_request = local_places.find_covering_request(db_session, keyword, latitude, longitude,
+                                                              place_data.radius)
+        cache_lookup("places", "miss" if covering_request is None else "hit")
+        if covering_request is not None:
+            nearby_places[keyword] = {
+                "id": covering_request.id,
+                "nearby_places_response": local_places.find_local_places(db_session, keyword, latitude, longitude,
+                                                                         place_data.radius)
+            }
+
+    missing_keywords = [keyword for keyword in keywords if keyword not in nearby_places]
+
+    if missing_keywords:
+        token = utils.get_mapple_token(http)
+        if not token:
+            raise HTTPException(status_code=500, detail="Token not found")
+
+        # one Mapple request per keyword, so each result can be stored and reused on its own,
+        # a keyword already being fetched for the same location by another request is waited for, not fetched again
+        # the workers run in the context of the request, so its upstream priority applies to them
+        context = contextvars.copy_context()
+        results = _keyword_executor.map(
+            lambda keyword: context.copy().run(
+                upstream_flight.do,
+                ("nearby_places", keyword, *location_key(latitude, longitude), place_data.radius, place_data.region),
+                fetch_keyword_nearby_places, http, token, keyword, place_data),
+            missing_keywords)
+
+        for keyword, result in zip(missing_keywords, results):
+            nearby_places[keyword] = result
+
+    ref_location_list = [latitude, longitude]
+
+    return {
+        "id": nearby_places[keywords[0]]["id"] if keywords else None,
+        "keywords": keywords,
+        "ref_location": ref_location_list,
+        "nearby_places_response": merge_nearby_places_responses(
+            [nearby_places[keyword]["nearby_places_response"] for keyword in keywords], keywords)
+    }
 
+
+@traced("find_stored_nearby_places")
+def find_stored_nearby_places(db_session: Session, keywords, latitude: float, longitude: float, radius: int,
+                              region: str):
+    """
+    Looks up the stored nearby places of each keyword near the location with the same radius and region
+    :param db_session: DB connection session
+    :param keywords: normalized keywords
+    :param latitude: latitude
+    :param longitude: longitude
+    :param radius: radius in meters
+    :param region: region
+    :return: dict keyword -> id and nearby places response of the closest stored result
+    """
+    rows = (db_session.query(models.NearbyPlace).
+            filter(models.NearbyPlace.keywords.in_(keywords),
+                   models.NearbyPlace.radius == radius,
+                   models.NearbyPlace.region == region,
+                   within_distance(models.NearbyPlace.ref_location, longitude, latitude)).
+            order_by(nearest_first(models.NearbyPlace.ref_location, longitude, latitude)).all())
+
+    nearby_places = {}
+    for row in rows:
+        if row.keywords not in nearby_places:
+            nearby_places[row.keywords] = {"id": row.id, "nearby_places_response": row.nearby_places_response}
+    return nearby_places
+
+
+@traced("fetch_keyword_nearby_places")
+def fetch_keyword_nearby_places(http: UpstreamClient, token: str, keyword: str,
+                                place_data: schema.NearbyPlacesCreate):
+    """
+    Requests the nearby places of one keyword from Mapple API and stores them,
+    it runs in a worker thread so it writes with a DB session of its own
+    :param http: shared upstream http client
+    :param token: Mapple bearer token
+    :param keyword: normalized keyword
+    :param place_data: inputs such as longitude, latitude, radius and region
+    :return: dict with the id of the stored result and the Mapple API response
+    """
+    data = request_nearby_places(http, token, keyword, place_data)
+    latitude, longitude = place_data.ref_location[0], place_data.ref_location[1]
+
+    nearby_place = models.NearbyPlace(
+        id=uuid.uuid4(),
+        keywords=keyword,
+        ref_location=WKTElement(f'POINT({longitude} {latitude})', srid=4326),
+        radius=place_data.radius,
+        region=place_data.region,
+        complete=local_places.is_complete_result(data),
+        nearby_places_response=data
+    )
+
+    db_session = SessionLocal()
+    try:
+        # places first and committed at once, the result may go to the write-behind queue as it is only written
+        # after them, so a result marked complete never points to places which are not written
+        local_places.store_places(db_session, keyword, data)
+        persist(db_session, nearby_place)
+    finally:
+        db_session.close()
+
+    return {"id": nearby_place.id, "nearby_places_response": data}
+
+
+def request_nearby_places(http: UpstreamClient, token: str, keyword: str, place_data: schema.NearbyPlacesCreate):
+    """
+    Requests the nearby places of one keyword from Mapple API
+    :param http: shared upstream http client
+    :param token: Mapple bearer token
+    :param keyword: keyword to search
+    :param place_data: inputs such as longitude, latitude, radius and region
+    :return: Mapple API response
+    """
     headers = {
         'Authorization': f'Bearer {token}'
     }
 
     ref_location_str = f"{place_data.ref_location[0]},{place_data.ref_location[1]}"
     params = {
-        'keywords': keywords_to_string(place_data.keywords),
+        'keywords': keyword,
         'refLocation': ref_location_str,
         'radius': place_data.radius,
         'region': place_data.region
     }
 
-    response = requests.get(nearby_places_url, headers=headers, params=params)
+    response = http.get(nearby_places_url, provider=MAPPLE, headers=headers, params=params)
 
-    if response.status_code == 200:
-        data = response.json()
-
-        ref_location_point = WKTElement(f'POINT({place_data.ref_location[1]} {place_data.ref_location[0]})',
-                                        srid=4326)
-
-        nearby_place = models.NearbyPlace(
-            keywords=keywords_to_string(place_data.keywords),
-            ref_location=ref_location_point,
-            nearby_places_response=data
-        )
-        db_session.add(nearby_place)
-        db_session.commit()
-        db_session.refresh(nearby_place)
-
-        ref_location_list = [place_data.ref_location[0], place_data.ref_location[1]]
-
-        return {
-            "id": nearby_place.id,
-            "keywords": string_to_keywords(nearby_place.keywords),
-            "ref_location": ref_location_list,
-            "nearby_places_response": nearby_place.nearby_places_response
+    if response.status_code == 401:
+        # token was rejected before its expiry, refresh it once and retry
+        token = utils.get_mapple_token(http, expired_token=token)
+        headers = {
+            'Authorization': f'Bearer {token}'
         }
+        response = http.get(nearby_places_url, provider=MAPPLE, headers=headers, params=params)
 
-    else:
-        raise HTTPException(status_code=400, detail="Failed to fetch places from Mapple API")
-
+    if response.status_code == 200:
+        return response.json()
 
+    else:
+        raise upstream_error(response.status_code, "Failed to fetch places from Mapple API")
 
-def keywords_to_string(keywords):
-    """Convert a list of keywords to a comma-separated string."""
-    if isinstance(keywords, list):
-        return ','.join(keywords)
-    return keywords
 
-def string_to_keywords(keywords_str):
-    """Convert a comma-separated string of keywords back into a list."""
-    if isinstance(keywords_str, str):
-        return keywords_str.split(',')
-    return keywords_str
\ No newline at end of file
+def merge_nearby_places_responses(responses, keywords=None):
+    """
+    Combines the nearby places of several keywords, a place found by more than one keyword is kept once
+    :param responses: Mapple API responses
+    :param keywords: keyword of each response, when given the number of places of each keyword is added
+    :return: response with all suggestedLocations (and keywordCounts)
+    """
+    suggested_locations = []
+    seen_elocs = set()
+    for response in responses:
+        for location in response.get("suggestedLocations", []):
+            eloc = location.get("eLoc")
+            if eloc is not None:
+                if eloc in seen_elocs:
+                    continue
+                seen_elocs.add(eloc)
+            suggested_locations.append(location)
+
+    merged = {"suggestedLocations": suggested_locations}
+    if keywords is not None:
+        merged["keywordCounts"] = {keyword: len(response.get("suggestedLocations", []))
+                                   for keyword, response in zip(keywords, responses)}
+    return merged
+
+
+def normalize_keywords(keywords):
+    """Lower case, strip and de-duplicate the keywords, keeping their order."""
+    return list(dict.fromkeys(keyword.strip().lower() for keyword in keywords if keyword.strip()))
@@ -4,11 +4,15 @@ geocode_api.py help get lon and lat and vice versa from 3rdy party server (HERE
 
 from dotenv import load_dotenv
 from fastapi import APIRouter, HTTPException, Depends
-import requests
+from geoalchemy2 import WKTElement
 import os
 from sqlalchemy.orm import Session
 from urbo_api.db_connect.db import get_db
+from urbo_api.db_connect.write_behind import persist
 from urbo_api.urbo_api_dataload import models, schema
+from urbo_api.urbo_api_dataload.http_client import UpstreamClient, get_http_client, upstream_error
+from urbo_api.urbo_api_dataload.upstream_scheduler import HERE
+from urbo_api.urbo_api_monitoring.tracing import traced
 
 #load environment variable from .env
 load_dotenv()
@@ -23,11 +27,14 @@ router = APIRouter(
 
 
 @router.post("/geocode", response_model=schema.GeocodeResponse)
-def get_geocode(geocode_data: schema.GeocodeCreate, db: Session = Depends(get_db)):
+@traced("get_geocode")
+def get_geocode(geocode_data: schema.GeocodeCreate, db: Session = Depends(get_db),
+                http: UpstreamClient = Depends(get_http_client)):
     """
     Get the Latitude and Longitude based on address
     :param geocode_data: takes address in string format as user input
     :param db: db_session: DB connection session
+    :param http: shared upstream http client
     :return:based on given address finds the coordinates  (long and lat)
     """
     if not here_api_key:
@@ -38,10 +45,10 @@ def get_geocode(geocode_data: schema.GeocodeCreate, db: Session = Depends(get_db
         'q': geocode_data.address,
         'apiKey': here_api_key
     }
-    response = requests.get(geocode_url, params=params)
+    response = http.get(geocode_url, provider=HERE, params=params)
 
     if response.status_code != 200:
-        raise HTTPException(status_code=response.status_code, detail="Error fetching geocode")
+        raise upstream_error(response.status_code, "Error fetching geocode")
 
     data = response.json()
 
@@ -58,13 +65,11 @@ def get_geocode(geocode_data: schema.GeocodeCreate, db: Session = Depends(get_db
         address=geocode_data.address,
         latitude=latitude,
         longitude=longitude,
-        ref_location=ref_location_point,
+        ref_location=WKTElement(ref_location_point, srid=4326),
         geocode_response=data
     )
 
-    db.add(new_geocode)
-    db.commit()
-    db.refresh(new_geocode)
+    persist(db, new_geocode)
 
     return {
         "address": geocode_data.address,
@@ -77,11 +82,14 @@ def get_geocode(geocode_data: schema.GeocodeCreate, db: Session = Depends(get_db
 
 
 @router.post("/reverse-geocode", response_model=schema.GeocodeResponse)
-def get_reverse_geocode(reverse_geocode_data: schema.ReverseGeocodeCreate, db: Session = Depends(get_db)):
+@traced("get_reverse_geocode")
+def get_reverse_geocode(reverse_geocode_data: schema.ReverseGeocodeCreate, db: Session = Depends(get_db),
+                        http: UpstreamClient = Depends(get_http_client)):
     """
 
     :param reverse_geocode_data: it takes coordinates (lon, lat)
     :param db: db_session: DB connection session
+    :param http: shared upstream http client
     :return: returns the address
     """
     if not here_api_key:
@@ -93,10 +101,10 @@ def get_reverse_geocode(reverse_geocode_data: schema.ReverseGeocodeCreate, db: S
         'limit': 1,  # limit results to 1
         'apiKey': here_api_key
     }
-    response = requests.get(reverse_geocode_url, params=params)
+    response = http.get(reverse_geocode_url, provider=HERE, params=params)
 
     if response.status_code != 200:
-        raise HTTPException(status_code=response.status_code, detail="Error fetching reverse geocode")
+        raise upstream_error(response.status_code, "Error fetching reverse geocode")
 
     data = response.json()
 
@@ -112,13 +120,11 @@ def get_reverse_geocode(reverse_geocode_data: schema.ReverseGeocodeCreate, db: S
         address=address,
         latitude=reverse_geocode_data.latitude,
         longitude=reverse_geocode_data.longitude,
-        ref_location=ref_location_point,
+        ref_location=WKTElement(ref_location_point, srid=4326),
         geocode_response=data
     )
 
-    db.add(new_geocode)
-    db.commit()
-    db.refresh(new_geocode)
+    persist(db, new_geocode)
 
     return {
         "address": address,
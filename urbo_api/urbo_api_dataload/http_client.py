@@ -0,0 +1,202 @@
+"""
+ http_client.py contains the shared http client used to call 3rd party api services (HERE, Mapple, OpenWeather)
+ it keeps a connection pool per host (keep-alive), applies connect/read timeouts and retries on 429/5xx,
+ every attempt (retries included) goes through the circuit breaker of its provider and takes a token from the
+ upstream scheduler first, so the rate limit and the daily quota count every request sent to the provider
+"""
+import os
+import time
+from typing import Optional
+
+import requests
+from dotenv import load_dotenv
+from fastapi import HTTPException, Request
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from urbo_api.urbo_api_dataload.circuit_breaker import CircuitBreaker, CircuitOpenError
+from urbo_api.urbo_api_dataload.upstream_scheduler import PROVIDERS, UpstreamScheduler
+from urbo_api.urbo_api_monitoring.metrics import observe_upstream
+from urbo_api.urbo_api_monitoring.tracing import span
+
+# load environment variable
+load_dotenv()
+CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "3.05"))
+READ_TIMEOUT = float(os.getenv("UPSTREAM_READ_TIMEOUT", "10"))
+POOL_CONNECTIONS = int(os.getenv("UPSTREAM_POOL_CONNECTIONS", "10"))
+POOL_MAXSIZE = int(os.getenv("UPSTREAM_POOL_MAXSIZE", "20"))
+MAX_RETRIES = int(os.getenv("UPSTREAM_MAX_RETRIES", "3"))
+BACKOFF_FACTOR = float(os.getenv("UPSTREAM_BACKOFF_FACTOR", "0.3"))
+# longest Retry-After (seconds) a request thread sleeps before retrying, a longer one pauses the provider instead
+MAX_RETRY_WAIT = float(os.getenv("UPSTREAM_MAX_RETRY_WAIT", "2"))
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class UpstreamClient:
+    """
+    Pooled http client shared by all the routers, it is created once at app startup
+    """
+
+    def __init__(self, connect_timeout: float = CONNECT_TIMEOUT, read_timeout: float = READ_TIMEOUT,
+                 pool_connections: int = POOL_CONNECTIONS, pool_maxsize: int = POOL_MAXSIZE,
+                 max_retries: int = MAX_RETRIES, backoff_factor: float = BACKOFF_FACTOR,
+                 max_retry_wait: float = MAX_RETRY_WAIT, scheduler: Optional[UpstreamScheduler] = None):
+        """
+        :param connect_timeout: seconds to wait for the TCP/TLS connection
+        :param read_timeout: seconds to wait for the response
+        :param pool_connections: number of hosts for which a connection pool is kept
+        :param pool_maxsize: keep-alive connections kept per host
+        :param max_retries: retries on connection errors and on 429/5xx responses
+        :param backoff_factor: exponential backoff between retries, Retry-After header is respected
+        :param max_retry_wait: longest Retry-After waited for, a longer one stops the retries and pauses the provider
+        :param scheduler: rate limiter of the providers, default one is configured from the environment
+        """
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_retry_wait = max_retry_wait
+        self.scheduler = scheduler or UpstreamScheduler()
+        self.breakers = {provider: CircuitBreaker(provider) for provider in PROVIDERS}
+
+        # only connection errors are retried by urllib3, nothing was counted by the provider for them,
+        # 429/5xx responses are retried by _send so each attempt takes its own token
+        retry = Retry(
+            total=max_retries,
+            connect=max_retries,
+            read=max_retries,
+            status=0,
+            backoff_factor=backoff_factor,
+            allowed_methods=frozenset({"GET", "POST"}),
+            respect_retry_after_header=False,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def get(self, url: str, provider: Optional[str] = None, **kwargs) -> requests.Response:
+        """
+        :param url: upstream url
+        :param provider: provider whose rate limit applies (upstream_scheduler.HERE, MAPPLE, OPENWEATHER)
+        :param kwargs: same as requests.get (params, headers ...)
+        :return: upstream response
+        """
+        return self._send(self.session.get, url, provider, **kwargs)
+
+    def post(self, url: str, provider: Optional[str] = None, **kwargs) -> requests.Response:
+        """
+        :param url: upstream url
+        :param provider: provider whose rate limit applies (upstream_scheduler.HERE, MAPPLE, OPENWEATHER)
+        :param kwargs: same as requests.post (data, headers ...)
+        :return: upstream response
+        """
+        return self._send(self.session.post, url, provider, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+    def _send(self, method, url: str, provider: Optional[str], **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        attempt = 0
+        while True:
+            response = self._attempt(method, url, provider, **kwargs)
+            if response.status_code not in RETRY_STATUS_CODES:
+                return response
+
+            wait = retry_after_seconds(response, default=None)
+            if wait is None:
+                wait = self.backoff_factor * 2 ** attempt
+            if attempt >= self.max_retries or wait > self.max_retry_wait:
+                break
+            time.sleep(wait)
+            attempt += 1
+
+        if provider is not None and response.status_code == 429:
+            # still limited after the retries, hold back the other callers of the provider too
+            retry_after = retry_after_seconds(response)
+            self.scheduler.pause(provider, retry_after)
+            raise HTTPException(status_code=503, detail=f"Upstream {provider} rate limit reached, try again later",
+                                headers={"Retry-After": str(retry_after)})
+
+        return response
+
+    def _attempt(self, method, url: str, provider: Optional[str], **kwargs) -> requests.Response:
+        """
+        Sends the request once, after the circuit breaker check and with a token of the provider
+        """
+        breaker = self.breakers.get(provider)
+        if breaker is not None:
+            # fail fast while the provider is down, before waiting for a rate limit token
+            try:
+                breaker.before_call()
+            except CircuitOpenError:
+                observe_upstream(provider, "circuit_open")
+                raise
+        if provider is not None:
+            try:
+                self.scheduler.acquire(provider)
+            except BaseException:
+                if breaker is not None:
+                    breaker.release()
+                observe_upstream(provider, "rate_limited")
+                raise
+
+        start = time.monotonic()
+        try:
+            with span(f"upstream_{provider or 'other'}"):
+                response = method(url, **kwargs)
+        except requests.exceptions.Timeout:
+            self._record(provider, breaker, "timeout", start)
+            raise HTTPException(status_code=504, detail="Upstream service timed out")
+        except requests.exceptions.RequestException:
+            self._record(provider, breaker, "error", start)
+            raise HTTPException(status_code=502, detail="Upstream service not reachable")
+
+        self._record(provider, breaker, response.status_code, start)
+        return response
+
+    @staticmethod
+    def _record(provider: Optional[str], breaker: Optional[CircuitBreaker], status, start: float):
+        # status is the http status code, or timeout / error when no response came back
+        duration = time.monotonic() - start
+        if provider is not None:
+            observe_upstream(provider, status, duration)
+        if breaker is not None:
+            breaker.record(not isinstance(status, int) or status >= 500, duration)
+
+
+def retry_after_seconds(response: requests.Response, default: Optional[int] = 1) -> Optional[int]:
+    """
+    :param response: upstream response
+    :param default: seconds used when the header is missing or is a date
+    :return: seconds of the Retry-After header, at least 1 when the header is there
+    """
+    try:
+        return max(int(response.headers["Retry-After"]), 1)
+    except (KeyError, ValueError):
+        return default
+
+
+def upstream_error(status_code: int, detail: str) -> HTTPException:
+    """
+    :param status_code: status of the failed upstream response
+    :param detail: error message
+    :return: 503 when the service is rate limited, 502 when it failed (5xx) or refused the configured credentials
+             (401, 403, e.g. a rotated key), otherwise 400 as the request was refused,
+             the 5xx ones count as upstream failures which the aggregate endpoint degrades on
+    """
+    if status_code == 429:
+        return HTTPException(status_code=503, detail=detail)
+    if status_code >= 500 or status_code in (401, 403):
+        return HTTPException(status_code=502, detail=detail)
+    return HTTPException(status_code=400, detail=detail)
+
+
+def get_http_client(request: Request) -> UpstreamClient:
+    """
+    Dependency which gives the http client created at app startup
+    """
+    return request.app.state.http_client
@@ -0,0 +1,155 @@
+"""
+ image_pipeline.py derives still maps from the ones already stored instead of requesting them again from Mappls
+ a smaller size is a crop of a stored map, another zoom is a crop resized by 2^(zoom difference), the crop is
+ placed with web mercator pixel math so a stored map of a nearby center can be used as well
+ it also makes the WebP and thumbnail variants of the stored maps
+ Pillow is optional, without it nothing is derived and every map comes from Mappls
+"""
+import io
+import math
+import os
+
+from dotenv import load_dotenv
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# load environment variable
+load_dotenv()
+STILLMAP_DERIVE_ENABLED = os.getenv("STILLMAP_DERIVE_ENABLED", "true").lower() == "true"
+# largest enlargement of the stored pixels, 2 allows one zoom level in, 1 only allows crops and zooming out
+STILLMAP_MAX_UPSCALE = float(os.getenv("STILLMAP_MAX_UPSCALE", "2"))
+STILLMAP_WEBP_QUALITY = int(os.getenv("STILLMAP_WEBP_QUALITY", "80"))
+# largest side of the thumbnail variant
+STILLMAP_THUMBNAIL_SIZE = int(os.getenv("STILLMAP_THUMBNAIL_SIZE", "256"))
+
+# web mercator tiles are 256 pixels wide, zoom z shows the world on 256 * 2^z pixels
+TILE_SIZE = 256
+
+# variant name -> file extension in the image store (next to the png of the same hash) and media type
+VARIANTS = {
+    "webp": ("webp", "image/webp"),
+    "thumbnail": ("thumb.webp", "image/webp"),
+}
+
+
+def pillow_available() -> bool:
+    return Image is not None
+
+
+def parse_size(size: str):
+    """
+    :param size: size as "widthxheight", e.g. 1000x1000
+    :return: (width, height), None when it is not a valid size
+    """
+    try:
+        width, height = (int(value) for value in size.lower().split("x"))
+    except ValueError:
+        return None
+    return (width, height) if width > 0 and height > 0 else None
+
+
+def mercator_pixel(lat: float, lon: float, zoom: float):
+    """
+    :param lat: latitude
+    :param lon: longitude
+    :param zoom: zoom level
+    :return: (x, y) position in pixels of the whole world map at that zoom
+    """
+    world = TILE_SIZE * 2 ** zoom
+    lat = max(min(lat, 85.0511), -85.0511)
+    sin_lat = math.sin(math.radians(lat))
+    x = (lon + 180) / 360 * world
+    y = (0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)) * world
+    return x, y
+
+
+def crop_box(source: dict, lat: float, lon: float, zoom: int, size, max_upscale: float = STILLMAP_MAX_UPSCALE):
+    """
+    :param source: stored map, dict with lat, lon, zoom and size (width, height)
+    :param lat: latitude of the requested center
+    :param lon: longitude of the requested center
+    :param zoom: requested zoom
+    :param size: requested (width, height)
+    :param max_upscale: largest enlargement of the stored pixels
+    :return: (left, top, right, bottom) area of the stored map showing the requested map, None when the stored
+             map does not cover it or would have to be enlarged too much
+    """
+    scale = 2 ** (zoom - source["zoom"])
+    if scale > max_upscale:
+        return None
+
+    source_x, source_y = mercator_pixel(source["lat"], source["lon"], source["zoom"])
+    target_x, target_y = mercator_pixel(lat, lon, source["zoom"])
+    source_width, source_height = source["size"]
+    center_x = source_width / 2 + target_x - source_x
+    center_y = source_height / 2 + target_y - source_y
+    half_width, half_height = size[0] / scale / 2, size[1] / scale / 2
+
+    box = (center_x - half_width, center_y - half_height, center_x + half_width, center_y + half_height)
+    # half a pixel over the edge is rounding, not missing content
+    if box[0] < -0.5 or box[1] < -0.5 or box[2] > source_width + 0.5 or box[3] > source_height + 0.5:
+        return None
+    return (max(box[0], 0), max(box[1], 0), min(box[2], source_width), min(box[3], source_height))
+
+
+def best_source(sources, lat: float, lon: float, zoom: int, size, max_upscale: float = STILLMAP_MAX_UPSCALE):
+    """
+    :param sources: stored maps (see crop_box), the closest first, a map with a source_id was itself derived
+                    and is never used, chained derivations would enlarge past max_upscale
+    :param lat: latitude of the requested center
+    :param lon: longitude of the requested center
+    :param zoom: requested zoom
+    :param size: requested (width, height)
+    :param max_upscale: largest enlargement of the stored pixels
+    :return: (source, box) needing the least enlargement, the closest one among equals, None when no map fits
+    """
+    best = None
+    for source in sources:
+        if source.get("source_id") is not None or source["size"] is None:
+            continue
+        box = crop_box(source, lat, lon, zoom, size, max_upscale)
+        if box is None:
+            continue
+        scale = 2 ** (zoom - source["zoom"])
+        if best is None or scale < best[0]:
+            best = (scale, source, box)
+    return None if best is None else (best[1], best[2])
+
+
+def derive_image(content: bytes, box, size) -> bytes:
+    """
+    :param content: stored map image
+    :param box: area of the stored map to use, see crop_box
+    :param size: (width, height) of the result
+    :return: PNG image
+    """
+    with Image.open(io.BytesIO(content)) as image:
+        if round(box[2] - box[0]) == size[0] and round(box[3] - box[1]) == size[1]:
+            # same zoom, a plain crop keeps the pixels sharp
+            left, top = round(box[0]), round(box[1])
+            result = image.crop((left, top, left + size[0], top + size[1]))
+        else:
+            result = image.resize(size, Image.LANCZOS, box=box)
+
+        output = io.BytesIO()
+        result.save(output, format="PNG", optimize=True)
+        return output.getvalue()
+
+
+def make_variant(content: bytes, variant: str) -> bytes:
+    """
+    :param content: stored map image
+    :param variant: webp or thumbnail
+    :return: image of the variant, WebP
+    """
+    with Image.open(io.BytesIO(content)) as image:
+        image = image.convert("RGBA" if image.mode in ("RGBA", "LA", "P") else "RGB")
+        if variant == "thumbnail":
+            image.thumbnail((STILLMAP_THUMBNAIL_SIZE, STILLMAP_THUMBNAIL_SIZE), Image.LANCZOS)
+
+        output = io.BytesIO()
+        image.save(output, format="WEBP", quality=STILLMAP_WEBP_QUALITY, method=4)
+        return output.getvalue()
@@ -0,0 +1,73 @@
+"""
+ image_store.py keeps the still map images on disk, each file is named after the sha256 hash of its content
+ so the same image is stored only once and the DB keeps only its hash and metadata
+"""
+import hashlib
+import os
+import uuid
+
+from dotenv import load_dotenv
+
+# load environment variable
+load_dotenv()
+MAP_IMAGE_STORE_DIR = os.getenv("MAP_IMAGE_STORE_DIR", "map_images")
+
+
+class ImageStore:
+    """
+    Content addressed file store, files are spread over sub directories named after the first 2 chars of the hash
+    """
+
+    def __init__(self, root: str = MAP_IMAGE_STORE_DIR):
+        self.root = root
+
+    def put(self, content: bytes, extension: str = "png") -> str:
+        """
+        Stores the content unless a file with the same hash already exists
+        :param content: image bytes
+        :param extension: file extension
+        :return: sha256 hash of the content
+        """
+        image_hash = hashlib.sha256(content).hexdigest()
+        self.put_variant(image_hash, content, extension)
+        return image_hash
+
+    def put_variant(self, image_hash: str, content: bytes, extension: str):
+        """
+        Stores content derived from an image (e.g. its WebP version) next to it, unless it already exists
+        :param image_hash: sha256 hash of the original image
+        :param content: bytes of the variant
+        :param extension: file extension of the variant
+        """
+        path = self.path(image_hash, extension)
+
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # write to a temporary file first so a reader never sees a half written image
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, "wb") as file:
+                file.write(content)
+            os.replace(tmp_path, path)
+
+    def exists(self, image_hash: str, extension: str = "png") -> bool:
+        return os.path.exists(self.path(image_hash, extension))
+
+    def path(self, image_hash: str, extension: str = "png") -> str:
+        """
+        :param image_hash: sha256 hash of the content
+        :param extension: file extension
+        :return: path of the file
+        """
+        return os.path.join(self.root, image_hash[:2], f"{image_hash}.{extension}")
+
+    def read(self, image_hash: str, extension: str = "png") -> bytes:
+        """
+        :param image_hash: sha256 hash of the content
+        :param extension: file extension
+        :return: image bytes
+        """
+        with open(self.path(image_hash, extension), "rb") as file:
+            return file.read()
+
+
+image_store = ImageStore()
@@ -0,0 +1,115 @@
+"""
+ local_places.py unpacks the places found by Mapple API into the places table (one row per place and keyword)
+ and answers radius + keyword queries from it when the area was already covered by an earlier Mapple request
+"""
+import os
+import uuid
+
+from dotenv import load_dotenv
+from geoalchemy2 import Geography
+from sqlalchemy import cast, func
+from sqlalchemy.orm import Session
+
+from urbo_api.db_connect.write_behind import persist_rows
+from urbo_api.urbo_api_dataload import models
+from urbo_api.urbo_api_dataload.spatial import make_point, within_distance
+
+# load environment variable
+load_dotenv()
+# largest radius (meters) accepted by Mapple nearby API, it bounds the search of covering requests
+NEARBY_PLACES_MAX_RADIUS = int(os.getenv("NEARBY_PLACES_MAX_RADIUS", "10000"))
+
+
+def place_coordinates(location: dict):
+    """
+    :param location: one entry of suggestedLocations
+    :return: (lon, lat) of the place or None when Mapple did not send its coordinates
+    """
+    for lat_key, lon_key in (("latitude", "longitude"), ("entryLatitude", "entryLongitude")):
+        if location.get(lat_key) is not None and location.get(lon_key) is not None:
+            return float(location[lon_key]), float(location[lat_key])
+    return None
+
+
+def is_complete_result(data: dict):
+    """
+    A result can answer later queries locally only if every place has coordinates and no page is missing
+    :param data: Mapple nearby API response
+    :return: True when all the places of the searched area are in the result
+    """
+    page_info = data.get("pageInfo") or {}
+    if int(page_info.get("totalPages") or 1) > 1:
+        return False
+    return all(place_coordinates(location) is not None for location in data.get("suggestedLocations", []))
+
+
+def store_places(db_session: Session, keyword: str, data: dict):
+    """
+    Upserts the places of a Mapple response, a place found again for the same keyword is updated, not duplicated
+    they are written now, not by the write-behind queue, as the result marked complete is only stored after them
+    :param db_session: DB connection session
+    :param keyword: searched keyword
+    :param data: Mapple nearby API response
+    """
+    rows = {}
+    for location in data.get("suggestedLocations", []):
+        coordinates = place_coordinates(location)
+        if location.get("eLoc") is None or coordinates is None:
+            continue
+
+        rows[location["eLoc"]] = {
+            "id": uuid.uuid4(),
+            "eloc": location["eLoc"],
+            "keyword": keyword,
+            "name": location.get("placeName"),
+            "category": location.get("type") or location.get("categoryCode"),
+            "location": make_point(*coordinates),
+            "place_response": location
+        }
+
+    persist_rows(db_session, models.Place, list(rows.values()), conflict_columns=("eloc", "keyword"), defer=False)
+
+
+def find_covering_request(db_session: Session, keyword: str, latitude: float, longitude: float, radius: int):
+    """
+    Finds a complete stored Mapple result whose searched circle contains the requested circle
+    :param db_session: DB connection session
+    :param keyword: normalized keyword
+    :param latitude: latitude
+    :param longitude: longitude
+    :param radius: requested radius in meters
+    :return: NearbyPlace row or None
+    """
+    point = cast(make_point(longitude, latitude), Geography(srid=4326))
+    return (db_session.query(models.NearbyPlace).
+            filter(models.NearbyPlace.keywords == keyword,
+                   models.NearbyPlace.complete.is_(True),
+                   models.NearbyPlace.radius >= radius,
+                   # the constant distance lets the GiST index pick the candidates
+                   within_distance(models.NearbyPlace.ref_location, longitude, latitude, NEARBY_PLACES_MAX_RADIUS),
+                   func.ST_DWithin(models.NearbyPlace.ref_location, point, models.NearbyPlace.radius - radius)).
+            first())
+
+
+def find_local_places(db_session: Session, keyword: str, latitude: float, longitude: float, radius: int):
+    """
+    Answers the nearby places query from the places table
+    :param db_session: DB connection session
+    :param keyword: normalized keyword
+    :param latitude: latitude
+    :param longitude: longitude
+    :param radius: radius in meters
+    :return: response shaped like Mapple nearby API response, closest place first
+    """
+    point = cast(make_point(longitude, latitude), Geography(srid=4326))
+    distance = func.ST_Distance(models.Place.location, point)
+    rows = (db_session.query(models.Place.place_response, distance).
+            filter(models.Place.keyword == keyword,
+                   within_distance(models.Place.location, longitude, latitude, radius)).
+            order_by(distance).all())
+
+    suggested_locations = []
+    for place_response, place_distance in rows:
+        suggested_locations.append({**place_response, "distance": round(place_distance)})
+
+    return {"suggestedLocations": suggested_locations}
@@ -1,20 +1,46 @@
 """
  map_image_api.py contains the api for fetching still map image based on long, lat and other given params
+ the images are kept in the image store, the DB keeps only their hash and metadata
+ maps which a stored map covers are derived from it (see image_pipeline.py), WebP and thumbnail variants are
+ made on their first request and kept next to the png
 """
+import hashlib
 import os
+import uuid
 from dotenv import load_dotenv
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse
 from geoalchemy2 import WKTElement
+from sqlalchemy import func
 from sqlalchemy.orm import Session
-import requests
-from urbo_api.db_connect.db import get_db
+from urbo_api.db_connect.db import AsyncSession, get_async_db, get_db
+from urbo_api.db_connect.local_cache import local_cache
+from urbo_api.db_connect.write_behind import persist
 from urbo_api.urbo_api_dataload import models, schema
+from urbo_api.urbo_api_dataload.http_client import UpstreamClient, get_http_client, upstream_error
+from urbo_api.urbo_api_dataload.image_pipeline import STILLMAP_DERIVE_ENABLED, VARIANTS, best_source, \
+    derive_image, make_variant, parse_size, pillow_available
+from urbo_api.urbo_api_dataload.image_store import image_store
+from urbo_api.urbo_api_dataload.spatial import nearest_first, within_distance
+from urbo_api.urbo_api_dataload.upstream_scheduler import MAPPLE
+from urbo_api.urbo_api_monitoring.metrics import cache_lookup
+from urbo_api.urbo_api_monitoring.tracing import span, traced
 
 # load environment variable
 load_dotenv()
 api_key = os.getenv("API_KEY")
 url = os.getenv("STILL_MAP_URL")
 
+# an image never changes for a given id, so clients and proxies may keep it for a year
+IMAGE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# seconds the still maps found for a place, and the image hash of each id, are kept in the local cache
+LOCAL_CACHE_STILLMAP_TTL = float(os.getenv("LOCAL_CACHE_STILLMAP_TTL", "86400"))
+# stored maps whose center is within this distance (meters) are tried as source of a derived map,
+# the closest STILLMAP_DERIVE_CANDIDATES of them
+STILLMAP_DERIVE_DISTANCE = float(os.getenv("STILLMAP_DERIVE_DISTANCE", "5000"))
+STILLMAP_DERIVE_CANDIDATES = int(os.getenv("STILLMAP_DERIVE_CANDIDATES", "20"))
+
 
 router = APIRouter(
     tags=["map"],
@@ -23,7 +49,9 @@ router = APIRouter(
 
 
 @router.get("/stillmap", response_model=schema.StillMapImageResponse)
-def get_stillmap(lat: float, lon: float, zoom: int = 12, size: str = "1000x1000", db: Session = Depends(get_db)):
+@traced("get_stillmap")
+def get_stillmap(lat: float, lon: float, zoom: int = 12, size: str = "1000x1000", db: Session = Depends(get_db),
+                 http: UpstreamClient = Depends(get_http_client)):
     """
 
     :param lat: latitude in float
@@ -31,8 +59,14 @@ def get_stillmap(lat: float, lon: float, zoom: int = 12, size: str = "1000x1000"
     :param zoom: zoom level set to 12
     :param size: constant size 1000x1000
     :param db: DB connection session
+    :param http: shared upstream http client
     :return: fetches the still map image in .png form based on given inputs
     """
+    # a stored map covering the requested one is cropped or resized instead of requesting Mappls again
+    derived = derive_stillmap(lat, lon, zoom, size, db)
+    if derived is not None:
+        return derived
+
     # Construct the URL to fetch the image
     still_map_url = f"{url}{api_key}/still_image"
     params = {
@@ -41,24 +75,211 @@ def get_stillmap(lat: float, lon: float, zoom: int = 12, size: str = "1000x1000"
         "size": size
     }
 
-    response = requests.get(still_map_url, params=params)
+    response = http.get(still_map_url, provider=MAPPLE, params=params)
 
     if response.status_code != 200:
-        raise HTTPException(status_code=response.status_code, detail="Error fetching image from Mapples")
+        raise upstream_error(response.status_code, "Error fetching image from Mapples")
+
+    image_hash = image_store.put(response.content)
 
     center = [lon,lat]
     center_point = WKTElement(f'POINT({center[0]} {center[1]})', srid=4326)
     new_stillmap = models.StillMap(
         center= center_point,
-        map_img=response.content
+        zoom=zoom,
+        size=size,
+        image_hash=image_hash,
+        content_type="image/png",
+        size_bytes=len(response.content)
     )
 
-    db.add(new_stillmap)
-    db.commit()
-    db.refresh(new_stillmap)
+    persist(db, new_stillmap)
+    stillmap_id = new_stillmap.id
 
     return {
-        "id": new_stillmap.id,
+        "id": stillmap_id,
         "center": [lon,lat],
-        "map_img": new_stillmap.map_img
-    }
\ No newline at end of file
+        "map_img": response.content,
+        "image_url": stillmap_image_url(stillmap_id)
+    }
+
+
+@router.get("/stillmap/{stillmap_id}.png")
+async def get_stillmap_image(stillmap_id: uuid.UUID, request: Request, db: AsyncSession = Depends(get_async_db)):
+    """
+    Streams the stored still map image as binary png, with ETag and long lived cache headers
+    :param stillmap_id: id of the still map
+    :param request: http request, used for If-None-Match
+    :param db: async DB connection session
+    :return: png image
+    """
+    image_hash, still_map = await find_image_hash(stillmap_id, db)
+    headers = {
+        "ETag": f'"{image_hash}"',
+        "Cache-Control": IMAGE_CACHE_CONTROL
+    }
+
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
+
+    if still_map is not None and still_map.image_hash is None:
+        return Response(content=still_map.map_img, media_type="image/png", headers=headers)
+
+    # FileResponse lets the server send the file with sendfile (http.response.pathsend) when it supports it
+    return FileResponse(image_store.path(image_hash), media_type="image/png", headers=headers)
+
+
+@router.get("/stillmap/{stillmap_id}.webp")
+async def get_stillmap_webp(stillmap_id: uuid.UUID, request: Request, db: AsyncSession = Depends(get_async_db)):
+    """
+    Same image as the png endpoint in WebP, a fraction of its bytes for the mobile clients
+    :param stillmap_id: id of the still map
+    :param request: http request, used for If-None-Match
+    :param db: async DB connection session
+    :return: webp image
+    """
+    return await stillmap_variant_response(stillmap_id, "webp", request, db)
+
+
+@router.get("/stillmap/{stillmap_id}/thumbnail.webp")
+async def get_stillmap_thumbnail(stillmap_id: uuid.UUID, request: Request,
+                                 db: AsyncSession = Depends(get_async_db)):
+    """
+    Thumbnail of the still map (STILLMAP_THUMBNAIL_SIZE pixels at most) in WebP
+    :param stillmap_id: id of the still map
+    :param request: http request, used for If-None-Match
+    :param db: async DB connection session
+    :return: webp image
+    """
+    return await stillmap_variant_response(stillmap_id, "thumbnail", request, db)
+
+
+async def find_image_hash(stillmap_id: uuid.UUID, db: AsyncSession):
+    """
+    :param stillmap_id: id of the still map
+    :param db: async DB connection session
+    :return: hash of the image and the StillMap row, the row is None when the hash came from the local cache
+    """
+    # the hash of an id never changes, a cached one saves the DB lookup
+    image_hash = local_cache.get("stillmap_hash", str(stillmap_id))
+    if image_hash is not None:
+        return image_hash, None
+
+    still_map = await db.get(models.StillMap, stillmap_id)
+    if still_map is None:
+        raise HTTPException(status_code=404, detail="Still map not found")
+    if still_map.image_hash is not None:
+        local_cache.set("stillmap_hash", str(stillmap_id), still_map.image_hash, LOCAL_CACHE_STILLMAP_TTL)
+
+    # rows stored before the image store keep the image in DB
+    return still_map.image_hash or hashlib.sha256(still_map.map_img).hexdigest(), still_map
+
+
+async def stillmap_variant_response(stillmap_id: uuid.UUID, variant: str, request: Request, db: AsyncSession):
+    """
+    Serves a variant of the still map, it is made on the first request and kept next to the png in the image store
+    :param stillmap_id: id of the still map
+    :param variant: one of image_pipeline.VARIANTS
+    :param request: http request, used for If-None-Match
+    :param db: async DB connection session
+    :return: image of the variant
+    """
+    if not pillow_available():
+        raise HTTPException(status_code=501, detail="Image variants are not available, Pillow is not installed")
+
+    image_hash, still_map = await find_image_hash(stillmap_id, db)
+    extension, media_type = VARIANTS[variant]
+    headers = {
+        "ETag": f'"{image_hash}-{variant}"',
+        "Cache-Control": IMAGE_CACHE_CONTROL
+    }
+
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
+
+    if not image_store.exists(image_hash, extension):
+        legacy_image = still_map.map_img if still_map is not None and still_map.image_hash is None else None
+        await run_in_threadpool(store_variant, image_hash, variant, legacy_image)
+
+    return FileResponse(image_store.path(image_hash, extension), media_type=media_type, headers=headers)
+
+
+def store_variant(image_hash: str, variant: str, legacy_image: bytes = None):
+    """
+    :param image_hash: hash of the still map image
+    :param variant: one of image_pipeline.VARIANTS
+    :param legacy_image: image of a row stored before the image store, None to read it from the store
+    """
+    content = legacy_image if legacy_image is not None else image_store.read(image_hash)
+    image_store.put_variant(image_hash, make_variant(content, variant), VARIANTS[variant][0])
+
+
+def derive_stillmap(lat: float, lon: float, zoom: int, size: str, db: Session):
+    """
+    Makes the requested map from a stored map covering it, the result is stored as a still map of its own
+    :param lat: latitude of the requested center
+    :param lon: longitude of the requested center
+    :param zoom: requested zoom
+    :param size: requested size, e.g. 500x500
+    :param db: DB connection session
+    :return: same dict as get_stillmap, None when no stored map covers the request
+    """
+    target_size = parse_size(size)
+    if not STILLMAP_DERIVE_ENABLED or not pillow_available() or target_size is None:
+        return None
+
+    with span("derive_stillmap"):
+        # only maps from Mappls are sources, a derived map is already resized and would lose sharpness again
+        rows = (db.query(models.StillMap.id, models.StillMap.image_hash, models.StillMap.zoom, models.StillMap.size,
+                         func.ST_Y(models.StillMap.center), func.ST_X(models.StillMap.center),
+                         models.StillMap.source_id).
+                filter(within_distance(models.StillMap.center, lon, lat, STILLMAP_DERIVE_DISTANCE),
+                       models.StillMap.image_hash.isnot(None),
+                       models.StillMap.source_id.is_(None)).
+                order_by(nearest_first(models.StillMap.center, lon, lat)).
+                limit(STILLMAP_DERIVE_CANDIDATES).all())
+        sources = [{"id": row[0], "image_hash": row[1], "zoom": row[2], "size": parse_size(row[3] or ""),
+                    "lat": row[4], "lon": row[5], "source_id": row[6]} for row in rows]
+        found = best_source(sources, lat, lon, zoom, target_size)
+        if found is None:
+            return None
+
+        source, box = found
+        content = derive_image(image_store.read(source["image_hash"]), box, target_size)
+        image_hash = image_store.put(content)
+        new_stillmap = models.StillMap(
+            center=WKTElement(f'POINT({lon} {lat})', srid=4326),
+            zoom=zoom,
+            size=size,
+            image_hash=image_hash,
+            content_type="image/png",
+            size_bytes=len(content),
+            source_id=source["id"]
+        )
+        persist(db, new_stillmap)
+        cache_lookup("stillmap", "derived")
+
+    return {
+        "id": new_stillmap.id,
+        "center": [lon, lat],
+        "map_img": content,
+        "image_url": stillmap_image_url(new_stillmap.id)
+    }
+
+
+def stillmap_image_url(stillmap_id) -> str:
+    """
+    :param stillmap_id: id of the still map
+    :return: url of the binary image endpoint
+    """
+    return f"/stillmap/{stillmap_id}.png"
+
+
+def read_stillmap_image(still_map: models.StillMap) -> bytes:
+    """
+    :param still_map: still map row
+    :return: image bytes, from the image store or from DB for rows stored before it
+    """
+    if still_map.image_hash:
+        return image_store.read(still_map.image_hash)
+    return still_map.map_img
@@ -0,0 +1,86 @@
+"""
+ migrate.py contains the schema migration of the DB, run it once on deploy before the app is started
+ how to run?
+    python -m urbo_api.urbo_api_dataload.migrate
+ it creates the missing tables (importing the app does not touch the schema), adds the columns and indexes missing
+ on existing tables, fills created_at of the old air pollution rows and creates the air quality history partitions
+ every step can be run again, nothing is changed when the schema is up to date
+"""
+import logging
+from datetime import datetime, timezone
+
+from sqlalchemy import inspect, text
+
+from urbo_api.db_connect.db import engine
+from urbo_api.urbo_api_dataload import models
+from urbo_api.urbo_api_dataload.air_quality_history_api import ensure_partitions, month_start, next_month
+
+logger = logging.getLogger(__name__)
+
+# OpenWeather measurement time (unix seconds) of the first entry of a stored air pollution response
+AIR_POLLUTION_DT = "(air_pollution_response -> 0 ->> 'dt')"
+
+
+def upgrade_tables(bind):
+    """
+    Adds the columns and indexes missing on existing tables
+    a new column is added without its default, so existing rows stay null instead of getting the migration time,
+    the default is set afterwards and only applies to new rows
+    :param bind: DB engine
+    """
+    inspector = inspect(bind)
+    with bind.begin() as connection:
+        for table in models.Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+
+            existing_columns = {column["name"]: column for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns:
+                    if column.nullable and not existing_columns[column.name]["nullable"]:
+                        connection.execute(text(f'ALTER TABLE {table.name} ALTER COLUMN {column.name} DROP NOT NULL'))
+                    continue
+
+                logger.info("Adding column %s.%s", table.name, column.name)
+                connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN IF NOT EXISTS {column.name} '
+                                        f'{column.type.compile(dialect=bind.dialect)}'))
+                if column.server_default is not None:
+                    connection.execute(text(f'ALTER TABLE {table.name} ALTER COLUMN {column.name} SET DEFAULT '
+                                            f'{column.server_default.arg.compile(dialect=bind.dialect)}'))
+
+    for table in models.Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=bind, checkfirst=True)
+
+
+def backfill_air_pollution_created_at(bind) -> int:
+    """
+    Fills the missing created_at of stored air pollution rows with the measurement time of their response,
+    it is never later than the fetch, rows without a measurement time stay null and are handled as stale
+    :param bind: DB engine
+    :return: number of rows filled
+    """
+    with bind.begin() as connection:
+        result = connection.execute(text(
+            f"UPDATE {models.AirPollution.__tablename__} "
+            f"SET created_at = to_timestamp({AIR_POLLUTION_DT}::double precision) "
+            f"WHERE created_at IS NULL AND {AIR_POLLUTION_DT} ~ '^[0-9]+$'"))
+    return result.rowcount
+
+
+def migrate(bind=engine):
+    """
+    Brings the DB schema up to date
+    :param bind: DB engine
+    """
+    models.Base.metadata.create_all(bind=bind)
+    upgrade_tables(bind)
+    logger.info("Filled created_at of %s air pollution rows", backfill_air_pollution_created_at(bind))
+    # partitions of the air quality history for this month and the next, later months are added when stored
+    this_month = month_start(datetime.now(timezone.utc))
+    ensure_partitions(bind, [this_month, next_month(this_month)])
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    migrate()
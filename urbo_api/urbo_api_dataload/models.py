@@ -1,45 +1,109 @@
 """
 models.py file maintains the table structure with table name
 """
-from sqlalchemy import Column, JSON, String, Float, LargeBinary
+from sqlalchemy import (Column, JSON, String, Float, LargeBinary, Index, DateTime, Integer, Boolean, UniqueConstraint,
+                        SmallInteger, func)
 from urbo_api.db_connect.db import Base
 from geoalchemy2 import Geography, Geometry
 import uuid
-from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.dialects.postgresql import REAL, UUID
 
 
 class NearbyPlace(Base):
     __tablename__ = "nearby_places"
+    __table_args__ = (
+        Index("idx_nearby_places_ref_location", "ref_location", postgresql_using="gist"),
+    )
 
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4, index=True)
+    # one keyword per row, so a multi keyword request can be served from the stored keywords
     keywords = Column(String, index=True)
-    ref_location = Column(Geography(geometry_type='POINT', srid=4326))
+    ref_location = Column(Geography(geometry_type='POINT', srid=4326, spatial_index=False))
+    radius = Column(Integer)
+    region = Column(String)
+    # every place of the searched area is in the places table, so later queries inside it are answered locally
+    complete = Column(Boolean)
     nearby_places_response = Column(JSON)
 
 
+class Place(Base):
+    __tablename__ = "places"
+    __table_args__ = (
+        UniqueConstraint("eloc", "keyword", name="uq_places_eloc_keyword"),
+        Index("idx_places_location", "location", postgresql_using="gist"),
+    )
+
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4, index=True)
+    eloc = Column(String, nullable=False)
+    keyword = Column(String, nullable=False, index=True)
+    name = Column(String)
+    category = Column(String, index=True)
+    location = Column(Geography(geometry_type='POINT', srid=4326, spatial_index=False), nullable=False)
+    place_response = Column(JSON)
+
+
 class Geocode(Base):
     __tablename__ = "geocode"
+    __table_args__ = (
+        Index("idx_geocode_ref_location", "ref_location", postgresql_using="gist"),
+    )
 
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4, index=True)
     address = Column(String, index=True)
     latitude = Column(Float, nullable=False)
     longitude = Column(Float, nullable=False)
-    ref_location = Column(Geometry(geometry_type='POINT', srid=4326))
+    ref_location = Column(Geometry(geometry_type='POINT', srid=4326, spatial_index=False))
     geocode_response = Column(JSON)
 
 
 class StillMap(Base):
     __tablename__ = "stillmap"
+    __table_args__ = (
+        Index("idx_stillmap_center", "center", postgresql_using="gist"),
+    )
 
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4, index=True)
-    center = Column(Geometry(geometry_type='POINT', srid=4326))
-    map_img = Column(LargeBinary, nullable=False)
+    center = Column(Geometry(geometry_type='POINT', srid=4326, spatial_index=False))
+    zoom = Column(Integer)
+    size = Column(String)
+    # the image itself is in the image store, map_img is only set on rows stored before it
+    image_hash = Column(String(64), index=True)
+    content_type = Column(String)
+    size_bytes = Column(Integer)
+    map_img = Column(LargeBinary, nullable=True)
+    # set on maps cropped or resized from another stored map instead of requested from Mappls
+    source_id = Column(UUID(as_uuid=True), nullable=True)
 
 
 class AirPollution(Base):
     __tablename__ = "airpollution"
+    __table_args__ = (
+        Index("idx_airpollution_center_coordinates", "center_coordinates", postgresql_using="gist"),
+    )
 
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4, index=True)
-    center_coordinates = Column(Geometry(geometry_type='POINT', srid=4326))
+    center_coordinates = Column(Geometry(geometry_type='POINT', srid=4326, spatial_index=False))
     air_pollution_response = Column(JSON)
+    # null on rows stored before the column existed whose fetch time is unknown, they count as stale
+    created_at = Column(DateTime(timezone=True), nullable=True, server_default=func.now(), index=True)
+
+
+class AirQualityReading(Base):
+    """
+    One air pollution component measured at a location and time, the table is partitioned by month
+    (see air_quality_history_api.ensure_partitions)
+    """
+    __tablename__ = "air_quality_readings"
+    __table_args__ = (
+        Index("idx_air_quality_readings_location", "location", postgresql_using="gist"),
+        # rows arrive in time order, a BRIN index stays tiny and still skips the blocks outside the time range
+        Index("idx_air_quality_readings_measured_at", "measured_at", postgresql_using="brin"),
+        {"postgresql_partition_by": "RANGE (measured_at)"},
+    )
 
+    # the primary key has to contain the partition key, it also keeps a reading fetched twice stored once
+    location = Column(Geometry(geometry_type='POINT', srid=4326, spatial_index=False), primary_key=True)
+    measured_at = Column(DateTime(timezone=True), primary_key=True)
+    # code of the component, see air_quality_history_api.COMPONENT_CODES
+    component = Column(SmallInteger, primary_key=True)
+    value = Column(REAL, nullable=False)
@@ -1,7 +1,8 @@
 """
  schema.py file contains all the pydantic schema designed to integrate validation of api and DB tables
 """
-from typing import List, Any, Optional
+from datetime import datetime
+from typing import Dict, List, Any, Literal, Optional
 from pydantic import BaseModel, Field
 import uuid
 
@@ -13,6 +14,12 @@ class UrbanPlanningByPlaceCreate(BaseModel):
     radius: Optional[int] = 1000
     zoom: int = Field(12, example=14)
     size: str = Field("1000x1000", example="1000x1000")
+    # when false the still map is returned as url instead of base64 image
+    inline_map_image: bool = Field(True, example=False)
+    # parts of the aggregate response to build, all of them when not given
+    # nearby_places_count gives the count and recommendation without the places themselves
+    sections: Optional[List[Literal["nearby_places", "nearby_places_count", "air_quality", "still_map",
+                                    "pollutants_info"]]] = Field(None, example=["air_quality", "nearby_places_count"])
 
 
 class PollutantSchema(BaseModel):
@@ -26,13 +33,45 @@ class AggregateResponse(BaseModel):
     address: str = Field(..., example="New Delhi")
     latitude: float = Field(..., example=77.2090)
     longitude: float = Field(..., example=28.6139)
-    Nearby_places: Any
-    nearby_places_recommendation: str
-    air_quality_index: int
-    aqi_recommendation: str
-    air_pollution_params: Any
-    pollutants_info: List[PollutantSchema]
-    still_map_image: str
+    Nearby_places: Any = None
+    nearby_places_count: Optional[int] = None
+    nearby_places_recommendation: Optional[str] = None
+    recommendation_score: Optional[float] = None
+    air_quality_index: Optional[int] = None
+    aqi_recommendation: Optional[str] = None
+    air_pollution_params: Any = None
+    air_quality_updated_at: Optional[datetime] = None
+    air_quality_stale: bool = False
+    pollutants_info: Optional[List[PollutantSchema]] = None
+    still_map_image: Optional[str] = None
+    still_map_url: Optional[str] = None
+    still_map_stale: bool = False
+    # sections left empty because their 3rd party api service failed (nearby_places, air_quality, still_map)
+    degraded_sections: List[str] = []
+
+
+class RecommendationCityInput(BaseModel):
+    address: Optional[str] = Field(None, example="New Delhi")
+    radius: int = Field(1000, gt=0, example=1000)
+    aqi: Optional[int] = Field(None, example=3)
+    # number of places found for each searched keyword
+    place_counts: Dict[str, int] = Field({}, example={"parks": 12, "schools": 4})
+
+
+class RuleResult(BaseModel):
+    name: str = Field(..., example="parks")
+    metric: str = Field(..., example="places")
+    passed: bool
+    value: float = Field(..., example=12)
+    threshold: float = Field(..., example=10)
+    message: Optional[str] = None
+
+
+class RecommendationScore(BaseModel):
+    address: Optional[str] = Field(None, example="New Delhi")
+    # weighted share of the rules with data which passed, 0 to 100, None when no rule had data
+    score: Optional[float] = Field(None, example=66.7)
+    rules: List[RuleResult] = []
 
 
 class NearbyPlacesCreate(BaseModel):
@@ -43,7 +82,7 @@ class NearbyPlacesCreate(BaseModel):
 
 
 class NearbyPlaceResponse(BaseModel):
-    id: uuid.UUID
+    id: Optional[uuid.UUID] = None
     keywords: List[str] = Field(..., example=["parks"])
     ref_location: List[float] = Field(..., example=[28.6139, 77.2090])
     nearby_places_response: Any
@@ -72,6 +111,12 @@ class GeocodeResponse(BaseModel):
         orm_mode = True
 
 
+class GeocodePoint(BaseModel):
+    address: str = Field(..., example="New Delhi")
+    latitude: float = Field(..., example=28.6139)
+    longitude: float = Field(..., example=77.2090)
+
+
 class StillMapImageCreate(BaseModel):
     center: List[float] = Field(..., example=[28.6139, 77.2090])
     zoom: int = Field(..., example=14)
@@ -82,6 +127,7 @@ class StillMapImageResponse(BaseModel):
     id: uuid.UUID
     center: List[float] = Field(..., example=[28.6139, 77.2090])
     map_img: bytes
+    image_url: Optional[str] = None
 
     class Config:
         arbitrary_types_allowed = True
@@ -119,3 +165,81 @@ class AirPollutionResponse(BaseModel):
 
     class Config:
         orm_mode = True
+
+
+class AirQualityStats(BaseModel):
+    mean: float = Field(..., example=42.7)
+    min: float = Field(..., example=18.2)
+    max: float = Field(..., example=97.4)
+    p50: float = Field(..., example=39.1)
+    p90: float = Field(..., example=71.3)
+    p95: float = Field(..., example=84.6)
+    count: int = Field(..., example=24)
+
+
+class AirQualityHistoryBucket(BaseModel):
+    bucket: datetime
+    components: Dict[str, AirQualityStats]
+
+
+class AirQualityHistoryResponse(BaseModel):
+    center_coordinates: Coordinates
+    start: datetime
+    end: datetime
+    interval: str = Field(..., example="day")
+    buckets: List[AirQualityHistoryBucket]
+
+
+class Bounds(BaseModel):
+    north: float = Field(..., example=28.6588)
+    south: float = Field(..., example=28.5690)
+    east: float = Field(..., example=77.2601)
+    west: float = Field(..., example=77.1579)
+
+
+class AirQualityHeatmapResponse(BaseModel):
+    address: str = Field(..., example="New Delhi")
+    center_coordinates: Coordinates
+    bounds: Bounds
+    component: str = Field(..., example="aqi")
+    grid: int = Field(..., example=3)
+    resolution: int = Field(..., example=64)
+    sampled_points: int = Field(..., example=9)
+    failed_points: int = Field(..., example=0)
+    # some points could not be loaded (OpenWeather down or its rate limit reached), the surface is interpolated
+    # from the other points
+    partial: bool = Field(..., example=False)
+    min: float = Field(..., example=2)
+    max: float = Field(..., example=4)
+    # resolution x resolution values, row 0 is the north edge and column 0 the west edge
+    values: List[List[float]]
+
+
+class TransportGap(BaseModel):
+    lat: float = Field(..., example=28.6201)
+    lon: float = Field(..., example=77.2154)
+    # None when there is no hub at all
+    nearest_hub_distance: Optional[float] = Field(None, example=1240)
+
+
+class PublicTransportDensityResponse(BaseModel):
+    address: str = Field(..., example="New Delhi")
+    center_coordinates: Coordinates
+    bounds: Bounds
+    radius: int = Field(..., example=2000)
+    grid: int = Field(..., example=20)
+    cell_size: float = Field(..., example=200)
+    keywords: List[str] = Field(..., example=["bus stop", "metro station"])
+    hubs: int = Field(..., example=14)
+    hubs_per_km2: float = Field(..., example=1.11)
+    # share of the circle within walk_distance of a hub, 0 to 1
+    coverage: float = Field(..., example=0.62)
+    walk_distance: float = Field(..., example=500)
+    score: float = Field(..., example=61.4)
+    # uncovered cells of the circle, the farthest from a hub first
+    gaps: List[TransportGap] = []
+    # grid x grid values, row 0 is the north edge and column 0 the west edge
+    counts_per_km2: List[List[float]]
+    kernel_density: List[List[float]]
+    # None when there is no hub at all
+    nearest_hub_distance: List[List[Optional[float]]]
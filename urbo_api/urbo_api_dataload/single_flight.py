@@ -0,0 +1,91 @@
+"""
+ single_flight.py coalesces identical in-flight calls: the first caller of a key does the work,
+ the callers arriving while it runs wait for it and share its result (or its error)
+"""
+import asyncio
+import threading
+
+
+class SingleFlight:
+    """
+    Single-flight for blocking functions called from threads (threadpool endpoints, background workers)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func, *args):
+        """
+        :param key: hashable key identifying the call
+        :param func: function doing the work, it runs in the thread of the first caller
+        :param args: arguments for func
+        :return: result of func
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args)
+            return call.result
+        except BaseException as exc:
+            call.error = exc
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class AsyncSingleFlight:
+    """
+    Single-flight for coroutines, the work runs as its own task so a caller going away does not cancel it
+    for the others
+    """
+
+    def __init__(self):
+        self._calls = {}
+
+    async def do(self, key, func, *args):
+        """
+        :param key: hashable key identifying the call
+        :param func: coroutine function doing the work
+        :param args: arguments for func
+        :return: result of func
+        """
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func(*args))
+            self._calls[key] = task
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+
+        return await asyncio.shield(task)
+
+
+def location_key(latitude: float, longitude: float):
+    """
+    :param latitude: latitude
+    :param longitude: longitude
+    :return: coordinates rounded to about 10 meters, so the same place looked up twice gives the same key
+    """
+    return round(latitude, 4), round(longitude, 4)
+
+
+# shared by the upstream calls (geocode, nearby places, air pollution, still map), keys start with the call name
+upstream_flight = SingleFlight()
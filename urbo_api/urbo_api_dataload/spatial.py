@@ -0,0 +1,65 @@
+"""
+ spatial.py contains helpers to look up stored points near a coordinate instead of comparing them by exact equality
+ the filters are written so PostGIS can use the GiST index of the column (ST_DWithin and KNN <-> ordering)
+"""
+import math
+import os
+
+from dotenv import load_dotenv
+from geoalchemy2 import Geography, WKTElement
+from sqlalchemy import and_, cast, func
+
+# load environment variable
+load_dotenv()
+# any stored point within this distance (meters) counts as a cache hit
+CACHE_DISTANCE_TOLERANCE = float(os.getenv("CACHE_DISTANCE_TOLERANCE", "50"))
+
+METERS_PER_DEGREE = 111320
+
+
+def make_point(lon: float, lat: float):
+    """
+    :param lon: longitude
+    :param lat: latitude
+    :return: point with srid 4326
+    """
+    return WKTElement(f'POINT({lon} {lat})', srid=4326)
+
+
+def within_distance(column, lon: float, lat: float, distance: float = CACHE_DISTANCE_TOLERANCE):
+    """
+    Filter expression matching the rows whose point column is within distance meters of (lon, lat)
+    :param column: Geometry or Geography point column with srid 4326
+    :param lon: longitude
+    :param lat: latitude
+    :param distance: distance in meters
+    :return: sqlalchemy filter expression
+    """
+    point = make_point(lon, lat)
+
+    if isinstance(column.type, Geography):
+        return func.ST_DWithin(column, cast(point, Geography(srid=4326)), distance)
+
+    # Geometry columns are in degrees, the first check is a bounding box in degrees which uses the GiST index,
+    # the second one is the exact distance in meters on the spheroid
+    degrees = distance / (METERS_PER_DEGREE * max(math.cos(math.radians(lat)), 0.01))
+    return and_(
+        func.ST_DWithin(column, point, degrees),
+        func.ST_DWithin(cast(column, Geography(srid=4326)), cast(point, Geography(srid=4326)), distance)
+    )
+
+
+def nearest_first(column, lon: float, lat: float):
+    """
+    Order by expression returning the closest point first (KNN, uses the GiST index)
+    :param column: Geometry or Geography point column with srid 4326
+    :param lon: longitude
+    :param lat: latitude
+    :return: sqlalchemy order by expression
+    """
+    point = make_point(lon, lat)
+
+    if isinstance(column.type, Geography):
+        return column.distance_centroid(cast(point, Geography(srid=4326)))
+
+    return column.distance_centroid(point)
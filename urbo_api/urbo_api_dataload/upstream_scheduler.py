@@ -0,0 +1,240 @@
+"""
+ upstream_scheduler.py contains the rate limiter in front of the 3rd party api services (HERE, Mapple, OpenWeather)
+ each provider has a token bucket (requests per second + burst) and an optional daily quota,
+ callers waiting for a token are served by priority: interactive requests first, then batch, then prefetch
+ the limiter state lives in each process, with several uvicorn workers every worker gets its share of the limits:
+ rate, burst and daily quota are divided by UPSTREAM_WORKERS (default WEB_CONCURRENCY, the uvicorn worker count),
+ so all the workers together stay within the configured limits of the provider
+"""
+import contextvars
+import heapq
+import itertools
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from enum import IntEnum
+from typing import Optional
+
+from dotenv import load_dotenv
+from fastapi import APIRouter, HTTPException, Request
+
+# load environment variable
+load_dotenv()
+
+HERE = "here"
+MAPPLE = "mapple"
+OPENWEATHER = "openweather"
+PROVIDERS = (HERE, MAPPLE, OPENWEATHER)
+
+# requests per second, burst and daily quota (0 means no quota) of each provider,
+# e.g. HERE_RATE_LIMIT, MAPPLE_BURST, OPENWEATHER_DAILY_QUOTA
+DEFAULT_LIMITS = {
+    HERE: {"rate": 5, "burst": 10, "daily_quota": 0},
+    MAPPLE: {"rate": 10, "burst": 20, "daily_quota": 0},
+    OPENWEATHER: {"rate": 1, "burst": 10, "daily_quota": 0},
+}
+# processes sharing the limits above, each one gets limits / UPSTREAM_WORKERS
+UPSTREAM_WORKERS = max(int(os.getenv("UPSTREAM_WORKERS", os.getenv("WEB_CONCURRENCY", "1"))), 1)
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0
+    BATCH = 1
+    PREFETCH = 2
+
+
+# longest time (seconds) a caller of each priority waits for a token before giving up
+QUEUE_TIMEOUTS = {
+    Priority.INTERACTIVE: float(os.getenv("UPSTREAM_QUEUE_TIMEOUT_INTERACTIVE", "5")),
+    Priority.BATCH: float(os.getenv("UPSTREAM_QUEUE_TIMEOUT_BATCH", "30")),
+    Priority.PREFETCH: float(os.getenv("UPSTREAM_QUEUE_TIMEOUT_PREFETCH", "60")),
+}
+
+# priority of the upstream calls made by the current request or background job,
+# it follows the request into run_in_threadpool and asyncio tasks
+upstream_priority = contextvars.ContextVar("upstream_priority", default=Priority.INTERACTIVE)
+
+
+class ProviderLimiter:
+    """
+    Token bucket and daily quota of one provider, callers wait on it in priority order
+    """
+
+    def __init__(self, name: str, rate: float, burst: int, daily_quota: int = 0):
+        """
+        :param name: provider name
+        :param rate: tokens added per second
+        :param burst: size of the bucket
+        :param daily_quota: requests allowed per UTC day, 0 for no quota
+        """
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.daily_quota = daily_quota
+
+        self._condition = threading.Condition()
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._day = _utc_today()
+        self._used_today = 0
+        self._waiting = []
+        self._sequence = itertools.count()
+
+    def acquire(self, priority: Priority = Priority.INTERACTIVE, timeout: Optional[float] = None):
+        """
+        Takes one token, waiting behind the callers of higher priority (and earlier callers of the same priority)
+        :param priority: priority of the call
+        :param timeout: seconds to wait at most, default depends on the priority
+        """
+        timeout = QUEUE_TIMEOUTS[priority] if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        entry = (int(priority), next(self._sequence))
+
+        with self._condition:
+            self._check_quota()
+            heapq.heappush(self._waiting, entry)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    ready_at = max(self._paused_until, now + (1 - self._tokens) / self.rate if self._tokens < 1 else now)
+
+                    if self._waiting[0] == entry and ready_at <= now:
+                        # callers which were already waiting when the quota got used up must not get a token
+                        self._check_quota()
+                        heapq.heappop(self._waiting)
+                        self._tokens -= 1
+                        self._used_today += 1
+                        self._condition.notify_all()
+                        return
+
+                    if ready_at > deadline or now >= deadline:
+                        raise HTTPException(status_code=503,
+                                            detail=f"Upstream {self.name} rate limit reached, try again later",
+                                            headers={"Retry-After": str(max(1, round(ready_at - now)))})
+
+                    self._condition.wait(max(min(ready_at, deadline) - now, 0.001))
+            except BaseException:
+                if entry in self._waiting:
+                    self._waiting.remove(entry)
+                    heapq.heapify(self._waiting)
+                    self._condition.notify_all()
+                raise
+
+    def pause(self, seconds: float):
+        """
+        Stops handing out tokens, used when the provider answered 429 with a Retry-After header
+        :param seconds: seconds to pause
+        """
+        with self._condition:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def budget(self) -> dict:
+        """
+        :return: current state of the bucket and the daily quota
+        """
+        with self._condition:
+            now = time.monotonic()
+            self._refill(now)
+            return {
+                "rate_per_second": self.rate,
+                "burst": self.burst,
+                "tokens_available": int(self._tokens),
+                "daily_quota": self.daily_quota or None,
+                "used_today": self._used_today,
+                "remaining_today": max(self.daily_quota - self._used_today, 0) if self.daily_quota else None,
+                "queued": len(self._waiting),
+                "paused_for_seconds": round(max(self._paused_until - now, 0), 1)
+            }
+
+    def _refill(self, now: float):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+        today = _utc_today()
+        if today != self._day:
+            self._day = today
+            self._used_today = 0
+
+    def _check_quota(self):
+        self._refill(time.monotonic())
+        if self.daily_quota and self._used_today >= self.daily_quota:
+            tomorrow = datetime.combine(self._day + timedelta(days=1), datetime.min.time(), tzinfo=timezone.utc)
+            retry_after = (tomorrow - datetime.now(timezone.utc)).total_seconds()
+            raise HTTPException(status_code=503, detail=f"Upstream {self.name} daily quota used up",
+                                headers={"Retry-After": str(max(1, round(retry_after)))})
+
+
+class UpstreamScheduler:
+    """
+    One limiter per provider, configured from the environment
+    """
+
+    def __init__(self, limits: Optional[dict] = None):
+        """
+        :param limits: provider -> dict with rate, burst and daily_quota, default read from the environment
+        """
+        limits = limits or {provider: provider_limits(provider) for provider in PROVIDERS}
+        self.limiters = {provider: ProviderLimiter(provider, **values) for provider, values in limits.items()}
+
+    def acquire(self, provider: str, priority: Optional[Priority] = None, timeout: Optional[float] = None):
+        """
+        :param provider: provider name, calls to an unknown provider are not limited
+        :param priority: priority of the call, default is the priority of the current request
+        :param timeout: seconds to wait at most, default depends on the priority
+        """
+        limiter = self.limiters.get(provider)
+        if limiter is not None:
+            limiter.acquire(upstream_priority.get() if priority is None else priority, timeout)
+
+    def pause(self, provider: str, seconds: float):
+        limiter = self.limiters.get(provider)
+        if limiter is not None:
+            limiter.pause(seconds)
+
+    def budget(self) -> dict:
+        """
+        :return: provider -> remaining budget
+        """
+        return {provider: limiter.budget() for provider, limiter in self.limiters.items()}
+
+
+def provider_limits(provider: str, workers: int = UPSTREAM_WORKERS) -> dict:
+    """
+    :param provider: provider name
+    :param workers: processes sharing the limits
+    :return: rate, burst and daily quota of the provider from the environment, share of one process
+    """
+    prefix = provider.upper()
+    defaults = DEFAULT_LIMITS[provider]
+    daily_quota = int(os.getenv(f"{prefix}_DAILY_QUOTA", defaults["daily_quota"]))
+    return {
+        "rate": float(os.getenv(f"{prefix}_RATE_LIMIT", defaults["rate"])) / workers,
+        "burst": max(int(os.getenv(f"{prefix}_BURST", defaults["burst"])) // workers, 1),
+        # a quota stays a quota, every worker may send at least one request a day
+        "daily_quota": max(daily_quota // workers, 1) if daily_quota else 0
+    }
+
+
+def _utc_today():
+    return datetime.now(timezone.utc).date()
+
+
+router = APIRouter(
+    tags=["upstream"],
+    responses={404: {"description": "Not Found"}}
+)
+
+
+@router.get("/upstream/budget")
+def get_upstream_budget(request: Request):
+    """
+    Remaining rate limit and daily quota of each 3rd party api service in this worker, helps planning bulk loads
+    :param request: incoming request, gives access to the shared http client
+    :return: provider -> tokens available, used and remaining daily quota, queued callers, circuit state
+    """
+    http = request.app.state.http_client
+    return {provider: {**budget, "circuit": http.breakers[provider].state}
+            for provider, budget in http.scheduler.budget().items()}
@@ -1,21 +1,68 @@
 """
  utils.py helps to generate bearer token from 3rd party api service (Mapple service)
+ the token is cached until shortly before it expires and refreshed only once for all concurrent requests
 """
-import requests
 import os
+import threading
+import time
 from dotenv import load_dotenv
+from fastapi import HTTPException
+from urbo_api.urbo_api_dataload.http_client import UpstreamClient
+from urbo_api.urbo_api_dataload.upstream_scheduler import MAPPLE
 
 # loads data from .env file
 load_dotenv()
 MAPPLE_TOKEN_URL = os.getenv('TOKEN_URL')
 CLIENT_ID = os.getenv('CLIENT_ID')
 CLIENT_SECRET = os.getenv('CLIENT_SECRET')
+# seconds before expires_in at which the cached token is considered expired
+TOKEN_REFRESH_MARGIN = int(os.getenv('MAPPLE_TOKEN_REFRESH_MARGIN', '60'))
+# used when the token endpoint does not send expires_in
+DEFAULT_TOKEN_EXPIRES_IN = 3600
 
 
-def get_mapple_token():
+class MappleTokenManager:
+    """
+    Keeps the Mapple access token in memory and refreshes it when it is about to expire.
+    The refresh happens under a lock, so concurrent requests wait for one refresh instead of starting their own.
+    """
+
+    def __init__(self, refresh_margin: int = TOKEN_REFRESH_MARGIN):
+        self.refresh_margin = refresh_margin
+        self._token = None
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+
+    def get_token(self, http: UpstreamClient, expired_token: str = None):
+        """
+        :param http: shared upstream http client
+        :param expired_token: token rejected by Mapple (401), forces a refresh unless it was already replaced
+        :return: access_token
+        """
+        if self._is_valid(expired_token):
+            return self._token
+
+        with self._lock:
+            # another request may have refreshed the token while this one was waiting for the lock
+            if self._is_valid(expired_token):
+                return self._token
+
+            access_token, expires_in = request_mapple_token(http)
+            self._token = access_token
+            self._expires_at = time.monotonic() + max(expires_in - self.refresh_margin, 0)
+            return self._token
+
+    def _is_valid(self, expired_token: str = None):
+        return (self._token is not None
+                and self._token != expired_token
+                and time.monotonic() < self._expires_at)
+
+
+def request_mapple_token(http: UpstreamClient):
     """
     Based on provided client id, client secret it generates the bearer token
-    :return: access_token
+    :param http: shared upstream http client
+    :return: access_token and its lifetime in seconds
     """
     headers = {
         'Content-Type': 'application/x-www-form-urlencoded',
@@ -26,8 +73,23 @@ def get_mapple_token():
         'client_id': CLIENT_ID,
         'client_secret': CLIENT_SECRET,
     }
-    response = requests.post(MAPPLE_TOKEN_URL, headers=headers, data=data)
+    response = http.post(MAPPLE_TOKEN_URL, provider=MAPPLE, headers=headers, data=data)
     if response.status_code == 200:
-        return response.json()['access_token']
+        data = response.json()
+        return data['access_token'], int(data.get('expires_in', DEFAULT_TOKEN_EXPIRES_IN))
     else:
-        raise Exception('Failed to fetch token')
+        # without a token no Mapple data can be fetched, the service is unavailable whatever the reason
+        raise HTTPException(status_code=503, detail="Failed to fetch token from Mapple API")
+
+
+mapple_token_manager = MappleTokenManager()
+
+
+def get_mapple_token(http: UpstreamClient, expired_token: str = None):
+    """
+    Gives the cached bearer token, a new one is generated only when it is expired
+    :param http: shared upstream http client
+    :param expired_token: token rejected by Mapple (401), forces a refresh
+    :return: access_token
+    """
+    return mapple_token_manager.get_token(http, expired_token)
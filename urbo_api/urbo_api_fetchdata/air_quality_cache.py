@@ -0,0 +1,164 @@
+"""
+ air_quality_cache.py contains the freshness aware cache of air pollution data
+ fresh rows are served as they are, stale rows are served right away while one background refresh fetches new data
+ rows older than the stale limit are not served, the data is requested from OpenWeather API,
+ unless OpenWeather fails, then the latest row is served whatever its age, flagged as stale
+ rows without created_at (stored before the column was added and not backfilled by the migration) have an unknown
+ age, they are handled as rows older than the stale limit
+"""
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+from dotenv import load_dotenv
+from fastapi import HTTPException
+from sqlalchemy.orm import Session
+
+from urbo_api.db_connect.db import SessionLocal
+from urbo_api.db_connect.local_cache import local_cache
+from urbo_api.urbo_api_dataload import models
+from urbo_api.urbo_api_dataload.air_pollution_api import get_air_pollution
+from urbo_api.urbo_api_dataload.circuit_breaker import is_upstream_failure
+from urbo_api.urbo_api_dataload.http_client import UpstreamClient
+from urbo_api.urbo_api_dataload.single_flight import location_key, upstream_flight
+from urbo_api.urbo_api_dataload.spatial import within_distance
+from urbo_api.urbo_api_dataload.upstream_scheduler import Priority, upstream_priority
+from urbo_api.urbo_api_monitoring.metrics import cache_lookup
+
+# load environment variable
+load_dotenv()
+# seconds for which stored air pollution data is served as current (OpenWeather updates it hourly)
+AIR_QUALITY_TTL = int(os.getenv("AIR_QUALITY_TTL", "3600"))
+# seconds for which stored air pollution data may still be served as stale while it is refreshed
+AIR_QUALITY_STALE_TTL = int(os.getenv("AIR_QUALITY_STALE_TTL", "10800"))
+
+logger = logging.getLogger(__name__)
+
+_refresh_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="air-quality-refresh")
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+
+def load_air_quality(latitude: float, longitude: float, http: UpstreamClient, db: Session):
+    """
+    Finds the latest air pollution data near the coordinates in DB, if it is missing or too old
+    it requests it from OpenWeather API, when that fails the latest stored data is served as stale
+    :param latitude: latitude
+    :param longitude: longitude
+    :param http: shared upstream http client
+    :param db: DB connection session
+    :return: dict with the first entry of the air pollution list (output), when it was fetched and if it is stale
+    """
+    # only fresh data is put in the local cache, and only for the rest of its freshness
+    cached = local_cache.get("air_quality", location_key(latitude, longitude))
+    if cached is not None:
+        return cached
+
+    air_pollution_result = (db.query(models.AirPollution).
+                            filter(within_distance(models.AirPollution.center_coordinates, longitude, latitude)).
+                            order_by(models.AirPollution.created_at.desc().nullslast()).first())
+
+    if air_pollution_result is not None and air_pollution_result.created_at is not None:
+        age = datetime.now(timezone.utc) - air_pollution_result.created_at
+
+        if age <= timedelta(seconds=AIR_QUALITY_STALE_TTL):
+            stale = age > timedelta(seconds=AIR_QUALITY_TTL)
+            cache_lookup("airpollution", "stale" if stale else "hit")
+            result = {
+                "output": air_pollution_result.air_pollution_response[0],
+                "fetched_at": air_pollution_result.created_at,
+                "stale": stale
+            }
+            if stale:
+                schedule_refresh(latitude, longitude, http)
+            else:
+                local_cache.set("air_quality", location_key(latitude, longitude), result,
+                                AIR_QUALITY_TTL - age.total_seconds())
+            return result
+
+    cache_lookup("airpollution", "miss")
+    try:
+        fetched = fetch_air_pollution(latitude, longitude, http, db)
+    except HTTPException as exc:
+        if air_pollution_result is None or not is_upstream_failure(exc):
+            raise
+        # OpenWeather is down or its circuit is open, the last known data is better than none
+        logger.warning("Serving stale air pollution data for %s: %s", location_key(latitude, longitude), exc.detail)
+        return {
+            "output": air_pollution_result.air_pollution_response[0],
+            "fetched_at": air_pollution_result.created_at,
+            "stale": True
+        }
+
+    result = {
+        "output": fetched['air_pollution_response'][0],
+        "fetched_at": datetime.now(timezone.utc),
+        "stale": False
+    }
+    local_cache.set("air_quality", location_key(latitude, longitude), result, AIR_QUALITY_TTL)
+    return result
+
+
+def air_quality_fetched_at(latitude: float, longitude: float, db: Session):
+    """
+    :param latitude: latitude
+    :param longitude: longitude
+    :param db: DB connection session
+    :return: when the latest air pollution data near the coordinates was fetched, None when none is stored
+    """
+    cached = local_cache.get("air_quality", location_key(latitude, longitude))
+    if cached is not None:
+        return cached["fetched_at"]
+
+    row = (db.query(models.AirPollution.created_at).
+           filter(within_distance(models.AirPollution.center_coordinates, longitude, latitude),
+                  models.AirPollution.created_at.isnot(None)).
+           order_by(models.AirPollution.created_at.desc()).first())
+    return row[0] if row is not None else None
+
+
+def fetch_air_pollution(latitude: float, longitude: float, http: UpstreamClient, db: Session):
+    """
+    Requests the air pollution data from OpenWeather API and stores it, a request already running for
+    the same location (from another request or a background refresh) is waited for instead
+    :param latitude: latitude
+    :param longitude: longitude
+    :param http: shared upstream http client
+    :param db: DB connection session
+    :return: air pollution API response
+    """
+    return upstream_flight.do(("air_pollution", *location_key(latitude, longitude)),
+                              get_air_pollution, latitude, longitude, db, http)
+
+
+def schedule_refresh(latitude: float, longitude: float, http: UpstreamClient):
+    """
+    Starts a background refresh of the air pollution data, unless one is already running for that location
+    :param latitude: latitude
+    :param longitude: longitude
+    :param http: shared upstream http client
+    """
+    key = location_key(latitude, longitude)
+
+    with _refreshing_lock:
+        if key in _refreshing:
+            return
+        _refreshing.add(key)
+
+    _refresh_executor.submit(_refresh, key, latitude, longitude, http)
+
+
+def _refresh(key, latitude: float, longitude: float, http: UpstreamClient):
+    # nobody waits for the refresh, it gets the tokens left over by the requests
+    upstream_priority.set(Priority.PREFETCH)
+    db = SessionLocal()
+    try:
+        fetch_air_pollution(latitude, longitude, http, db)
+    except Exception:
+        logger.exception("Background refresh of air pollution data failed for %s", key)
+    finally:
+        db.close()
+        with _refreshing_lock:
+            _refreshing.discard(key)
@@ -0,0 +1,169 @@
+"""
+ air_quality_heatmap.py contains the endpoint returning the air quality of a whole area as a heatmap
+ the air quality is sampled on a grid around the geocoded address (stored data is reused, only missing or too old
+ points are requested from OpenWeather API), then interpolated onto a dense grid and returned as values or PNG
+"""
+import asyncio
+import logging
+import os
+
+import numpy as np
+from dotenv import load_dotenv
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
+from fastapi.concurrency import run_in_threadpool
+
+from urbo_api.db_connect.db import async_session
+from urbo_api.urbo_api_dataload import schema
+from urbo_api.urbo_api_dataload.air_quality_history_api import COMPONENT_CODES
+from urbo_api.urbo_api_dataload.circuit_breaker import is_upstream_failure
+from urbo_api.urbo_api_dataload.http_client import UpstreamClient, get_http_client
+from urbo_api.urbo_api_dataload.schema import GeocodeCreate
+from urbo_api.urbo_api_fetchdata.air_quality_cache import load_air_quality
+from urbo_api.urbo_api_fetchdata.fetch_data import fetch_geocode, find_stored_geocode, with_session
+from urbo_api.urbo_api_fetchdata.heatmap import colorize, degrees_per_meter, encode_png, grid_coordinates, \
+    grid_offsets, idw
+from urbo_api.urbo_api_monitoring.tracing import span
+
+# load environment variable
+load_dotenv()
+# sampled points per side, each point not stored yet costs one OpenWeather call, at most burst + rate x
+# interactive queue timeout calls (10 + 1 x 5 with the default limits) get a token before the request gives up,
+# the default grid fits in the burst, a grid without any stored point at the max may miss its last points,
+# the missing points are left out of the interpolation and the heatmap is marked partial
+HEATMAP_DEFAULT_GRID = int(os.getenv("HEATMAP_DEFAULT_GRID", "3"))
+HEATMAP_MAX_GRID = int(os.getenv("HEATMAP_MAX_GRID", "4"))
+# interpolated cells per side of the returned surface
+HEATMAP_DEFAULT_RESOLUTION = int(os.getenv("HEATMAP_DEFAULT_RESOLUTION", "64"))
+HEATMAP_MAX_RESOLUTION = int(os.getenv("HEATMAP_MAX_RESOLUTION", "512"))
+# side of the area in meters
+HEATMAP_DEFAULT_EXTENT = float(os.getenv("HEATMAP_DEFAULT_EXTENT", "10000"))
+HEATMAP_MAX_EXTENT = float(os.getenv("HEATMAP_MAX_EXTENT", "50000"))
+# sampled points loaded at the same time
+HEATMAP_CONCURRENCY = int(os.getenv("HEATMAP_CONCURRENCY", "8"))
+HEATMAP_IDW_POWER = float(os.getenv("HEATMAP_IDW_POWER", "2"))
+
+# OpenWeather air quality index goes from 1 (good) to 5 (very poor), the colors of the overlay keep that scale
+AQI_RANGE = (1, 5)
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter(
+    tags=["air-pollution"],
+    responses={404: {"description": "Not Found"}}
+)
+
+
+@router.get("/air-quality/heatmap", response_model=schema.AirQualityHeatmapResponse,
+            responses={200: {"content": {"image/png": {}}}})
+async def get_air_quality_heatmap(address: str,
+                                  grid: int = Query(HEATMAP_DEFAULT_GRID, ge=2, le=HEATMAP_MAX_GRID),
+                                  extent: float = Query(HEATMAP_DEFAULT_EXTENT, gt=0, le=HEATMAP_MAX_EXTENT),
+                                  resolution: int = Query(HEATMAP_DEFAULT_RESOLUTION, ge=2,
+                                                          le=HEATMAP_MAX_RESOLUTION),
+                                  component: str = "aqi", format: str = "json",
+                                  http: UpstreamClient = Depends(get_http_client)):
+    """
+    Samples the air quality on a grid x grid square around the address and interpolates it (inverse distance
+    weighting) onto a resolution x resolution surface
+    :param address: center of the area
+    :param grid: sampled points per side
+    :param extent: side of the area in meters
+    :param resolution: cells per side of the surface
+    :param component: aqi or one of the pollutants (co, no, no2, o3, so2, pm2_5, pm10, nh3)
+    :param format: json for the values, png for a colored overlay
+    :param http: shared upstream http client
+    :return: bounds and values of the surface (row 0 is the north edge), or the PNG overlay, partial when some
+             points could not be loaded
+    """
+    if component not in COMPONENT_CODES:
+        raise HTTPException(status_code=400, detail=f"Unknown component {component}")
+    if format not in ("json", "png"):
+        raise HTTPException(status_code=400, detail="format must be json or png")
+
+    with span("geocode"):
+        async with async_session() as async_db:
+            geocode_result = await find_stored_geocode(address, async_db)
+        if geocode_result is None:
+            geocode_result = await run_in_threadpool(with_session, fetch_geocode, GeocodeCreate(address=address),
+                                                     http)
+    lat, lon = geocode_result.latitude, geocode_result.longitude
+
+    with span("sample_points"):
+        sample_lats, sample_lons = grid_coordinates(lat, lon, grid, extent)
+        values = await load_grid_values(sample_lats.ravel(), sample_lons.ravel(), component, http)
+
+    sampled = ~np.isnan(values)
+    if not sampled.any():
+        raise HTTPException(status_code=503, detail="No air quality data could be loaded for the area")
+
+    with span("interpolate"):
+        sample_y, sample_x = grid_offsets(grid, extent)
+        sample_xy = np.column_stack((sample_x.ravel(), sample_y.ravel()))[sampled]
+        target_y, target_x = grid_offsets(resolution, extent)
+        target_xy = np.column_stack((target_x.ravel(), target_y.ravel()))
+        surface = (await run_in_threadpool(idw, sample_xy, values[sampled, None], target_xy, HEATMAP_IDW_POWER)
+                   ).reshape(resolution, resolution)
+
+    lat_per_meter, lon_per_meter = degrees_per_meter(lat)
+    bounds = {
+        "north": lat + extent / 2 * lat_per_meter,
+        "south": lat - extent / 2 * lat_per_meter,
+        "east": lon + extent / 2 * lon_per_meter,
+        "west": lon - extent / 2 * lon_per_meter
+    }
+    low, high = float(values[sampled].min()), float(values[sampled].max())
+    partial = not sampled.all()
+
+    if format == "png":
+        scale = AQI_RANGE if component == "aqi" else (low, high)
+        with span("encode_png"):
+            image = await run_in_threadpool(lambda: encode_png(colorize(surface, *scale)))
+        return Response(content=image, media_type="image/png", headers={
+            "X-Heatmap-Bounds": f"{bounds['south']},{bounds['west']},{bounds['north']},{bounds['east']}",
+            "X-Heatmap-Range": f"{low},{high}",
+            "X-Heatmap-Partial": str(partial).lower()
+        })
+
+    return {
+        "address": geocode_result.address,
+        "center_coordinates": {"lon": lon, "lat": lat},
+        "bounds": bounds,
+        "component": component,
+        "grid": grid,
+        "resolution": resolution,
+        "sampled_points": int(sampled.sum()),
+        "failed_points": int((~sampled).sum()),
+        "partial": partial,
+        "min": low,
+        "max": high,
+        "values": np.round(surface, 3).tolist()
+    }
+
+
+async def load_grid_values(lats, lons, component: str, http: UpstreamClient):
+    """
+    Loads the air quality of every sampled point, HEATMAP_CONCURRENCY points at a time
+    :param lats: latitudes of the points
+    :param lons: longitudes of the points
+    :param component: aqi or one of the pollutants
+    :param http: shared upstream http client
+    :return: array with the component value of each point, nan where OpenWeather failed
+    """
+    semaphore = asyncio.Semaphore(HEATMAP_CONCURRENCY)
+
+    async def load(point_lat: float, point_lon: float):
+        async with semaphore:
+            try:
+                air_quality = await run_in_threadpool(with_session, load_air_quality, round(point_lat, 4),
+                                                      round(point_lon, 4), http)
+            except HTTPException as exc:
+                if not is_upstream_failure(exc):
+                    raise
+                logger.warning("Heatmap point %.4f,%.4f skipped: %s", point_lat, point_lon, exc.detail)
+                return np.nan
+        output = air_quality["output"]
+        value = output["main"]["aqi"] if component == "aqi" else output["components"].get(component)
+        return np.nan if value is None else float(value)
+
+    return np.array(await asyncio.gather(*(load(float(point_lat), float(point_lon))
+                                           for point_lat, point_lon in zip(lats, lons))), dtype=np.float64)
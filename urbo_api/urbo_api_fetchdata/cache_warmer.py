@@ -0,0 +1,247 @@
+"""
+ cache_warmer.py contains the background scheduler which loads the data of the configured places ahead of demand
+ each place has jobs (e.g. geocode, nearby places and still map, or air quality) run on their own interval,
+ the upstream calls are made with prefetch priority and a job is skipped while the daily quota of one of its
+ providers is nearly used up, so warming never takes the quota the users need
+ every uvicorn worker creates the warmer, a lease in the shared local cache file lets only one of them run the jobs,
+ the runs of the jobs are saved in the same file, so every worker reports them and a worker taking the lease over
+ carries on from them instead of warming every place again
+"""
+import asyncio
+import json
+import logging
+import os
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from dotenv import load_dotenv
+from fastapi import HTTPException
+
+from urbo_api.urbo_api_dataload import schema
+from urbo_api.urbo_api_dataload.upstream_scheduler import Priority, upstream_priority
+
+# load environment variable
+load_dotenv()
+# seconds between two checks of the jobs which are due
+CACHE_WARM_TICK = float(os.getenv("CACHE_WARM_TICK", "30"))
+# seconds before a failed or skipped job is tried again (at most its own interval)
+CACHE_WARM_RETRY_INTERVAL = float(os.getenv("CACHE_WARM_RETRY_INTERVAL", "300"))
+# share of the daily quota of a provider kept for the users, jobs using the provider are skipped below it
+CACHE_WARM_QUOTA_RESERVE = float(os.getenv("CACHE_WARM_QUOTA_RESERVE", "0.2"))
+# seconds the worker running the jobs keeps the lease without renewing it, another worker takes over after it
+CACHE_WARM_LEASE_TTL = float(os.getenv("CACHE_WARM_LEASE_TTL", str(max(CACHE_WARM_TICK * 3, 60))))
+
+LEASE_NAME = "cache_warmer"
+# name of the runs of the jobs in the shared state
+STATE_NAME = "cache_warmer"
+
+logger = logging.getLogger(__name__)
+
+
+class WarmJob:
+    """
+    Work done for every configured place on an interval
+    """
+
+    def __init__(self, name: str, interval: float, providers, func):
+        """
+        :param name: job name, shown in the status
+        :param interval: seconds between two runs for the same place
+        :param providers: 3rd party api services the job may call
+        :param func: async function(place, state, http), place is the configured input, state a dict kept
+                     between runs of the place (e.g. its coordinates)
+        """
+        self.name = name
+        self.interval = interval
+        self.providers = tuple(providers)
+        self.func = func
+
+
+def load_warm_config(value: Optional[str]):
+    """
+    :param value: JSON list of places, or path of a JSON file holding it, each place is the input of the
+                  aggregate endpoint (address, keywords, region, radius, zoom, size)
+    :return: list of validated places
+    """
+    if not value or not value.strip():
+        return []
+
+    if value.lstrip().startswith("["):
+        entries = json.loads(value)
+    else:
+        with open(value) as file:
+            entries = json.load(file)
+
+    return [schema.UrbanPlanningByPlaceCreate(**{"keywords": [], **entry, "inline_map_image": False})
+            for entry in entries]
+
+
+def quota_blocker(budget: dict, providers, reserve: float = CACHE_WARM_QUOTA_RESERVE):
+    """
+    :param budget: provider -> remaining budget, as returned by UpstreamScheduler.budget
+    :param providers: providers used by the job
+    :param reserve: share of the daily quota kept for the users
+    :return: reason the job must wait, None when it may run
+    """
+    for provider in providers:
+        provider_budget = budget.get(provider)
+        if provider_budget is None or not provider_budget["daily_quota"]:
+            continue
+        if provider_budget["remaining_today"] <= provider_budget["daily_quota"] * reserve:
+            return f"{provider} daily quota reserved for users"
+    return None
+
+
+def place_key(place: schema.UrbanPlanningByPlaceCreate) -> str:
+    """
+    :param place: configured place
+    :return: key of the place in the shared state, the same in every worker
+    """
+    return json.dumps(place.model_dump(mode="json"), sort_keys=True)
+
+
+class CacheWarmer:
+    """
+    Runs the jobs of every place when they are due, one at a time so warming stays a light background load
+    """
+
+    def __init__(self, places, jobs, tick: float = CACHE_WARM_TICK,
+                 retry_interval: float = CACHE_WARM_RETRY_INTERVAL, shared=None,
+                 lease_ttl: float = CACHE_WARM_LEASE_TTL):
+        """
+        :param places: configured places, see load_warm_config
+        :param jobs: list of WarmJob, run in that order for each place
+        :param tick: seconds between two checks of the due jobs
+        :param retry_interval: seconds before a failed or skipped job is tried again
+        :param shared: object with acquire_lease / release_lease / load_state / save_state shared by the workers
+                       (e.g. the local cache), the jobs only run in the worker holding the lease and their runs are
+                       saved there, None runs them in every process
+        :param lease_ttl: seconds the lease is kept without renewing it
+        """
+        self.places = list(places)
+        self.jobs = list(jobs)
+        self.tick = tick
+        self.retry_interval = retry_interval
+        self.shared = shared
+        self.lease_ttl = lease_ttl
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex}"
+        self.leader = shared is None
+        self.states = [{} for _ in self.places]
+        self.runs = [{job.name: {"last_warmed_at": None, "last_attempt_at": None, "next_run_at": None,
+                                 "last_error": None} for job in self.jobs} for _ in self.places]
+        self._task = None
+
+    def due(self, now: datetime):
+        """
+        :param now: current time
+        :return: list of (place index, job) to run now
+        """
+        due = []
+        for index, runs in enumerate(self.runs):
+            for job in self.jobs:
+                next_run_at = runs[job.name]["next_run_at"]
+                if next_run_at is None or next_run_at <= now:
+                    due.append((index, job))
+        return due
+
+    async def run_once(self, http, now: Optional[datetime] = None):
+        """
+        Runs the jobs which are due
+        :param http: shared upstream http client
+        :param now: current time, default now
+        """
+        # renewed on every tick, also when no job is due, so the lease does not expire while the leader waits
+        was_leader = self.leader
+        if not self.hold_lease():
+            return
+        if not was_leader:
+            self.load_runs()
+
+        for index, job in self.due(now or datetime.now(timezone.utc)):
+            # renewed again before every job, a worker which lost the lease stops at once
+            if not self.hold_lease():
+                return
+            run = self.runs[index][job.name]
+            run["last_attempt_at"] = datetime.now(timezone.utc)
+
+            blocker = quota_blocker(http.scheduler.budget(), job.providers)
+            if blocker is None:
+                try:
+                    await job.func(self.places[index], self.states[index], http)
+                    run["last_warmed_at"] = datetime.now(timezone.utc)
+                    run["last_error"] = None
+                except HTTPException as exc:
+                    run["last_error"] = f"{exc.status_code}: {exc.detail}"
+                except Exception as exc:
+                    logger.exception("Cache warming %s failed for %s", job.name, self.places[index].address)
+                    run["last_error"] = repr(exc)
+            else:
+                run["last_error"] = f"skipped: {blocker}"
+
+            delay = job.interval if run["last_error"] is None else min(self.retry_interval, job.interval)
+            run["next_run_at"] = run["last_attempt_at"] + timedelta(seconds=delay)
+            self.save_runs()
+
+    def hold_lease(self) -> bool:
+        """
+        :return: True when this worker may run the jobs, takes or renews the lease
+        """
+        if self.shared is not None:
+            self.leader = self.shared.acquire_lease(LEASE_NAME, self.owner, self.lease_ttl)
+        return self.leader
+
+    def load_runs(self):
+        """
+        Takes the runs saved by the previous lease holder, so the jobs it ran are only due after their interval
+        """
+        saved = self.shared.load_state(STATE_NAME) if self.shared is not None else None
+        for place, runs in zip(self.places, self.runs):
+            for name, run in ((saved or {}).get(place_key(place)) or {}).items():
+                if name in runs:
+                    runs[name].update(run)
+
+    def save_runs(self):
+        if self.shared is not None:
+            self.shared.save_state(STATE_NAME, {place_key(place): runs for place, runs in zip(self.places, self.runs)})
+
+    async def run(self, http):
+        # warming waits behind the user requests for the upstream tokens
+        upstream_priority.set(Priority.PREFETCH)
+        while True:
+            try:
+                await self.run_once(http)
+            except Exception:
+                logger.exception("Cache warming run failed")
+            await asyncio.sleep(self.tick)
+
+    def start(self, http):
+        if self.places and self._task is None:
+            self._task = asyncio.create_task(self.run(http))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.shared is not None and self.leader:
+            # another worker can take over right away
+            self.shared.release_lease(LEASE_NAME, self.owner)
+            self.leader = False
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def status(self):
+        """
+        :return: each place with the last warming, next run and last error of its jobs, read from the shared state
+                 so every worker reports the runs of the lease holder
+        """
+        saved = (self.shared.load_state(STATE_NAME) if self.shared is not None else None) or {}
+        return [{"address": place.address, "keywords": place.keywords, "radius": place.radius,
+                 "jobs": {name: dict(run) for name, run in (saved.get(place_key(place)) or runs).items()}}
+                for place, runs in zip(self.places, self.runs)]
@@ -0,0 +1,119 @@
+"""
+ cache_warming_api.py contains the warming jobs of the configured places and the endpoint reporting their status
+ the places are read from CACHE_WARM_CONFIG (JSON list or path of a JSON file), e.g.
+    CACHE_WARM_CONFIG='[{"address": "New Delhi", "keywords": ["parks", "schools"], "radius": 2000}]'
+ geocode, nearby places and still map are stored for good once loaded, their job makes sure they are there,
+ air quality goes stale after AIR_QUALITY_TTL so its job requests it again on a shorter interval, unless it is
+ still fresh enough to last until the next run (e.g. a user request just loaded it)
+ only the worker holding the cache_warmer lease of the shared local cache file runs the jobs, their runs are kept
+ in the same file
+"""
+import os
+from datetime import datetime, timedelta, timezone
+
+from dotenv import load_dotenv
+from fastapi import APIRouter
+from fastapi.concurrency import run_in_threadpool
+
+from urbo_api.db_connect.local_cache import local_cache
+
+from urbo_api.urbo_api_dataload import models, schema
+from urbo_api.urbo_api_dataload.upstream_scheduler import HERE, MAPPLE, OPENWEATHER
+from urbo_api.urbo_api_fetchdata.air_quality_cache import AIR_QUALITY_TTL, air_quality_fetched_at, \
+    fetch_air_pollution
+from urbo_api.urbo_api_fetchdata.cache_warmer import CacheWarmer, WarmJob, load_warm_config
+from urbo_api.urbo_api_fetchdata.fetch_data import fetch_geocode, load_nearby_places, load_still_map, with_session
+
+# load environment variable
+load_dotenv()
+CACHE_WARM_ENABLED = os.getenv("CACHE_WARM_ENABLED", "false").lower() == "true"
+CACHE_WARM_CONFIG = os.getenv("CACHE_WARM_CONFIG")
+# seconds between two checks that geocode, nearby places and still map of a place are stored
+CACHE_WARM_INTERVAL = float(os.getenv("CACHE_WARM_INTERVAL", "21600"))
+# seconds between two air quality requests of a place, shorter than AIR_QUALITY_TTL so it is always fresh
+CACHE_WARM_AIR_QUALITY_INTERVAL = float(os.getenv("CACHE_WARM_AIR_QUALITY_INTERVAL",
+                                                  str(max(AIR_QUALITY_TTL * 0.8, 60))))
+
+router = APIRouter(
+    tags=["cache-warming"],
+    responses={404: {"description": "Not Found"}}
+)
+
+
+def place_geocode(place: schema.UrbanPlanningByPlaceCreate, http, db):
+    """
+    :param place: configured place
+    :param http: shared upstream http client
+    :param db: DB connection session
+    :return: stored geocode of the address, requested from HERE API when it is missing
+    """
+    geocode = db.query(models.Geocode).filter(models.Geocode.address == place.address).first()
+    return geocode if geocode is not None else fetch_geocode(place, http, db)
+
+
+def warm_place_data(place: schema.UrbanPlanningByPlaceCreate, state: dict, http, db):
+    """
+    Loads geocode, nearby places and still map of the place, only the missing ones reach the 3rd party api services
+    :param place: configured place
+    :param state: kept between the runs of the place, gets its coordinates
+    :param http: shared upstream http client
+    :param db: DB connection session
+    """
+    geocode = place_geocode(place, http, db)
+    state["latitude"], state["longitude"] = geocode.latitude, geocode.longitude
+    if place.keywords:
+        load_nearby_places(place, geocode, http, db)
+    load_still_map(place, geocode, http, db)
+
+
+def warm_air_quality(place: schema.UrbanPlanningByPlaceCreate, state: dict, http, db):
+    """
+    Requests the current air quality of the place, unless the stored one is still fresh at the next run
+    :param place: configured place
+    :param state: kept between the runs of the place, has its coordinates once the place data was warmed
+    :param http: shared upstream http client
+    :param db: DB connection session
+    """
+    if "latitude" not in state:
+        geocode = place_geocode(place, http, db)
+        state["latitude"], state["longitude"] = geocode.latitude, geocode.longitude
+
+    fetched_at = air_quality_fetched_at(state["latitude"], state["longitude"], db)
+    fresh_until = fetched_at + timedelta(seconds=AIR_QUALITY_TTL) if fetched_at is not None else None
+    if fresh_until is not None and \
+            fresh_until - datetime.now(timezone.utc) > timedelta(seconds=CACHE_WARM_AIR_QUALITY_INTERVAL):
+        return
+    fetch_air_pollution(state["latitude"], state["longitude"], http, db)
+
+
+def threaded_job(func):
+    """
+    :param func: warming function taking a DB session as last argument
+    :return: async job running it in the threadpool with its own DB session
+    """
+    async def job(place, state, http):
+        await run_in_threadpool(with_session, func, place, state, http)
+    return job
+
+
+cache_warmer = CacheWarmer(
+    load_warm_config(CACHE_WARM_CONFIG) if CACHE_WARM_ENABLED else [],
+    [WarmJob("place_data", CACHE_WARM_INTERVAL, (HERE, MAPPLE), threaded_job(warm_place_data)),
+     WarmJob("air_quality", CACHE_WARM_AIR_QUALITY_INTERVAL, (HERE, OPENWEATHER), threaded_job(warm_air_quality))],
+    shared=local_cache
+)
+
+
+@router.get("/cache-warming/status")
+def get_cache_warming_status():
+    """
+    :return: whether warming runs and, for each configured place, when each job last warmed it
+    """
+    return {
+        "enabled": CACHE_WARM_ENABLED,
+        "running": cache_warmer.running,
+        # only one worker of the host runs the jobs, every worker reports their runs from the shared cache file
+        "leader": cache_warmer.leader,
+        "intervals": {job.name: job.interval for job in cache_warmer.jobs},
+        "places": cache_warmer.status()
+    }
@@ -2,20 +2,57 @@
  fetch_data.py contain the endpoint which acts on top of other apis
  if data not found in current dn then this api request the data to third party api service
 """
+import asyncio
 import base64
+import json
+import logging
+import os
+from typing import List, Optional
 
-from fastapi import APIRouter, Depends
-from geoalchemy2 import WKTElement
-from sqlalchemy.orm import Session
+from dotenv import load_dotenv
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.concurrency import run_in_threadpool
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, StreamingResponse
+from sqlalchemy import select
+from sqlalchemy.orm import Session, defer
 
-from urbo_api.db_connect.db import get_db
+from urbo_api.db_connect.db import AsyncSession, SessionLocal, async_session
+from urbo_api.db_connect.local_cache import local_cache
 from urbo_api.urbo_api_dataload import models, schema
-from urbo_api.urbo_api_dataload.air_pollution_api import get_air_pollution
-from urbo_api.urbo_api_dataload.data_nearbyplaces_api import fetch_nearby_places
+from urbo_api.urbo_api_dataload.circuit_breaker import is_upstream_failure
+from urbo_api.urbo_api_dataload.data_nearbyplaces_api import fetch_nearby_places, normalize_keywords
 from urbo_api.urbo_api_dataload.geocode_api import get_geocode
-from urbo_api.urbo_api_dataload.map_image_api import get_stillmap
-from urbo_api.urbo_api_dataload.schema import NearbyPlacesCreate, GeocodeCreate, PollutantSchema
-from urbo_api.urbo_api_fetchdata.urbo_recommendations import AQILevel, PollutantInfo
+from urbo_api.urbo_api_dataload.http_client import UpstreamClient, get_http_client
+from urbo_api.urbo_api_dataload.map_image_api import LOCAL_CACHE_STILLMAP_TTL, get_stillmap, read_stillmap_image, \
+    stillmap_image_url
+from urbo_api.urbo_api_dataload.schema import NearbyPlacesCreate, GeocodeCreate
+from urbo_api.urbo_api_dataload.single_flight import AsyncSingleFlight, location_key, upstream_flight
+from urbo_api.urbo_api_dataload.spatial import within_distance, nearest_first
+from urbo_api.urbo_api_dataload.upstream_scheduler import Priority, upstream_priority
+from urbo_api.urbo_api_fetchdata.air_quality_cache import load_air_quality
+from urbo_api.urbo_api_fetchdata.recommendations_api import recommendation_rules
+from urbo_api.urbo_api_fetchdata.rules_engine import PLACES
+from urbo_api.urbo_api_fetchdata.urbo_recommendations import AQI_RECOMMENDATIONS, POLLUTANTS_INFO
+from urbo_api.urbo_api_monitoring.metrics import cache_lookup
+from urbo_api.urbo_api_monitoring.tracing import span
+
+# load environment variable
+load_dotenv()
+# places processed at the same time by the batch endpoint
+AGGREGATE_BATCH_CONCURRENCY = int(os.getenv("AGGREGATE_BATCH_CONCURRENCY", "4"))
+AGGREGATE_BATCH_MAX_CONCURRENCY = int(os.getenv("AGGREGATE_BATCH_MAX_CONCURRENCY", "16"))
+# seconds the results are kept in the local cache shared by the workers
+LOCAL_CACHE_GEOCODE_TTL = float(os.getenv("LOCAL_CACHE_GEOCODE_TTL", "86400"))
+LOCAL_CACHE_NEARBY_PLACES_TTL = float(os.getenv("LOCAL_CACHE_NEARBY_PLACES_TTL", "3600"))
+
+logger = logging.getLogger(__name__)
+
+# parts of the aggregate response a user input can ask for, address and coordinates are always returned
+AGGREGATE_SECTIONS = ("nearby_places", "nearby_places_count", "air_quality", "still_map", "pollutants_info")
+
+# identical aggregate requests in flight at the same time
+aggregate_flight = AsyncSingleFlight()
 
 router = APIRouter(
     tags=["get-urban-planning-data"],
@@ -24,123 +61,417 @@ router = APIRouter(
 
 
 @router.post("/aggregate-endpoint", response_model=schema.AggregateResponse)
-def get_urban_planning_data(user_input: schema.UrbanPlanningByPlaceCreate, db: Session = Depends(get_db)):
+async def get_urban_planning_data(user_input: schema.UrbanPlanningByPlaceCreate,
+                                  http: UpstreamClient = Depends(get_http_client)):
     """
     this function acts on top of other api endpoints.
     this check if requested data is present in the database if not then it request from 3rd party api
-    :param user_input: takes input from user - address, keywords, region, radius, zoom, size
-    :param db: db_session: DB connection session
+    once the geocode is known, nearby places, air pollution and still map are fetched concurrently
+    identical requests arriving while one is running share its result
+    only the requested sections are loaded and returned, e.g. sections=["air_quality", "nearby_places_count"]
+    :param user_input: takes input from user - address, keywords, region, radius, zoom, size, sections
+    :param http: shared upstream http client
     :return: returns combined data from different endpoints and also display some recommendations
     """
-    geocode_result = None
-    map_img_base64 = None
-    air_pollution_output = None
-    nearby_places_result = None
+    with span("aggregate"):
+        response_data = await coalesced_urban_planning_data(user_input, http)
+    if user_input.sections is None:
+        return response_data
+    return JSONResponse(encode_aggregate_response(user_input, response_data))
+
+
+@router.post("/aggregate-endpoint/batch")
+async def get_urban_planning_data_batch(user_inputs: List[schema.UrbanPlanningByPlaceCreate],
+                                        concurrency: Optional[int] = Query(None, ge=1),
+                                        http: UpstreamClient = Depends(get_http_client)):
+    """
+    Same as aggregate endpoint for many places at once, the places are processed with bounded concurrency
+    and each result is streamed as one NDJSON line as soon as it is ready (not in input order)
+    :param user_inputs: list of aggregate endpoint user inputs
+    :param concurrency: number of places processed at the same time, capped by AGGREGATE_BATCH_MAX_CONCURRENCY
+    :param http: shared upstream http client
+    :return: NDJSON stream, one line per place with its index in the input and its result or error
+    """
+    concurrency = min(concurrency or AGGREGATE_BATCH_CONCURRENCY, AGGREGATE_BATCH_MAX_CONCURRENCY)
+    return StreamingResponse(stream_urban_planning_data(user_inputs, http, concurrency),
+                             media_type="application/x-ndjson")
+
+
+def aggregate_key(user_input: schema.UrbanPlanningByPlaceCreate):
+    """
+    :param user_input: aggregate endpoint user input
+    :return: key of the request, inputs which only differ by case, spaces or keyword order give the same key
+    """
+    return (" ".join(user_input.address.lower().split()),
+            tuple(sorted(normalize_keywords(user_input.keywords))),
+            user_input.region,
+            user_input.radius,
+            user_input.zoom,
+            user_input.size,
+            user_input.inline_map_image,
+            requested_sections(user_input))
+
+
+def requested_sections(user_input: schema.UrbanPlanningByPlaceCreate):
+    """
+    :param user_input: aggregate endpoint user input
+    :return: sorted tuple of the sections to build, all of them when the input does not list any
+    """
+    if user_input.sections is None:
+        return AGGREGATE_SECTIONS
+    return tuple(sorted(set(user_input.sections)))
+
+
+def encode_aggregate_response(user_input: schema.UrbanPlanningByPlaceCreate, response_data: dict):
+    """
+    :param user_input: aggregate endpoint user input
+    :param response_data: aggregate endpoint response data
+    :return: JSON compatible response, without the fields of the sections which were not requested
+    """
+    return jsonable_encoder(schema.AggregateResponse(**response_data),
+                            exclude_unset=user_input.sections is not None)
+
+
+async def coalesced_urban_planning_data(user_input: schema.UrbanPlanningByPlaceCreate, http: UpstreamClient):
+    """
+    Builds the aggregate response, unless an identical request is already being built, then it waits for that one
+    the work gets its own async DB session, so it does not depend on the request which started it
+    :param user_input: aggregate endpoint user input
+    :param http: shared upstream http client
+    :return: aggregate endpoint response data
+    """
+    async def build():
+        async with async_session() as async_db:
+            return await build_urban_planning_data(user_input, http, async_db)
+
+    return await aggregate_flight.do(aggregate_key(user_input), build)
+
+
+async def build_urban_planning_data(user_input: schema.UrbanPlanningByPlaceCreate, http: UpstreamClient,
+                                    async_db: AsyncSession):
+    """
+    Combines geocode, nearby places, air pollution and still map of the user input and adds the recommendations
+    the sections which are not requested are neither loaded nor added to the response data
+    :param user_input: takes input from user - address, keywords, region, radius, zoom, size, sections
+    :param http: shared upstream http client
+    :param async_db: async DB connection session, used for the geocode lookup
+    :return: aggregate endpoint response data
+    """
+    sections = requested_sections(user_input)
     aqi_recommendation = None
     nearby_places_recommendation = None
 
     # Fetch Longitude and Latitude
-    if user_input:
-        geocode_result = db.query(models.Geocode).filter(models.Geocode.address == user_input.address).first()
-
+    with span("geocode"):
+        geocode_result = await find_stored_geocode(user_input.address, async_db)
         if geocode_result is None:
-            geocode_create_date = GeocodeCreate(
-                address=user_input.address
-            )
-            geocode_result = get_geocode(geocode_create_date, db)
-
-    # Fetch Nearby Places based on Latitude and Longitude
-    if geocode_result and user_input:
-        ref_location = WKTElement(f'POINT({geocode_result.longitude} {geocode_result.latitude})', srid=4326)
-        nearby_places_result = (db.query(models.NearbyPlace).
-                                filter(models.NearbyPlace.keywords.in_(user_input.keywords),
-                                       models.NearbyPlace.ref_location == ref_location
-                                       ).first())
-
-        if nearby_places_result is None:
-            nearby_places_data = NearbyPlacesCreate(
-                keywords=user_input.keywords,
-                ref_location=[geocode_result.latitude, geocode_result.longitude],
-                region=user_input.region,
-                radius=user_input.radius
-            )
-
-            nearby_places_result = fetch_nearby_places(nearby_places_data, db)
-
-    # Fetch Air pollution results based on Latitude and Longitude
-    if geocode_result:
-
-        center_coordinates = WKTElement(f'POINT({geocode_result.longitude} {geocode_result.latitude})', srid=4326)
-        air_pollution_result = db.query(models.AirPollution).filter(
-            models.AirPollution.center_coordinates == center_coordinates).first()
-
-        if air_pollution_result is None:
-            air_pollution_result = get_air_pollution(geocode_result.latitude, geocode_result.longitude, db)
-            air_pollution_output = air_pollution_result['air_pollution_response'][0]
-
-    # Fetch still Map image (Byte format) based on Latitude and Longitude and other constant params
-    if geocode_result:
-        center_input = WKTElement(f'POINT({geocode_result.longitude} {geocode_result.latitude})', srid=4326)
-        get_still_map_results = db.query(models.StillMap).filter(models.StillMap.center == center_input).first()
-
-        if get_still_map_results is None:
-            get_still_map_results = get_stillmap(geocode_result.latitude, geocode_result.longitude, user_input.zoom,
-                                                 user_input.size, db)
-
-            map_img_bytes = get_still_map_results["map_img"]
-            map_img_base64 = base64.b64encode(map_img_bytes).decode('utf-8')
+            geocode_result = await run_in_threadpool(with_session, fetch_geocode, user_input, http)
+
+    # Nearby places, air pollution and still map only depend on Latitude and Longitude,
+    # so the requested ones run at the same time, each one with its own DB session
+    # a section whose 3rd party api service fails is left empty and listed in degraded_sections
+    degraded_sections = []
+    loaders = {}
+    if "nearby_places" in sections or "nearby_places_count" in sections:
+        loaders["nearby_places"] = load_section("nearby_places", degraded_sections, load_nearby_places,
+                                                user_input, geocode_result, http)
+    if "air_quality" in sections:
+        loaders["air_quality"] = load_section("air_quality", degraded_sections, load_air_pollution,
+                                              geocode_result, http)
+    if "still_map" in sections:
+        loaders["still_map"] = load_section("still_map", degraded_sections, load_still_map,
+                                            user_input, geocode_result, http)
+    loaded = dict(zip(loaders, await asyncio.gather(*loaders.values())))
+    nearby_places_response = loaded.get("nearby_places")
+    air_quality = loaded.get("air_quality")
+    still_map = loaded.get("still_map")
+    air_pollution_output = air_quality["output"] if air_quality is not None else None
+
+    response_data = {
+        "address": geocode_result.address,
+        "latitude": geocode_result.latitude,
+        "longitude": geocode_result.longitude,
+        "degraded_sections": degraded_sections
+    }
 
     # Recommendation Logic based on quantitative data received from different 3rd party api services
     # For Air Quality Index
-    if air_pollution_output['main']['aqi']:
-
-        match air_pollution_output['main']['aqi']:
-            case 1:
-                aqi_recommendation = AQILevel.GOOD
-            case 2:
-                aqi_recommendation = AQILevel.FAIR
-            case 3:
-                aqi_recommendation = AQILevel.MODERATE
-            case 4:
-                aqi_recommendation = AQILevel.POOR
-            case 5:
-                aqi_recommendation = AQILevel.VERY_POOR
-            case _:
-                aqi_recommendation = "Invalid AQI value received"
+    if air_pollution_output is not None and air_pollution_output['main']['aqi']:
+        aqi_recommendation = AQI_RECOMMENDATIONS.get(air_pollution_output['main']['aqi'],
+                                                     "Invalid AQI value received")
 
     # For Air Pollution data
-    pollutants = []
-    for pollutant in PollutantInfo:
-        pollutant_data = PollutantSchema(
-            pollutant_name=pollutant.value["name"],
-            description=pollutant.value["description"],
-            source=pollutant.value["source"],
-            health_effects=pollutant.value["health_effects"]
-        )
+    if "pollutants_info" in sections:
+        response_data["pollutants_info"] = POLLUTANTS_INFO
 
-        pollutants.append(pollutant_data)
+    # For Nearby found places and the overall score, the recommendation rules of the loaded data
+    if "nearby_places" in loaders or "air_quality" in loaders:
+        city = {
+            "radius": user_input.radius,
+            "aqi": air_pollution_output['main']['aqi'] if air_pollution_output is not None else None,
+            "place_counts": nearby_places_response.get("keywordCounts", {}) if nearby_places_response else {}
+        }
+        city_result = recommendation_rules.score_cities([city])[0]
+        response_data["recommendation_score"] = city_result["score"]
 
-    pollutants_info = pollutants
+        place_messages = [rule["message"] for rule in city_result["rules"]
+                          if rule["metric"] == PLACES and rule["message"]]
+        nearby_places_recommendation = " ".join(place_messages) or None
 
-    # For Nearby found places
-    nearby_places_count = len(nearby_places_result.nearby_places_response["suggestedLocations"])
+    if "nearby_places" in loaders:
+        response_data["nearby_places_count"] = (len(nearby_places_response["suggestedLocations"])
+                                                if nearby_places_response is not None else None)
+        response_data["nearby_places_recommendation"] = nearby_places_recommendation
+        if "nearby_places" in sections:
+            response_data["Nearby_places"] = nearby_places_response
 
-    if nearby_places_count < 5 and user_input.radius >= 1000:
-        nearby_places_recommendation = f"You have very less {user_input.keywords} in the radius of {user_input.radius} meters "
-    elif nearby_places_count > 5 and user_input.radius <= 1000:
-        nearby_places_recommendation = f"You have good enough {user_input.keywords} in the radius of {user_input.radius} meters "
+    if "air_quality" in loaders:
+        response_data.update({
+            "aqi_recommendation": aqi_recommendation,
+            "air_quality_index": air_pollution_output['main']['aqi'] if air_quality is not None else None,
+            "air_pollution_params": air_pollution_output['components'] if air_quality is not None else None,
+            "air_quality_updated_at": air_quality["fetched_at"] if air_quality is not None else None,
+            "air_quality_stale": air_quality["stale"] if air_quality is not None else False
+        })
 
-    response_data = {
-        "address": geocode_result.address,
-        "latitude": geocode_result.latitude,
-        "longitude": geocode_result.longitude,
-        "Nearby_places": nearby_places_result.nearby_places_response,
-        "nearby_places_recommendation": nearby_places_recommendation,
-        "air_quality_index": air_pollution_output['main']['aqi'],
-        "aqi_recommendation": aqi_recommendation,
-        "air_pollution_params": air_pollution_output['components'],
-        "pollutants_info": pollutants_info,
-        "still_map_image": f"data:image/png;base64,{map_img_base64}"
-    }
+    if "still_map" in loaders:
+        response_data["still_map_url"] = stillmap_image_url(still_map["id"]) if still_map is not None else None
+        response_data["still_map_stale"] = still_map.get("stale", False) if still_map is not None else False
+        if user_input.inline_map_image:
+            response_data["still_map_image"] = None
+
+    if still_map is not None and user_input.inline_map_image:
+        map_img_base64 = base64.b64encode(still_map["map_img"]).decode('utf-8')
+        response_data["still_map_image"] = f"data:image/png;base64,{map_img_base64}"
 
     return response_data
+
+
+async def stream_urban_planning_data(user_inputs: List[schema.UrbanPlanningByPlaceCreate], http: UpstreamClient,
+                                     concurrency: int):
+    """
+    Runs a fixed number of workers which take the next place as soon as they are done with the previous one,
+    results are yielded as NDJSON lines in the order they finish
+    :param user_inputs: list of aggregate endpoint user inputs
+    :param http: shared upstream http client
+    :param concurrency: number of workers
+    :return: async generator of NDJSON lines
+    """
+    # bounded, so workers wait for the client instead of piling up results in memory
+    results = asyncio.Queue(maxsize=concurrency)
+    pending_inputs = iter(enumerate(user_inputs))
+
+    async def worker():
+        # upstream calls of the batch wait behind the interactive requests
+        upstream_priority.set(Priority.BATCH)
+        for index, user_input in pending_inputs:
+            line = {"index": index, "address": user_input.address}
+            try:
+                response_data = await coalesced_urban_planning_data(user_input, http)
+                line["result"] = encode_aggregate_response(user_input, response_data)
+            except HTTPException as exc:
+                line["error"] = {"status_code": exc.status_code, "detail": exc.detail}
+            except Exception:
+                logger.exception("Aggregate batch failed for %s", user_input.address)
+                line["error"] = {"status_code": 500, "detail": "Internal Server Error"}
+            await results.put(line)
+
+    workers = [asyncio.create_task(worker()) for _ in range(min(concurrency, len(user_inputs)))]
+    try:
+        for _ in range(len(user_inputs)):
+            yield json.dumps(await results.get()) + "\n"
+    finally:
+        # client went away or all results are sent
+        for task in workers:
+            task.cancel()
+
+
+async def load_section(name: str, degraded_sections: List[str], loader, *args):
+    """
+    Runs the loader of one aggregate section in the threadpool, a failing 3rd party api service
+    degrades the section instead of failing the whole response
+    :param name: section name, added to degraded_sections when it fails
+    :param degraded_sections: names of the failed sections
+    :param loader: one of the load_* functions
+    :param args: arguments for the loader
+    :return: whatever the loader returns, None when the section is degraded
+    """
+    try:
+        with span(name):
+            return await run_in_threadpool(with_session, loader, *args)
+    except HTTPException as exc:
+        if not is_upstream_failure(exc):
+            raise
+        logger.warning("Aggregate section %s degraded: %s", name, exc.detail)
+        degraded_sections.append(name)
+        return None
+
+
+def with_session(loader, *args):
+    """
+    Runs the loader with a DB session of its own, a session must not be shared between threads
+    :param loader: one of the load_* functions, it takes the DB session as last argument
+    :param args: arguments for the loader
+    :return: whatever the loader returns
+    """
+    db = SessionLocal()
+    try:
+        return loader(*args, db)
+    finally:
+        db.close()
+
+
+async def find_stored_geocode(address: str, async_db: AsyncSession):
+    """
+    Finds the geocode of the address in the local cache, then in DB without holding a thread
+    the shared level of the local cache is a SQLite file which may wait for a writer, so it is read and written
+    in the threadpool, not on the event loop
+    :param address: user input address
+    :param async_db: async DB connection session
+    :return: Geocode row, GeocodePoint or None
+    """
+    cached = await run_in_threadpool(local_cache.get, "geocode", address)
+    if cached is not None:
+        cache_lookup("geocode", "hit")
+        return schema.GeocodePoint(**cached)
+
+    result = await async_db.execute(select(models.Geocode).where(models.Geocode.address == address).limit(1))
+    geocode = result.scalars().first()
+    cache_lookup("geocode", "miss" if geocode is None else "hit")
+    if geocode is not None:
+        await run_in_threadpool(cache_geocode, geocode)
+    return geocode
+
+
+def cache_geocode(geocode):
+    """
+    :param geocode: object with address, latitude and longitude attributes
+    """
+    local_cache.set("geocode", geocode.address, {"address": geocode.address, "latitude": geocode.latitude,
+                                                 "longitude": geocode.longitude}, LOCAL_CACHE_GEOCODE_TTL)
+
+
+def fetch_geocode(user_input: schema.UrbanPlanningByPlaceCreate, http: UpstreamClient, db: Session):
+    """
+    Requests the geocode of the address from HERE API and stores it, once per address at a time
+    :param user_input: aggregate endpoint user input
+    :param http: shared upstream http client
+    :param db: DB connection session
+    :return: object with address, latitude and longitude attributes
+    """
+    geocode_create_date = GeocodeCreate(
+        address=user_input.address
+    )
+    geocode = schema.GeocodeResponse(**upstream_flight.do(("geocode", user_input.address), get_geocode,
+                                                          geocode_create_date, db, http))
+    cache_geocode(geocode)
+    return geocode
+
+
+def load_nearby_places(user_input: schema.UrbanPlanningByPlaceCreate, geocode_result, http: UpstreamClient,
+                       db: Session):
+    """
+    Finds the nearby places of each keyword in DB, only the missing keywords are requested from Mapple API
+    :param user_input: aggregate endpoint user input
+    :param geocode_result: geocode of the user input address
+    :param http: shared upstream http client
+    :param db: DB connection session
+    :return: nearby places response of all the keywords
+    """
+    cache_key = (sorted(normalize_keywords(user_input.keywords)), *location_key(geocode_result.latitude,
+                                                                               geocode_result.longitude),
+                 user_input.radius, user_input.region)
+    cached = local_cache.get("nearby_places", cache_key)
+    if cached is not None:
+        return cached
+
+    nearby_places_data = NearbyPlacesCreate(
+        keywords=user_input.keywords,
+        ref_location=[geocode_result.latitude, geocode_result.longitude],
+        region=user_input.region,
+        radius=user_input.radius
+    )
+    nearby_places_response = fetch_nearby_places(nearby_places_data, db, http)["nearby_places_response"]
+    local_cache.set("nearby_places", cache_key, nearby_places_response, LOCAL_CACHE_NEARBY_PLACES_TTL)
+    return nearby_places_response
+
+
+def load_air_pollution(geocode_result, http: UpstreamClient, db: Session):
+    """
+    Finds the air pollution data in DB, stale data is served while it is refreshed in the background,
+    missing or too old data is requested from OpenWeather API
+    :param geocode_result: geocode of the user input address
+    :param http: shared upstream http client
+    :param db: DB connection session
+    :return: dict with the first entry of the air pollution list (output), when it was fetched and if it is stale
+    """
+    return load_air_quality(geocode_result.latitude, geocode_result.longitude, http, db)
+
+
+def load_still_map(user_input: schema.UrbanPlanningByPlaceCreate, geocode_result, http: UpstreamClient,
+                   db: Session):
+    """
+    Finds the still map image in DB, if not found it requests it from Mapple API
+    :param user_input: aggregate endpoint user input
+    :param geocode_result: geocode of the user input address
+    :param http: shared upstream http client
+    :param db: DB connection session
+    :return: dict with the still map id and the image in byte format (only read when it is returned inline),
+             stale is set when another map of the place is served because the Mapple API failed
+    """
+    lon, lat = geocode_result.longitude, geocode_result.latitude
+    cache_key = (*location_key(lat, lon), user_input.zoom, user_input.size, user_input.inline_map_image)
+    cached = local_cache.get("stillmap", cache_key)
+    if cached is not None:
+        return cached
+
+    get_still_map_results = (db.query(models.StillMap).
+                             options(defer(models.StillMap.map_img)).
+                             filter(within_distance(models.StillMap.center, lon, lat),
+                                    models.StillMap.zoom == user_input.zoom,
+                                    models.StillMap.size == user_input.size).
+                             order_by(nearest_first(models.StillMap.center, lon, lat)).first())
+
+    cache_lookup("stillmap", "miss" if get_still_map_results is None else "hit")
+    if get_still_map_results is not None:
+        result = still_map_result(get_still_map_results, user_input.inline_map_image)
+        local_cache.set("stillmap", cache_key, result, LOCAL_CACHE_STILLMAP_TTL)
+        return result
+
+    # the same map requested by another request at this moment is waited for, not fetched and stored twice
+    try:
+        get_still_map_results = upstream_flight.do(
+            ("stillmap", *location_key(lat, lon), user_input.zoom, user_input.size),
+            get_stillmap, lat, lon, user_input.zoom, user_input.size, db, http)
+    except HTTPException as exc:
+        if not is_upstream_failure(exc):
+            raise
+        # Mapple still map API is down or its circuit is open, a map of the place with another zoom or size
+        # is better than none
+        fallback = (db.query(models.StillMap).
+                    options(defer(models.StillMap.map_img)).
+                    filter(within_distance(models.StillMap.center, lon, lat)).
+                    order_by(nearest_first(models.StillMap.center, lon, lat)).first())
+        if fallback is None:
+            raise
+        logger.warning("Serving stale still map for %s: %s", location_key(lat, lon), exc.detail)
+        return {**still_map_result(fallback, user_input.inline_map_image), "stale": True}
+
+    result = {
+        "id": get_still_map_results["id"],
+        "map_img": get_still_map_results["map_img"] if user_input.inline_map_image else None
+    }
+    local_cache.set("stillmap", cache_key, result, LOCAL_CACHE_STILLMAP_TTL)
+    return result
+
+
+def still_map_result(still_map: models.StillMap, inline_map_image: bool):
+    """
+    :param still_map: StillMap row, loaded without map_img
+    :param inline_map_image: True when the image is returned inline
+    :return: dict with the still map id and the image in byte format (only read when it is returned inline)
+    """
+    return {
+        "id": still_map.id,
+        "map_img": read_stillmap_image(still_map) if inline_map_image else None
+    }
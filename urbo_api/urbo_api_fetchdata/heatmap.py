@@ -0,0 +1,131 @@
+"""
+ heatmap.py contains the numpy helpers of the air quality heatmap
+ sample grid around a center, inverse distance weighting (IDW) of the sampled values onto a dense grid,
+ color ramp and PNG encoding of the surface
+ distances are computed on a local plane in meters, which is accurate enough over a city
+"""
+import math
+import struct
+import zlib
+
+import numpy as np
+
+from urbo_api.urbo_api_dataload.spatial import METERS_PER_DEGREE
+
+# target cells interpolated at once, keeps the distance matrix (cells x samples) small enough for the CPU cache
+IDW_CHUNK_CELLS = 1024
+
+# color ramp of the overlay from the lowest to the highest value (green, yellow, orange, red, purple)
+COLOR_STOPS = np.array([
+    [0, 166, 81],
+    [255, 222, 51],
+    [255, 153, 51],
+    [204, 0, 51],
+    [126, 0, 35],
+], dtype=np.float32)
+
+
+def degrees_per_meter(lat: float):
+    """
+    :param lat: latitude of the area
+    :return: (latitude, longitude) degrees per meter around that latitude
+    """
+    return 1 / METERS_PER_DEGREE, 1 / (METERS_PER_DEGREE * max(math.cos(math.radians(lat)), 0.01))
+
+
+def grid_offsets(size: int, extent: float):
+    """
+    :param size: number of points per side
+    :param extent: side of the square in meters
+    :return: (y, x) offsets in meters from the center of a size x size grid, row 0 is the north edge
+    """
+    half = extent / 2 if size > 1 else 0
+    x, y = np.meshgrid(np.linspace(-half, half, size), np.linspace(half, -half, size))
+    return y, x
+
+
+def grid_coordinates(lat: float, lon: float, size: int, extent: float):
+    """
+    :param lat: latitude of the center
+    :param lon: longitude of the center
+    :param size: number of points per side
+    :param extent: side of the square in meters
+    :return: (lats, lons) arrays of shape (size, size), row 0 is the north edge
+    """
+    lat_per_meter, lon_per_meter = degrees_per_meter(lat)
+    y, x = grid_offsets(size, extent)
+    return lat + y * lat_per_meter, lon + x * lon_per_meter
+
+
+def idw(sample_xy, sample_values, target_xy, power: float = 2, chunk_cells: int = IDW_CHUNK_CELLS):
+    """
+    Inverse distance weighting, every target gets the mean of the samples weighted by 1 / distance^power
+    computed in float32 with the squared distances expanded as |t|^2 + |s|^2 - 2 t.s, so the bulk of the work is
+    one matrix product per chunk of targets
+    :param sample_xy: (samples, 2) positions of the samples in meters
+    :param sample_values: (samples, components) values of the samples
+    :param target_xy: (targets, 2) positions to interpolate in meters
+    :param power: higher values make the closest samples count more
+    :param chunk_cells: targets interpolated at once
+    :return: (targets, components) interpolated values, a target on a sample gets the sample value
+    """
+    sample_xy = np.asarray(sample_xy, dtype=np.float32)
+    sample_values = np.asarray(sample_values, dtype=np.float32)
+    target_xy = np.asarray(target_xy, dtype=np.float32)
+    result = np.empty((len(target_xy), sample_values.shape[1]), dtype=np.float32)
+
+    sample_norms = (sample_xy ** 2).sum(axis=1)
+    target_norms = (target_xy ** 2).sum(axis=1)
+    sample_xy_t = -2 * sample_xy.T
+
+    for start in range(0, len(target_xy), chunk_cells):
+        end = start + chunk_cells
+        squared = target_xy[start:end] @ sample_xy_t
+        squared += target_norms[start:end, None]
+        squared += sample_norms[None, :]
+        # within 1 meter counts as being on the sample (it also absorbs the float32 rounding),
+        # its weight then outweighs all the others
+        np.maximum(squared, 1, out=squared)
+        weights = np.reciprocal(squared, out=squared) if power == 2 else np.power(squared, -power / 2, out=squared)
+        result[start:end] = (weights @ sample_values) / weights.sum(axis=1, keepdims=True)
+
+    return result
+
+
+def colorize(values, low: float, high: float, alpha: int = 160):
+    """
+    :param values: 2D array of values
+    :param low: value shown with the first color
+    :param high: value shown with the last color
+    :param alpha: opacity of the overlay, 0 to 255
+    :return: (rows, columns, 4) RGBA uint8 array
+    """
+    scale = (np.asarray(values, dtype=np.float32) - low) / (high - low) if high > low else np.zeros_like(values)
+    position = np.clip(scale, 0, 1) * (len(COLOR_STOPS) - 1)
+    index = np.minimum(position.astype(np.int32), len(COLOR_STOPS) - 2)
+    fraction = (position - index)[..., None]
+    rgb = COLOR_STOPS[index] * (1 - fraction) + COLOR_STOPS[index + 1] * fraction
+
+    rgba = np.empty(rgb.shape[:2] + (4,), dtype=np.uint8)
+    rgba[..., :3] = np.rint(rgb)
+    rgba[..., 3] = alpha
+    return rgba
+
+
+def encode_png(rgba) -> bytes:
+    """
+    :param rgba: (rows, columns, 4) uint8 array
+    :return: PNG image, 8 bit RGBA without filtering
+    """
+    height, width = rgba.shape[:2]
+
+    def chunk(kind: bytes, payload: bytes):
+        return (struct.pack(">I", len(payload)) + kind + payload
+                + struct.pack(">I", zlib.crc32(kind + payload) & 0xFFFFFFFF))
+
+    # each row starts with its filter type, 0 (none)
+    raw = np.zeros((height, width * 4 + 1), dtype=np.uint8)
+    raw[:, 1:] = np.ascontiguousarray(rgba, dtype=np.uint8).reshape(height, width * 4)
+    header = struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header)
+            + chunk(b"IDAT", zlib.compress(raw.tobytes(), 6)) + chunk(b"IEND", b""))
@@ -0,0 +1,152 @@
+"""
+ public_transport_api.py contains the public transport density analysis of an area
+ it only reads stored data, the geocode of the address and the bus / train hubs found by earlier nearby places
+ searches (places table), so it can be computed again for many cities and radii without calling Mappls
+"""
+import os
+from typing import List, Optional
+
+import numpy as np
+from dotenv import load_dotenv
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.concurrency import run_in_threadpool
+from geoalchemy2 import Geometry
+from sqlalchemy import cast, func, select
+
+from urbo_api.db_connect.db import AsyncSession, get_async_db
+from urbo_api.urbo_api_dataload import models, schema
+from urbo_api.urbo_api_dataload.data_nearbyplaces_api import normalize_keywords
+from urbo_api.urbo_api_dataload.local_places import NEARBY_PLACES_MAX_RADIUS
+from urbo_api.urbo_api_dataload.spatial import within_distance
+from urbo_api.urbo_api_fetchdata.fetch_data import find_stored_geocode
+from urbo_api.urbo_api_fetchdata.heatmap import degrees_per_meter
+from urbo_api.urbo_api_fetchdata.transport_density import TRANSPORT_KEYWORDS, cell_centers, density_score, \
+    hub_counts, hub_distances, local_xy
+from urbo_api.urbo_api_monitoring.tracing import span
+
+# load environment variable
+load_dotenv()
+# cells per side of the analysis grid
+TRANSPORT_DEFAULT_GRID = int(os.getenv("TRANSPORT_DEFAULT_GRID", "20"))
+TRANSPORT_MAX_GRID = int(os.getenv("TRANSPORT_MAX_GRID", "100"))
+# meters a place may be from a hub and still count as covered
+TRANSPORT_WALK_DISTANCE = float(os.getenv("TRANSPORT_WALK_DISTANCE", "500"))
+# hubs per km² giving the full density part of the score
+TRANSPORT_TARGET_DENSITY = float(os.getenv("TRANSPORT_TARGET_DENSITY", "4"))
+# largest number of gaps returned
+TRANSPORT_MAX_GAPS = int(os.getenv("TRANSPORT_MAX_GAPS", "20"))
+
+router = APIRouter(
+    tags=["public-transport"],
+    responses={404: {"description": "Not Found"}}
+)
+
+
+@router.get("/public-transport/density", response_model=schema.PublicTransportDensityResponse)
+async def get_public_transport_density(address: str,
+                                       radius: int = Query(1000, gt=0, le=NEARBY_PLACES_MAX_RADIUS),
+                                       grid: int = Query(TRANSPORT_DEFAULT_GRID, ge=2, le=TRANSPORT_MAX_GRID),
+                                       walk_distance: float = Query(TRANSPORT_WALK_DISTANCE, gt=0),
+                                       bandwidth: Optional[float] = Query(None, gt=0),
+                                       keywords: Optional[List[str]] = Query(None),
+                                       db: AsyncSession = Depends(get_async_db)):
+    """
+    Bins the stored public transport hubs around the address on a grid x grid square of side 2 x radius
+    :param address: center of the area, its geocode must already be stored
+    :param radius: radius of the analysed circle in meters
+    :param grid: cells per side
+    :param walk_distance: meters to a hub within which a cell counts as covered
+    :param bandwidth: standard deviation of the density kernel in meters, default walk_distance
+    :param keywords: keywords of the stored places counted as hubs, default bus, train and metro stations
+    :param db: async DB connection session
+    :return: hub counts, kernel density and nearest hub distance of every cell, coverage gaps and density score
+    """
+    keywords = normalize_keywords(keywords or TRANSPORT_KEYWORDS)
+    if not keywords:
+        raise HTTPException(status_code=400, detail="At least one keyword is needed")
+
+    geocode_result = await find_stored_geocode(address, db)
+    if geocode_result is None:
+        raise HTTPException(status_code=404, detail="Address not found, load it with the aggregate endpoint first")
+    lat, lon = geocode_result.latitude, geocode_result.longitude
+
+    with span("find_hubs"):
+        # hubs just outside the circle still serve the cells at its edge
+        point = cast(models.Place.location, Geometry(geometry_type="POINT", srid=4326))
+        result = await db.execute(
+            select(models.Place.eloc, func.ST_Y(point), func.ST_X(point)).
+            where(models.Place.keyword.in_(keywords),
+                  within_distance(models.Place.location, lon, lat, radius + walk_distance)))
+        # a place found by several keywords is stored once per keyword
+        hubs = {eloc: (hub_lat, hub_lon) for eloc, hub_lat, hub_lon in result.all()}
+
+    with span("transport_density"):
+        analysis = await run_in_threadpool(analyse_hubs, list(hubs.values()), lat, lon, radius, grid, walk_distance,
+                                           bandwidth or walk_distance)
+
+    lat_per_meter, lon_per_meter = degrees_per_meter(lat)
+    return {
+        "address": geocode_result.address,
+        "center_coordinates": {"lon": lon, "lat": lat},
+        "bounds": {
+            "north": lat + radius * lat_per_meter,
+            "south": lat - radius * lat_per_meter,
+            "east": lon + radius * lon_per_meter,
+            "west": lon - radius * lon_per_meter
+        },
+        "radius": radius,
+        "grid": grid,
+        "cell_size": 2 * radius / grid,
+        "keywords": keywords,
+        "walk_distance": walk_distance,
+        **analysis
+    }
+
+
+def analyse_hubs(hubs, lat: float, lon: float, radius: int, grid: int, walk_distance: float, bandwidth: float):
+    """
+    :param hubs: list of (lat, lon) of the hubs
+    :param lat: latitude of the center
+    :param lon: longitude of the center
+    :param radius: radius of the analysed circle in meters
+    :param grid: cells per side
+    :param walk_distance: meters to a hub within which a cell counts as covered
+    :param bandwidth: standard deviation of the density kernel in meters
+    :return: dict with the hub count, density, coverage, score, gaps and the grids of the response
+    """
+    extent = 2 * radius
+    hub_xy = local_xy([hub[0] for hub in hubs], [hub[1] for hub in hubs], lat, lon)
+    cell_y, cell_x = cell_centers(grid, extent)
+    cell_xy = np.column_stack((cell_x.ravel(), cell_y.ravel()))
+
+    cell_km2 = (extent / grid) ** 2 / 1e6
+    counts = hub_counts(hub_xy, grid, extent)
+    nearest, density = hub_distances(hub_xy, cell_xy, bandwidth)
+    nearest, density = nearest.reshape(grid, grid), density.reshape(grid, grid)
+
+    inside = np.hypot(cell_x, cell_y) <= radius
+    hubs_inside = int((np.hypot(hub_xy[:, 0], hub_xy[:, 1]) <= radius).sum())
+    hubs_per_km2 = hubs_inside / (np.pi * radius ** 2 / 1e6)
+    gap_cells = inside & (nearest > walk_distance)
+    coverage = 1 - gap_cells.sum() / max(inside.sum(), 1)
+
+    lat_per_meter, lon_per_meter = degrees_per_meter(lat)
+    rows, columns = np.nonzero(gap_cells)
+    # the farthest from a hub first, all gaps are equally far when there is no hub
+    order = np.argsort(-nearest[rows, columns], kind="stable")[:TRANSPORT_MAX_GAPS]
+    gaps = [{"lat": float(lat + cell_y[row, column] * lat_per_meter),
+             "lon": float(lon + cell_x[row, column] * lon_per_meter),
+             "nearest_hub_distance": None if np.isinf(nearest[row, column]) else round(float(nearest[row, column]))}
+            for row, column in zip(rows[order], columns[order])]
+
+    return {
+        "hubs": hubs_inside,
+        "hubs_per_km2": round(hubs_per_km2, 3),
+        "coverage": round(float(coverage), 3),
+        "score": density_score(float(coverage), hubs_per_km2, TRANSPORT_TARGET_DENSITY),
+        "gaps": gaps,
+        "counts_per_km2": np.round(counts / cell_km2, 3).tolist(),
+        "kernel_density": np.round(density, 3).tolist(),
+        "nearest_hub_distance": [[None if np.isinf(value) else round(float(value)) for value in row]
+                                 for row in nearest]
+    }
@@ -0,0 +1,41 @@
+"""
+ recommendations_api.py contains the compiled recommendation rules and the endpoint scoring many cities at once
+ the rules are read from RECOMMENDATION_RULES (JSON list or path of a JSON file) when the app starts,
+ the README criteria of rules_engine.DEFAULT_RULES are used when it is not set
+"""
+import os
+from typing import List
+
+from dotenv import load_dotenv
+from fastapi import APIRouter, HTTPException
+
+from urbo_api.urbo_api_dataload import schema
+from urbo_api.urbo_api_fetchdata.rules_engine import RuleSet, load_rules
+
+# load environment variable
+load_dotenv()
+RECOMMENDATION_RULES = os.getenv("RECOMMENDATION_RULES")
+# cities accepted by one scoring request
+RECOMMENDATION_MAX_CITIES = int(os.getenv("RECOMMENDATION_MAX_CITIES", "1000"))
+
+router = APIRouter(
+    tags=["recommendations"],
+    responses={404: {"description": "Not Found"}}
+)
+
+# compiled once, shared by the aggregate endpoint and the scoring endpoint
+recommendation_rules = RuleSet(load_rules(RECOMMENDATION_RULES))
+
+
+@router.post("/recommendations/score", response_model=List[schema.RecommendationScore])
+def score_cities(cities: List[schema.RecommendationCityInput]):
+    """
+    Checks the recommendation rules for all the cities in one batch
+    :param cities: list of cities with radius, AQI and number of places found per keyword
+    :return: score and result of each rule with data, in input order
+    """
+    if len(cities) > RECOMMENDATION_MAX_CITIES:
+        raise HTTPException(status_code=400, detail=f"At most {RECOMMENDATION_MAX_CITIES} cities can be scored at once")
+
+    results = recommendation_rules.score_cities([city.model_dump() for city in cities])
+    return [{"address": city.address, **result} for city, result in zip(cities, results)]
@@ -0,0 +1,238 @@
+"""
+ rules_engine.py contains the recommendation rules engine
+ rules are declared as data (metric, comparison, threshold, weight and messages), e.g. a city must have at least
+ 10 parks per 1000 meters of radius or at least 5 schools, they are compiled once into numpy arrays and evaluated
+ for a whole batch of cities at once, one row per city and one column per rule
+"""
+import json
+from typing import Optional
+
+import numpy as np
+
+from urbo_api.urbo_api_fetchdata.transport_density import TRANSPORT_KEYWORDS
+
+AQI = "aqi"
+PLACES = "places"
+METRICS = (AQI, PLACES)
+
+# comparison of the city value with the threshold, the code is the index in this tuple
+OPERATORS = (">=", ">", "<=", "<", "==")
+
+# Mapple nearby API answers one page per keyword, a count above this can not be reached for one keyword
+NEARBY_PAGE_SIZE = 10
+
+# criteria of the README, used when RECOMMENDATION_RULES is not set
+DEFAULT_RULES = [
+    {
+        "name": "parks",
+        "metric": PLACES,
+        "keywords": ["park", "parks", "garden", "gardens", "forest", "forests"],
+        "label": "parks",
+        "op": ">=",
+        "value": 10,
+        "per_radius": 1000,
+        "max_value": NEARBY_PAGE_SIZE,
+        "weight": 2,
+        "pass": "{value:g} {label} within {radius} meters, enough green space for the area.",
+        "fail": "Only {value:g} {label} within {radius} meters, at least {threshold:g} are recommended. "
+                "Preserve the existing green spaces and plan new ones."
+    },
+    {
+        "name": "schools",
+        "metric": PLACES,
+        "keywords": ["school", "schools", "college", "colleges", "university", "universities", "education"],
+        "label": "schools",
+        "op": ">=",
+        "value": 5,
+        "weight": 1,
+        "pass": "{value:g} {label} within {radius} meters, enough education facilities.",
+        "fail": "Only {value:g} {label} within {radius} meters, at least {threshold:g} different schools "
+                "or education systems are recommended."
+    },
+    {
+        "name": "public_transport",
+        "metric": PLACES,
+        "keywords": list(TRANSPORT_KEYWORDS),
+        "label": "public transport hubs",
+        "op": ">=",
+        "value": 3,
+        "per_radius": 1000,
+        "max_value": NEARBY_PAGE_SIZE,
+        "weight": 1,
+        "pass": "{value:g} {label} within {radius} meters, the area is well served.",
+        "fail": "Only {value:g} {label} within {radius} meters, at least {threshold:g} are recommended. "
+                "Consider more bus or train stops."
+    },
+    {
+        # every searched keyword counts, it only adds its message, the specific rules give the score
+        "name": "nearby_places",
+        "metric": PLACES,
+        "label": "places of the searched keywords",
+        "op": ">=",
+        "value": 5,
+        "per_radius": 1000,
+        "max_value": NEARBY_PAGE_SIZE,
+        "weight": 0,
+        "pass": "You have good enough {label} ({value:g}) in the radius of {radius} meters.",
+        "fail": "You have very less {label} ({value:g}) in the radius of {radius} meters, "
+                "at least {threshold:g} are recommended."
+    },
+    {
+        "name": "air_quality",
+        "metric": AQI,
+        "label": "AQI",
+        "op": "<=",
+        "value": 3,
+        "weight": 2,
+        "pass": "AQI {value:g} is within the acceptable range.",
+        "fail": "AQI {value:g} is above {threshold:g}, reduce traffic and industrial emissions."
+    },
+]
+
+
+def load_rules(value: Optional[str]):
+    """
+    :param value: JSON list of rules, or path of a JSON file holding it, see DEFAULT_RULES
+    :return: list of rule dicts, DEFAULT_RULES when no value is given
+    """
+    if not value or not value.strip():
+        return DEFAULT_RULES
+
+    if value.lstrip().startswith("["):
+        return json.loads(value)
+    with open(value) as file:
+        return json.load(file)
+
+
+class RuleSet:
+    """
+    Rules compiled into one array per attribute, so a batch of cities is checked with a few array operations
+    """
+
+    def __init__(self, rules):
+        """
+        :param rules: list of rule dicts with name, metric (aqi or places), op, value and optionally keywords
+                      (places searched with these keywords are counted, all the places when missing), per_radius
+                      (the threshold is for this radius and grows in proportion to the searched radius, rounded
+                      up), max_value (largest threshold, e.g. NEARBY_PAGE_SIZE as the counts come from one page),
+                      weight, label and pass / fail messages (format fields: value, threshold, radius, label)
+        """
+        self.names = []
+        self.metrics = []
+        self.labels = []
+        self.keywords = []
+        self.pass_messages = []
+        self.fail_messages = []
+        operators, thresholds, per_radius, max_values, weights = [], [], [], [], []
+
+        for rule in rules:
+            name = rule.get("name")
+            if not name:
+                raise ValueError("Every rule needs a name")
+            if rule.get("metric") not in METRICS:
+                raise ValueError(f"Rule {name}: metric must be one of {', '.join(METRICS)}")
+            if rule.get("op") not in OPERATORS:
+                raise ValueError(f"Rule {name}: op must be one of {', '.join(OPERATORS)}")
+            if rule.get("per_radius") is not None and rule["per_radius"] <= 0:
+                raise ValueError(f"Rule {name}: per_radius must be positive")
+            if rule.get("max_value") is not None and rule["max_value"] < rule["value"]:
+                raise ValueError(f"Rule {name}: max_value must not be below value")
+
+            self.names.append(name)
+            self.metrics.append(rule["metric"])
+            self.labels.append(rule.get("label", name))
+            self.keywords.append(frozenset(keyword.strip().lower() for keyword in rule["keywords"])
+                                 if rule.get("keywords") else None)
+            self.pass_messages.append(rule.get("pass"))
+            self.fail_messages.append(rule.get("fail"))
+            operators.append(OPERATORS.index(rule["op"]))
+            thresholds.append(float(rule["value"]))
+            per_radius.append(np.nan if rule.get("per_radius") is None else float(rule["per_radius"]))
+            max_values.append(np.inf if rule.get("max_value") is None else float(rule["max_value"]))
+            weights.append(float(rule.get("weight", 1)))
+
+        self.operators = np.array(operators, dtype=np.int8)
+        self.thresholds = np.array(thresholds, dtype=np.float64)
+        self.per_radius = np.array(per_radius, dtype=np.float64)
+        self.max_values = np.array(max_values, dtype=np.float64)
+        self.weights = np.array(weights, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.names)
+
+    def city_values(self, city: dict):
+        """
+        :param city: dict with aqi (or None) and place_counts (keyword -> number of places)
+        :return: value of each rule for the city, nan when the city has no data for the rule
+        """
+        counts = {keyword.strip().lower(): count for keyword, count in (city.get("place_counts") or {}).items()}
+        values = []
+        for metric, keywords in zip(self.metrics, self.keywords):
+            if metric == AQI:
+                values.append(np.nan if city.get("aqi") is None else city["aqi"])
+            else:
+                matched = [count for keyword, count in counts.items() if keywords is None or keyword in keywords]
+                values.append(sum(matched) if matched else np.nan)
+        return values
+
+    def evaluate(self, values, radius):
+        """
+        :param values: (cities, rules) values, nan where a city has no data for a rule
+        :param radius: (cities,) searched radius of each city in meters
+        :return: (passed, known, thresholds) arrays of shape (cities, rules), a rule which is not known is
+                 neither passed nor failed
+        """
+        values = np.asarray(values, dtype=np.float64).reshape(-1, len(self))
+        radius = np.asarray(radius, dtype=np.float64)[:, None]
+
+        with np.errstate(invalid="ignore"):
+            scaled = np.ceil(self.thresholds * radius / self.per_radius)
+        thresholds = np.minimum(np.where(np.isnan(self.per_radius), self.thresholds, scaled), self.max_values)
+        known = ~np.isnan(values)
+
+        difference = values - thresholds
+        with np.errstate(invalid="ignore"):
+            checks = np.stack([difference >= 0, difference > 0, difference <= 0, difference < 0, difference == 0])
+        passed = np.take_along_axis(checks, np.broadcast_to(self.operators, values.shape)[None], axis=0)[0] & known
+        return passed, known, thresholds
+
+    def scores(self, passed, known):
+        """
+        :param passed: (cities, rules) passed rules
+        :param known: (cities, rules) rules with data
+        :return: (cities,) weighted share of the known rules which passed, 0 to 100, nan when no rule is known
+        """
+        known_weight = known @ self.weights
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(known_weight > 0, 100 * (passed @ self.weights) / known_weight, np.nan)
+
+    def score_cities(self, cities):
+        """
+        :param cities: list of dicts with radius, aqi and place_counts, see city_values
+        :return: list of dicts with the score of each city and the result of each known rule
+        """
+        if not cities:
+            return []
+        values = np.array([self.city_values(city) for city in cities], dtype=np.float64).reshape(-1, len(self))
+        radius = [city.get("radius") or 0 for city in cities]
+        passed, known, thresholds = self.evaluate(values, radius)
+        scores = self.scores(passed, known)
+
+        results = []
+        for index, city in enumerate(cities):
+            rules = []
+            for rule in np.flatnonzero(known[index]):
+                template = self.pass_messages[rule] if passed[index, rule] else self.fail_messages[rule]
+                rules.append({
+                    "name": self.names[rule],
+                    "metric": self.metrics[rule],
+                    "passed": bool(passed[index, rule]),
+                    "value": float(values[index, rule]),
+                    "threshold": float(thresholds[index, rule]),
+                    "message": template.format(value=values[index, rule], threshold=thresholds[index, rule],
+                                               radius=radius[index], label=self.labels[rule])
+                    if template else None
+                })
+            results.append({"score": None if np.isnan(scores[index]) else round(float(scores[index]), 1),
+                            "rules": rules})
+        return results
@@ -0,0 +1,98 @@
+"""
+ transport_density.py contains the numpy helpers of the public transport analysis
+ the bus and train hubs around a center are binned on a square grid (hubs per km²), smoothed with a gaussian
+ kernel and every cell gets the distance to its nearest hub, cells of the circle farther than a walk from any hub
+ are the coverage gaps
+ distances are computed on a local plane in meters, which is accurate enough over a city
+"""
+import numpy as np
+
+from urbo_api.urbo_api_fetchdata.heatmap import degrees_per_meter
+
+# keywords of the stored places which count as public transport hubs
+TRANSPORT_KEYWORDS = ("bus stop", "bus stops", "bus station", "bus stations", "railway station", "railway stations",
+                      "train station", "train stations", "metro station", "metro stations")
+
+# cells compared with all the hubs at once, keeps the distance matrix (cells x hubs) small
+DISTANCE_CHUNK_CELLS = 1024
+
+# share of the score given by the coverage, the rest is given by the density
+COVERAGE_WEIGHT = 0.7
+
+
+def local_xy(lats, lons, lat: float, lon: float):
+    """
+    :param lats: latitudes of the points
+    :param lons: longitudes of the points
+    :param lat: latitude of the center
+    :param lon: longitude of the center
+    :return: (points, 2) x (east) and y (north) offsets of the points from the center in meters
+    """
+    lat_per_meter, lon_per_meter = degrees_per_meter(lat)
+    return np.column_stack(((np.asarray(lons, dtype=np.float64) - lon) / lon_per_meter,
+                            (np.asarray(lats, dtype=np.float64) - lat) / lat_per_meter)).reshape(-1, 2)
+
+
+def cell_centers(size: int, extent: float):
+    """
+    :param size: number of cells per side
+    :param extent: side of the square in meters
+    :return: (y, x) offsets in meters of the cell centers from the center, row 0 is the north edge
+    """
+    centers = (np.arange(size) + 0.5) * (extent / size) - extent / 2
+    x, y = np.meshgrid(centers, centers[::-1])
+    return y, x
+
+
+def hub_counts(hub_xy, size: int, extent: float):
+    """
+    :param hub_xy: (hubs, 2) positions of the hubs in meters
+    :param size: number of cells per side
+    :param extent: side of the square in meters
+    :return: (size, size) number of hubs in each cell, row 0 is the north edge, hubs outside the square are left out
+    """
+    hub_xy = np.asarray(hub_xy, dtype=np.float64).reshape(-1, 2)
+    edges = np.linspace(-extent / 2, extent / 2, size + 1)
+    counts, _, _ = np.histogram2d(hub_xy[:, 1], hub_xy[:, 0], bins=(edges, edges))
+    # histogram rows go from south to north
+    return counts[::-1]
+
+
+def hub_distances(hub_xy, cell_xy, bandwidth: float, chunk_cells: int = DISTANCE_CHUNK_CELLS):
+    """
+    Distance to the nearest hub and gaussian kernel density of the hubs at every cell
+    :param hub_xy: (hubs, 2) positions of the hubs in meters
+    :param cell_xy: (cells, 2) positions of the cells in meters
+    :param bandwidth: standard deviation of the kernel in meters
+    :param chunk_cells: cells compared with the hubs at once
+    :return: (nearest, density) arrays of shape (cells,), meters (inf without hubs) and hubs per km²
+    """
+    hub_xy = np.asarray(hub_xy, dtype=np.float64).reshape(-1, 2)
+    cell_xy = np.asarray(cell_xy, dtype=np.float64).reshape(-1, 2)
+    nearest = np.full(len(cell_xy), np.inf)
+    density = np.zeros(len(cell_xy))
+    if not len(hub_xy):
+        return nearest, density
+
+    # each kernel integrates to one hub, 1e6 turns hubs per m² into hubs per km²
+    norm = 1e6 / (2 * np.pi * bandwidth ** 2)
+    for start in range(0, len(cell_xy), chunk_cells):
+        end = start + chunk_cells
+        squared = ((cell_xy[start:end, None, :] - hub_xy[None, :, :]) ** 2).sum(axis=2)
+        nearest[start:end] = np.sqrt(squared.min(axis=1))
+        density[start:end] = norm * np.exp(squared / (-2 * bandwidth ** 2)).sum(axis=1)
+
+    return nearest, density
+
+
+def density_score(coverage: float, hubs_per_km2: float, target_density: float,
+                  coverage_weight: float = COVERAGE_WEIGHT):
+    """
+    :param coverage: share of the area within a walk of a hub, 0 to 1
+    :param hubs_per_km2: hubs per km² of the area
+    :param target_density: hubs per km² giving the full density part of the score
+    :param coverage_weight: share of the score given by the coverage
+    :return: score from 0 to 100
+    """
+    density_part = min(hubs_per_km2 / target_density, 1) if target_density > 0 else 1
+    return round(100 * (coverage_weight * coverage + (1 - coverage_weight) * density_part), 1)
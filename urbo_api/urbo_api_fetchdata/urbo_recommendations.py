@@ -4,6 +4,8 @@
 
 from enum import Enum
 
+from urbo_api.urbo_api_dataload.schema import PollutantSchema
+
 class AQILevel(Enum):
     GOOD = {
         "aqi": 1,
@@ -80,4 +82,19 @@ class PollutantInfo(Enum):
         "description": "A precursor to nitrogen dioxide and ozone formation, associated with combustion processes.",
         "source": "Combustion of fossil fuels, especially in vehicles and power plants.",
         "health_effects": "Can lead to the formation of more harmful pollutants like NO2 and ozone."
-    }
\ No newline at end of file
+    }
+
+
+# built once at import, every response shares them
+AQI_RECOMMENDATIONS = {level.value["aqi"]: f'{level.value["description"]} {level.value["action"]}'
+                       for level in AQILevel}
+
+POLLUTANTS_INFO = [
+    PollutantSchema(
+        pollutant_name=pollutant.value["name"],
+        description=pollutant.value["description"],
+        source=pollutant.value["source"],
+        health_effects=pollutant.value["health_effects"]
+    )
+    for pollutant in PollutantInfo
+]
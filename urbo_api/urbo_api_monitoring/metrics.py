@@ -0,0 +1,314 @@
+"""
+ metrics.py contains the instrumentation of the app and the /metrics endpoint in Prometheus text format
+ upstream calls (latency, status), DB cache lookups (hit, miss per table), DB queries and commits, http requests
+ recording a value is a dict lookup and an addition under a lock, so it can stay on the hot path
+"""
+import bisect
+import threading
+import time
+
+from fastapi import APIRouter, Response
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# seconds, covers DB lookups (ms) up to slow 3rd party api calls
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Metric:
+    """
+    Base of the metric types, one value per combination of label values
+    """
+    kind = None
+
+    def __init__(self, name: str, documentation: str, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def expose(self):
+        """
+        :return: lines of the metric in Prometheus text format
+        """
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            values = list(self._values.items())
+        for label_values, value in sorted(values):
+            lines.extend(self._sample_lines(label_values, value))
+        return lines
+
+    def _sample_lines(self, label_values, value):
+        return [f"{self.name}{format_labels(self.labels, label_values)} {format_value(value)}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *label_values, amount: float = 1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def inc(self, *label_values, amount: float = 1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def dec(self, *label_values, amount: float = 1):
+        self.inc(*label_values, amount=-amount)
+
+    def set(self, *label_values, value: float):
+        with self._lock:
+            self._values[label_values] = value
+
+
+class CallbackGauge(Metric):
+    """
+    Gauge whose value is read when /metrics is scraped, e.g. a queue size
+    """
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, callback):
+        super().__init__(name, documentation)
+        self.callback = callback
+
+    def expose(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}",
+                f"{self.name} {format_value(self.callback())}"]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, *label_values, value: float):
+        # counts are kept per bucket and made cumulative only when exposed
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(label_values)
+            if state is None:
+                state = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def _sample_lines(self, label_values, value):
+        bucket_counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), bucket_counts):
+            cumulative += bucket_count
+            labels = format_labels(self.labels + ("le",), label_values + (format_value(bound),))
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = format_labels(self.labels, label_values)
+        lines.append(f"{self.name}_sum{labels} {format_value(total)}")
+        lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Registry:
+    """
+    Metrics exposed on /metrics
+    """
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def expose(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.expose())
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{escape_label(str(value))}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def escape_label(value: str):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+registry = Registry()
+
+UPSTREAM_REQUESTS = registry.register(Counter(
+    "urbo_upstream_requests_total", "Calls to 3rd party api services by provider and outcome",
+    ("provider", "status")))
+UPSTREAM_DURATION = registry.register(Histogram(
+    "urbo_upstream_request_duration_seconds", "Duration of the calls to 3rd party api services",
+    ("provider",)))
+CACHE_LOOKUPS = registry.register(Counter(
+    "urbo_cache_lookups_total", "DB cache lookups by table and result (hit, stale, miss)", ("table", "result")))
+LOCAL_CACHE_LOOKUPS = registry.register(Counter(
+    "urbo_local_cache_lookups_total", "Lookups of the in-process and shared local cache by namespace and level "
+    "(memory, shared, miss)", ("namespace", "level")))
+WRITE_BEHIND_DROPPED_ROWS = registry.register(Counter(
+    "urbo_write_behind_dropped_rows_total", "Rows the write-behind worker could not write, by table", ("table",)))
+DB_QUERY_DURATION = registry.register(Histogram(
+    "urbo_db_query_duration_seconds", "Duration of the DB statements by kind (SELECT, INSERT ...)",
+    ("statement",)))
+DB_COMMIT_DURATION = registry.register(Histogram(
+    "urbo_db_commit_duration_seconds", "Duration of the session commits, flush included"))
+HTTP_IN_FLIGHT = registry.register(Gauge(
+    "urbo_http_requests_in_flight", "Requests being handled"))
+HTTP_DURATION = registry.register(Histogram(
+    "urbo_http_request_duration_seconds", "Duration of the requests by route and status",
+    ("method", "route", "status")))
+
+
+def observe_upstream(provider: str, status, duration: float = None):
+    """
+    :param provider: provider name
+    :param status: http status code, or the reason the call failed (timeout, error, circuit_open, rate_limited)
+    :param duration: seconds the call took, None when no call was made
+    """
+    UPSTREAM_REQUESTS.inc(provider, str(status))
+    if duration is not None:
+        UPSTREAM_DURATION.observe(provider, value=duration)
+
+
+def cache_lookup(table: str, result: str):
+    """
+    :param table: DB table used as cache
+    :param result: hit, stale or miss
+    """
+    CACHE_LOOKUPS.inc(table, result)
+
+
+def local_cache_lookup(namespace: str, level: str):
+    """
+    :param namespace: kind of data cached
+    :param level: memory, shared or miss
+    """
+    LOCAL_CACHE_LOOKUPS.inc(namespace, level)
+
+
+def write_behind_dropped(table: str, rows: int):
+    """
+    :param table: table the rows were written to
+    :param rows: number of rows dropped
+    """
+    WRITE_BEHIND_DROPPED_ROWS.inc(table, amount=rows)
+
+
+# ------------------------- DB -------------------------
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get("query_start")
+    if starts:
+        duration = time.perf_counter() - starts.pop()
+        DB_QUERY_DURATION.observe(statement_kind(statement), value=duration)
+
+
+@event.listens_for(Engine, "handle_error")
+def _handle_error(exception_context):
+    # a failed statement never reaches after_cursor_execute
+    connection = exception_context.connection
+    if connection is not None and connection.info.get("query_start"):
+        connection.info["query_start"].pop()
+
+
+@event.listens_for(Session, "before_commit")
+def _before_commit(session):
+    session.info["commit_start"] = time.perf_counter()
+
+
+@event.listens_for(Session, "after_commit")
+def _after_commit(session):
+    start = session.info.pop("commit_start", None)
+    if start is not None:
+        DB_COMMIT_DURATION.observe(value=time.perf_counter() - start)
+
+
+@event.listens_for(Session, "after_rollback")
+def _after_rollback(session):
+    session.info.pop("commit_start", None)
+
+
+def statement_kind(statement: str) -> str:
+    """
+    :param statement: SQL statement
+    :return: its first keyword (SELECT, INSERT ...), keeps the label values few
+    """
+    kind = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ""
+    return kind if kind in ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH") else "OTHER"
+
+
+# ------------------------- HTTP -------------------------
+
+class MetricsMiddleware:
+    """
+    Pure ASGI middleware counting the requests in flight and timing them by route template
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        HTTP_IN_FLIGHT.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            HTTP_IN_FLIGHT.dec()
+            route = scope.get("route")
+            # the route template, not the raw path, so ids in the path do not create new series
+            route_path = getattr(route, "path", None) or "unmatched"
+            HTTP_DURATION.observe(scope["method"], route_path, str(status["code"]),
+                                  value=time.perf_counter() - start)
+
+
+router = APIRouter(
+    tags=["monitoring"],
+    responses={404: {"description": "Not Found"}}
+)
+
+
+@router.get("/metrics", include_in_schema=False)
+def get_metrics():
+    """
+    :return: all the metrics in Prometheus text format
+    """
+    return Response(content=registry.expose(), media_type=CONTENT_TYPE)
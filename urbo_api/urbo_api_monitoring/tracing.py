@@ -0,0 +1,328 @@
+"""
+ tracing.py times the stages of each request (spans) and returns them in the Server-Timing response header
+ requests slower than SLOW_REQUEST_THRESHOLD_MS get their span tree, and optionally a sampled profile,
+ written as one JSON line to a rotating log file
+"""
+import asyncio
+import functools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import RotatingFileHandler
+
+from dotenv import load_dotenv
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# load environment variable
+load_dotenv()
+SERVER_TIMING_ENABLED = os.getenv("SERVER_TIMING_ENABLED", "true").lower() == "true"
+# requests slower than this are written to the slow request log, 0 disables the log
+SLOW_REQUEST_THRESHOLD_MS = float(os.getenv("SLOW_REQUEST_THRESHOLD_MS", "2000"))
+SLOW_REQUEST_LOG = os.getenv("SLOW_REQUEST_LOG", "logs/slow_requests.log")
+SLOW_REQUEST_LOG_MAX_BYTES = int(os.getenv("SLOW_REQUEST_LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+SLOW_REQUEST_LOG_BACKUPS = int(os.getenv("SLOW_REQUEST_LOG_BACKUPS", "5"))
+# sampling profiler, the stacks of the threads working on a request are sampled every interval
+SLOW_REQUEST_PROFILE = os.getenv("SLOW_REQUEST_PROFILE", "false").lower() == "true"
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+# stacks kept in the log for one request, the most sampled first
+PROFILE_TOP_STACKS = int(os.getenv("PROFILE_TOP_STACKS", "20"))
+
+_current_trace = ContextVar("current_trace", default=None)
+_current_span = ContextVar("current_span", default=None)
+
+
+class Span:
+    """
+    One timed stage of a request, its sub stages are its children
+    """
+    __slots__ = ("name", "start", "end", "children")
+
+    def __init__(self, name: str, start: float = None):
+        self.name = name
+        self.start = time.perf_counter() if start is None else start
+        self.end = None
+        self.children = []
+
+    @property
+    def duration(self):
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+    def to_dict(self, origin: float) -> dict:
+        """
+        :param origin: start of the request, offsets are relative to it
+        :return: span tree with times in milliseconds
+        """
+        data = {"name": self.name, "start_ms": round((self.start - origin) * 1000, 2),
+                "duration_ms": round(self.duration * 1000, 2)}
+        if self.children:
+            data["children"] = [child.to_dict(origin) for child in list(self.children)]
+        return data
+
+
+class Trace:
+    """
+    Spans, DB time and profile samples of one request
+    """
+
+    def __init__(self):
+        self.root = Span("total")
+        self.db_seconds = 0.0
+        self.db_queries = 0
+        self.threads = {threading.get_ident()}
+        self.samples = Counter()
+
+    def durations(self):
+        """
+        :return: total duration per span name, a stage run several times (e.g. one per keyword) is summed
+        """
+        totals = {}
+
+        def add(spans):
+            for current in list(spans):
+                totals[current.name] = totals.get(current.name, 0) + current.duration
+                add(current.children)
+
+        add(self.root.children)
+        return totals
+
+    def server_timing(self) -> str:
+        """
+        :return: Server-Timing header value
+        """
+        entries = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.durations().items()]
+        if self.db_queries:
+            entries.append(f'db;dur={self.db_seconds * 1000:.1f};desc="{self.db_queries} queries"')
+        entries.append(f"total;dur={self.root.duration * 1000:.1f}")
+        return ", ".join(entries)
+
+
+@contextmanager
+def span(name: str):
+    """
+    Times the block as a child of the current span, does nothing outside of a request
+    :param name: stage name, shown in the Server-Timing header
+    """
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+
+    child = Span(name)
+    parent.children.append(child)
+    trace = _current_trace.get()
+    if trace is not None and SLOW_REQUEST_PROFILE:
+        trace.threads.add(threading.get_ident())
+
+    token = _current_span.set(child)
+    try:
+        yield child
+    finally:
+        child.end = time.perf_counter()
+        _current_span.reset(token)
+
+
+def traced(name: str):
+    """
+    Decorator timing each call of the function (sync or async) as a span
+    :param name: stage name
+    """
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+# ------------------------- DB -------------------------
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current_trace.get() is not None:
+        conn.info.setdefault("trace_query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    trace = _current_trace.get()
+    starts = conn.info.get("trace_query_start")
+    if trace is not None and starts:
+        trace.db_seconds += time.perf_counter() - starts.pop()
+        trace.db_queries += 1
+
+
+@event.listens_for(Engine, "handle_error")
+def _handle_error(exception_context):
+    connection = exception_context.connection
+    if connection is not None and connection.info.get("trace_query_start"):
+        connection.info["trace_query_start"].pop()
+
+
+# ------------------------- PROFILER -------------------------
+
+class SamplingProfiler:
+    """
+    Background thread which samples the stacks of the threads of the traced requests,
+    it only runs while at least one request is traced
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._traces = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def add(self, trace: Trace):
+        with self._lock:
+            self._traces.add(trace)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+                self._thread.start()
+
+    def remove(self, trace: Trace):
+        with self._lock:
+            self._traces.discard(trace)
+
+    def _run(self):
+        own_ident = threading.get_ident()
+        while True:
+            with self._lock:
+                if not self._traces:
+                    self._thread = None
+                    return
+                traces = list(self._traces)
+
+            frames = sys._current_frames()
+            for trace in traces:
+                for ident in list(trace.threads):
+                    frame = frames.get(ident)
+                    if frame is not None and ident != own_ident:
+                        trace.samples[collapse_stack(frame)] += 1
+            time.sleep(self.interval)
+
+
+def collapse_stack(frame) -> str:
+    """
+    :param frame: innermost frame of a thread
+    :return: stack as "file:function;file:function", outermost first
+    """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+profiler = SamplingProfiler(PROFILE_INTERVAL_MS / 1000)
+
+
+# ------------------------- SLOW REQUEST LOG -------------------------
+
+slow_request_logger = logging.getLogger("urbo.slow_requests")
+slow_request_logger.propagate = False
+
+
+def _configure_slow_request_log():
+    if slow_request_logger.handlers:
+        return
+    directory = os.path.dirname(SLOW_REQUEST_LOG)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    handler = RotatingFileHandler(SLOW_REQUEST_LOG, maxBytes=SLOW_REQUEST_LOG_MAX_BYTES,
+                                  backupCount=SLOW_REQUEST_LOG_BACKUPS)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    slow_request_logger.addHandler(handler)
+    slow_request_logger.setLevel(logging.INFO)
+
+
+def log_slow_request(scope, status: int, trace: Trace):
+    _configure_slow_request_log()
+    record = {
+        "time": datetime.now(timezone.utc).isoformat(),
+        "method": scope["method"],
+        "path": scope["path"],
+        "query": scope.get("query_string", b"").decode("latin-1"),
+        "status": status,
+        "duration_ms": round(trace.root.duration * 1000, 2),
+        "db": {"queries": trace.db_queries, "duration_ms": round(trace.db_seconds * 1000, 2)},
+        "spans": trace.root.to_dict(trace.root.start)
+    }
+    if trace.samples:
+        record["profile"] = {
+            "interval_ms": PROFILE_INTERVAL_MS,
+            "samples": sum(trace.samples.values()),
+            "stacks": [{"stack": stack, "count": count}
+                       for stack, count in trace.samples.most_common(PROFILE_TOP_STACKS)]
+        }
+    slow_request_logger.info(json.dumps(record))
+
+
+# ------------------------- MIDDLEWARE -------------------------
+
+class TimingMiddleware:
+    """
+    Pure ASGI middleware starting the trace of each request and adding the Server-Timing header,
+    the time between the end of the last stage and the response start is reported as serialization
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        trace = Trace()
+        trace_token = _current_trace.set(trace)
+        span_token = _current_span.set(trace.root)
+        if SLOW_REQUEST_PROFILE:
+            profiler.add(trace)
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                if trace.root.children:
+                    last_end = max(child.end or child.start for child in trace.root.children)
+                    serialization = Span("serialization", last_end)
+                    serialization.end = time.perf_counter()
+                    trace.root.children.append(serialization)
+                if SERVER_TIMING_ENABLED:
+                    headers = list(message.get("headers", []))
+                    headers.append((b"server-timing", trace.server_timing().encode("latin-1")))
+                    message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            trace.root.end = time.perf_counter()
+            if SLOW_REQUEST_PROFILE:
+                profiler.remove(trace)
+            _current_span.reset(span_token)
+            _current_trace.reset(trace_token)
+
+            if SLOW_REQUEST_THRESHOLD_MS and trace.root.duration * 1000 >= SLOW_REQUEST_THRESHOLD_MS:
+                try:
+                    log_slow_request(scope, status["code"], trace)
+                except Exception:
+                    logging.getLogger(__name__).exception("Could not write the slow request log")
@@ -1,18 +1,34 @@
 """
 starter file to start the fastapi app
 how to run?
+    python -m urbo_api.urbo_api_dataload.migrate    (once on deploy, brings the DB schema up to date)
     uvicorn urbo_app_main:app --reload
     uvicorn urbo_api.urbo_app_main:app --reload
 
 """
 
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import  CORSMiddleware
+from urbo_api.db_connect.db import dispose_async_engine
+from urbo_api.db_connect.write_behind import WRITE_BEHIND_ENABLED, write_behind_queue
+from urbo_api.urbo_api_dataload.http_client import UpstreamClient
 from urbo_api.urbo_api_dataload.data_nearbyplaces_api import router as data_load
 from urbo_api.urbo_api_dataload.geocode_api import router as geocode
 from urbo_api.urbo_api_dataload.map_image_api import router as map
 from urbo_api.urbo_api_dataload.air_pollution_api import router as air_pollution
+from urbo_api.urbo_api_dataload.air_quality_history_api import router as air_quality_history
+from urbo_api.urbo_api_dataload.upstream_scheduler import router as upstream
 from urbo_api.urbo_api_fetchdata.fetch_data import router as fetch_urban_planning_data
+from urbo_api.urbo_api_fetchdata.air_quality_heatmap import router as air_quality_heatmap
+from urbo_api.urbo_api_fetchdata.cache_warming_api import cache_warmer
+from urbo_api.urbo_api_fetchdata.cache_warming_api import router as cache_warming
+from urbo_api.urbo_api_fetchdata.recommendations_api import router as recommendations
+from urbo_api.urbo_api_fetchdata.public_transport_api import router as public_transport
+from urbo_api.urbo_api_monitoring.metrics import CallbackGauge, MetricsMiddleware, registry
+from urbo_api.urbo_api_monitoring.metrics import router as metrics
+from urbo_api.urbo_api_monitoring.tracing import TimingMiddleware
 import sys
 import os
 from pyfiglet import  Figlet
@@ -22,15 +38,35 @@ sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 figlet = Figlet(font='slant')
 text_art = figlet.renderText('URBO')
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # one pooled http client for all the routers, it keeps connections alive across requests
+    app.state.http_client = UpstreamClient()
+    if WRITE_BEHIND_ENABLED:
+        write_behind_queue.start()
+    # loads the configured places ahead of demand, does nothing when no place is configured
+    cache_warmer.start(app.state.http_client)
+    yield
+    await cache_warmer.stop()
+    # write what is still queued before the process exits
+    write_behind_queue.stop()
+    app.state.http_client.close()
+    await dispose_async_engine()
+
+
 app = FastAPI(
     title="URBO - Sustainability Tool for Urban Planning",
-    version="v0.1.0a"
+    version="v0.1.0a",
+    lifespan=lifespan
 )
 
 origins = [
     "http://localhost:8080"
 ]
 
+app.add_middleware(TimingMiddleware)
+app.add_middleware(MetricsMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
@@ -46,7 +82,17 @@ app.include_router(data_load)
 app.include_router(geocode)
 app.include_router(map)
 app.include_router(air_pollution)
+app.include_router(air_quality_history)
 app.include_router(fetch_urban_planning_data)
+app.include_router(air_quality_heatmap)
+app.include_router(cache_warming)
+app.include_router(recommendations)
+app.include_router(public_transport)
+app.include_router(upstream)
+app.include_router(metrics)
+
+registry.register(CallbackGauge("urbo_write_behind_queue_size", "Rows waiting in the write-behind queue",
+                                lambda: write_behind_queue.size))
 
 # root welcome api
 @app.get("/")